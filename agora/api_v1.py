@@ -16,3 +16,4 @@ def validation_error_handler(request, exc):
 api.add_router("/user/webhooks/", "user.webhooks.router")
 api.add_router("/user/", "user.api.router")
 api.add_router("/newsletter/", "agora.newsletter.api.router")
+api.add_router("/core/", "agora.core.api.router")
@@ -0,0 +1,49 @@
+from django.http import HttpRequest
+from ninja import Router, Schema
+from ninja.security import django_auth_is_staff
+
+from . import selectors
+
+router = Router(auth=django_auth_is_staff)
+
+
+class CacheOperationLatency(Schema):
+    count: int
+    # Upper bounds (in seconds) of the histogram buckets the percentiles fall in
+    p50: float | None
+    p95: float | None
+    p99: float | None
+    buckets: dict[str, int]
+
+
+class CachePrefixStats(Schema):
+    hits: int
+    local_hits: int
+    misses: int
+    timeouts: int
+    sets: int
+    deletes: int
+    hit_rate: float | None
+    latency: dict[str, CacheOperationLatency]
+
+
+class CacheStatsResponse(Schema):
+    workers: int
+    prefixes: dict[str, CachePrefixStats]
+
+
+class CacheStatsUnavailableResponse(Schema):
+    detail: str
+
+
+@router.get(
+    "/cache/stats/",
+    response={200: CacheStatsResponse, 404: CacheStatsUnavailableResponse},
+    url_name="cache_stats",
+)
+def cache_stats(request: HttpRequest):
+    metrics = selectors.cache_metrics()
+    if metrics is None:
+        return 404, {"detail": "The default cache doesn't record metrics"}
+
+    return 200, metrics.summary()
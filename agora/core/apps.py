@@ -1,6 +1,12 @@
 from django.apps import AppConfig
+from django.db.models.signals import pre_migrate
 
 
 class CoreAppConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "agora.core"
+
+    def ready(self) -> None:
+        from . import signals
+
+        pre_migrate.connect(signals.configure_database_before_migrating, sender=self)
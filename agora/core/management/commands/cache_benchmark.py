@@ -0,0 +1,411 @@
+import multiprocessing
+import os
+import random
+import shutil
+import tempfile
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field, replace
+from datetime import date
+from typing import Any
+
+import django
+import stripe
+from diskcache import DjangoCache
+from django.conf import settings
+from django.core.cache.backends.base import BaseCache
+from django.core.cache.backends.filebased import FileBasedCache
+from django.core.management.base import BaseCommand, CommandError, CommandParser
+from django.utils.module_loading import import_string
+
+from user import selectors, services
+from user.stripe_client import circuit_breaker
+from utils.benchmark import summarize_latencies
+from utils.cache import CachedValue
+
+# Relative weights of the cache calls made while serving requests, see the `Workload` methods
+OPERATIONS = {
+    "onboarding_state": 35,
+    "price_catalog": 20,
+    "stripe_call": 15,
+    "rate_limit": 15,
+    "checkout_session": 10,
+    "invalidate": 5,
+}
+DEFAULT_BACKENDS = [
+    "default",
+    "diskcache:8:10",
+    "diskcache:16:10",
+    "diskcache:8:100",
+    "diskcache:1:10",
+    "locmem",
+    "filebased",
+]
+BENCHMARK_PRICE_ID = "price_benchmark"
+
+
+@dataclass(frozen=True, slots=True)
+class BackendConfig:
+    """A cache to benchmark, built the way Django builds the ones in `CACHES`."""
+
+    label: str
+    backend: str
+    location: str = ""
+    params: dict[str, Any] = field(default_factory=dict)
+    # Whether processes share the cache, they don't with the local memory cache
+    shared: bool = True
+
+    def create(self) -> BaseCache:
+        return import_string(self.backend)(self.location, self.params)
+
+
+@dataclass(slots=True)
+class WorkloadResult:
+    """What one process measured."""
+
+    latencies: dict[str, list[float]]
+    expected_hits: int = 0
+    unexpected_misses: int = 0
+    errors: Counter[str] = field(default_factory=Counter)
+
+
+def _price_catalog() -> selectors.StripePriceCatalog:
+    prices = {
+        f"benchmark_{i}": stripe.Price.construct_from(
+            {
+                "id": f"price_benchmark_{i}",
+                "object": "price",
+                "active": True,
+                "currency": "usd",
+                "lookup_key": f"benchmark_{i}",
+                "unit_amount": 500 * (i + 1),
+                "recurring": {"interval": "month", "interval_count": 1},
+                "product": {
+                    "id": f"prod_benchmark_{i}",
+                    "object": "product",
+                    "name": f"Benchmark plan {i}",
+                    "description": "A plan that only exists in the cache benchmark",
+                    "metadata": {"features": "voting,proposals,discussions"},
+                },
+            },
+            "sk_benchmark",
+        )
+        for i in range(6)
+    }
+    return selectors.StripePriceCatalog(prices=prices, fetched_at=time.time())
+
+
+class Workload:
+    """The cache calls made by the selectors, services and decorators while serving requests.
+
+    Every call uses the same keys (and values of the same types) as the code it mimics. The
+    first half of the users is never invalidated, so along with the price catalog (stored
+    without a timeout) a miss on their onboarding state can only mean the read timed out
+    (or the entry was evicted).
+    """
+
+    def __init__(self, *, cache: BaseCache, users: int, seed: int):
+        self.cache = cache
+        self.users = users
+        self.stable_users = max(1, users // 2)
+        self.rng = random.Random(seed)
+        self.result = WorkloadResult(latencies={operation: [] for operation in OPERATIONS})
+
+    def populate(self) -> None:
+        self.cache.set(
+            selectors.PRICE_CATALOG_CACHE_KEY,
+            CachedValue(value=_price_catalog(), fresh_until=float("inf"), compute_time=0.5),
+            timeout=None,
+        )
+        for user_id in range(self.users):
+            self.cache.set(
+                selectors.onboarding_state_generation_key(user_id=user_id), 0, timeout=None
+            )
+            self._set_onboarding_state(user_id=user_id, generation=0)
+
+    def run(self, *, until: float) -> WorkloadResult:
+        operations = list(OPERATIONS)
+        weights = list(OPERATIONS.values())
+        latencies = self.result.latencies
+        while time.monotonic() < until:
+            (operation,) = self.rng.choices(operations, weights)
+            start = time.monotonic()
+            try:
+                getattr(self, operation)()
+            except Exception as e:
+                self.result.errors[f"{operation}: {type(e).__name__}"] += 1
+            latencies[operation].append(time.monotonic() - start)
+        return self.result
+
+    def _expect_hit(self, value: Any) -> None:
+        self.result.expected_hits += 1
+        if value is None:
+            self.result.unexpected_misses += 1
+
+    def _set_onboarding_state(self, *, user_id: int, generation: int) -> None:
+        onboarding_state = selectors.OnboardingState(
+            mfa_enabled=True,
+            subscription_expiration_date=date(2100, 1, 1) if user_id % 3 else None,
+            identity_verification_status=selectors.UserVerificationStatus.MISSING,
+        )
+        self.cache.set(
+            selectors.onboarding_state_cache_key(user_id=user_id, generation=generation),
+            CachedValue(value=onboarding_state, fresh_until=float("inf"), compute_time=0.002),
+            timeout=selectors.ONBOARDING_STATE_CACHE_TIMEOUT,
+        )
+
+    def onboarding_state(self) -> None:
+        # `selectors.user_onboarding_state`, called by the onboarding middleware
+        user_id = self.rng.randrange(self.users)
+        generation = self.cache.get(selectors.onboarding_state_generation_key(user_id=user_id))
+        if generation is None:
+            # The state isn't cached without a generation
+            self._expect_hit(generation)
+            return
+        cache_key = selectors.onboarding_state_cache_key(user_id=user_id, generation=generation)
+        value = self.cache.get(cache_key)
+        if user_id < self.stable_users:
+            self._expect_hit(value)
+        elif value is None:
+            # Computed under `get_or_compute`'s lock
+            lock_key = f"lock:{cache_key}"
+            if self.cache.add(lock_key, True, timeout=60):
+                self._set_onboarding_state(user_id=user_id, generation=generation)
+                self.cache.delete(lock_key)
+
+    def price_catalog(self) -> None:
+        # `selectors.stripe_price_catalog`, read whenever prices are shown
+        self._expect_hit(self.cache.get(selectors.PRICE_CATALOG_CACHE_KEY))
+
+    def stripe_call(self) -> None:
+        # `decorators.stripe_unavailable_retry_page` then the circuit breaker around the call
+        self.cache.get(circuit_breaker.opened_at_key)
+        self.cache.get(circuit_breaker.opened_at_key)
+        self.cache.get_many([circuit_breaker.failures_key, circuit_breaker.opened_at_key])
+
+    def rate_limit(self) -> None:
+        # allauth's rate limits keep a list of recent attempts per IP address
+        cache_key = f"allauth:rl:login:ip:10.0.{self.rng.randrange(self.users)}"
+        history = self.cache.get(cache_key, [])
+        now = time.time()
+        history = [attempt for attempt in history if attempt > now - 60][-4:]
+        self.cache.set(cache_key, [*history, now], 60)
+
+    def checkout_session(self) -> None:
+        # `services.create_stripe_checkout_session_for_subscription`
+        cache_key = services.checkout_session_cache_key(
+            user_id=self.rng.randrange(self.users), stripe_price_id=BENCHMARK_PRICE_ID
+        )
+        if self.cache.get(cache_key) is not None:
+            return
+        lock_key = f"{cache_key}:lock"
+        if self.cache.add(lock_key, True, timeout=services.CHECKOUT_SESSION_LIFETIME):
+            checkout_session_obj = stripe.checkout.Session.construct_from(
+                {"id": f"cs_benchmark_{self.rng.getrandbits(64):x}", "url": "https://example.com"},
+                "sk_benchmark",
+            )
+            self.cache.set(
+                cache_key, checkout_session_obj, timeout=services.CHECKOUT_SESSION_LIFETIME
+            )
+            self.cache.delete(lock_key)
+
+    def invalidate(self) -> None:
+        # A webhook was applied, `services.invalidate_user_onboarding_state` and fulfilment
+        user_id = self.rng.randrange(self.stable_users, self.users) if self.users > 1 else 0
+        generation_key = selectors.onboarding_state_generation_key(user_id=user_id)
+        try:
+            self.cache.incr(generation_key)
+        except ValueError:
+            self.cache.add(generation_key, 0, timeout=None)
+        self.cache.delete(
+            services.checkout_session_cache_key(user_id=user_id, stripe_price_id=BENCHMARK_PRICE_ID)
+        )
+
+
+def _run_workload(
+    config: BackendConfig, *, users: int, seed: int, start_at: float, duration: float
+) -> WorkloadResult:
+    cache = config.create()
+    try:
+        workload = Workload(cache=cache, users=users, seed=seed)
+        if not config.shared:
+            workload.populate()
+        # Wait for the other processes so that they all hit the cache at the same time
+        time.sleep(max(0.0, start_at - time.time()))
+        return workload.run(until=time.monotonic() + start_at + duration - time.time())
+    finally:
+        cache.close()
+
+
+def _parse_backend(spec: str, *, directory: str) -> BackendConfig:
+    name, _, arguments = spec.partition(":")
+    if name == "default":
+        default = settings.CACHES["default"]
+        config = BackendConfig(
+            label=f"default ({default['BACKEND'].rsplit('.', 1)[-1]})",
+            backend=default["BACKEND"],
+            location=default.get("LOCATION", ""),
+            params={key: value for key, value in default.items() if key != "LOCATION"},
+        )
+        if issubclass(import_string(config.backend), DjangoCache | FileBasedCache):
+            config = replace(config, location=tempfile.mkdtemp(dir=directory))
+        return config
+
+    if name == "diskcache":
+        try:
+            shards, timeout, *size_limit = arguments.split(":")
+            params = {
+                "SHARDS": int(shards),
+                "DATABASE_TIMEOUT": float(timeout) / 1000,
+                "OPTIONS": {"size_limit": int(size_limit[0]) * 2**20} if size_limit else {},
+            }
+        except ValueError as e:
+            raise CommandError(
+                f"Expected diskcache:SHARDS:TIMEOUT_MS[:SIZE_LIMIT_MB], got {spec}"
+            ) from e
+        return BackendConfig(
+            label=f"diskcache shards={shards} timeout={timeout}ms"
+            + (f" size_limit={size_limit[0]}MB" if size_limit else ""),
+            backend="diskcache.DjangoCache",
+            location=tempfile.mkdtemp(dir=directory),
+            params=params,
+        )
+
+    # Large enough that culling doesn't count as misses
+    options = {"MAX_ENTRIES": 10**7}
+    if name == "locmem":
+        return BackendConfig(
+            label="locmem (per process)",
+            backend="django.core.cache.backends.locmem.LocMemCache",
+            location="cache-benchmark",
+            params={"OPTIONS": options},
+            shared=False,
+        )
+    if name == "filebased":
+        return BackendConfig(
+            label="filebased",
+            backend="django.core.cache.backends.filebased.FileBasedCache",
+            location=tempfile.mkdtemp(dir=directory),
+            params={"OPTIONS": options},
+        )
+    raise CommandError(f"Unknown backend {spec}")
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark cache backends with the cache calls made while serving requests, from "
+        "several processes at once, and report their throughput, latency and the misses "
+        "caused by timeouts."
+    )
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument(
+            "--backend",
+            action="append",
+            dest="backends",
+            help=(
+                "Backend to benchmark, can be repeated: default (the configured default "
+                "cache), diskcache:SHARDS:TIMEOUT_MS[:SIZE_LIMIT_MB], locmem or filebased. "
+                f"Defaults to {', '.join(DEFAULT_BACKENDS)}."
+            ),
+        )
+        parser.add_argument(
+            "--processes",
+            type=int,
+            default=os.cpu_count() or 1,
+            help="Processes using each cache at the same time, like the web server's workers.",
+        )
+        parser.add_argument(
+            "--duration", type=float, default=10.0, help="Seconds to run each backend for."
+        )
+        parser.add_argument(
+            "--users", type=int, default=1000, help="Users whose keys are spread over."
+        )
+        parser.add_argument(
+            "--directory",
+            default=settings.CACHES["default"].get("LOCATION") or tempfile.gettempdir(),
+            help=(
+                "Where the file based caches are created (and removed afterwards), defaults "
+                "to the default cache's directory so that they're on the same disk."
+            ),
+        )
+
+    def handle(self, *args, **options) -> None:
+        processes: int = options["processes"]
+        os.makedirs(options["directory"], exist_ok=True)
+        directory = tempfile.mkdtemp(prefix="cache-benchmark-", dir=options["directory"])
+        self.stdout.write(
+            f"Running each backend for {options['duration']}s in {processes} process(es) "
+            f"over {options['users']} users"
+        )
+
+        try:
+            with ProcessPoolExecutor(
+                max_workers=processes,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=django.setup,
+            ) as pool:
+                for i, spec in enumerate(options["backends"] or DEFAULT_BACKENDS):
+                    config = _parse_backend(spec, directory=directory)
+                    # Leave time for the processes spawned for the first backend to set up Django
+                    self.benchmark(
+                        config, pool=pool, setup_time=5.0 if i == 0 else 1.0, options=options
+                    )
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def benchmark(
+        self,
+        config: BackendConfig,
+        *,
+        pool: ProcessPoolExecutor,
+        setup_time: float,
+        options: dict[str, Any],
+    ) -> None:
+        processes: int = options["processes"]
+        cache = config.create()
+        try:
+            cache.clear()
+            if config.shared:
+                Workload(cache=cache, users=options["users"], seed=0).populate()
+        finally:
+            cache.close()
+
+        # After populating, which can take longer than the setup time on slow backends
+        start_at = time.time() + setup_time
+        futures = [
+            pool.submit(
+                _run_workload,
+                config,
+                users=options["users"],
+                seed=seed,
+                start_at=start_at,
+                duration=options["duration"],
+            )
+            for seed in range(1, processes + 1)
+        ]
+        results = [future.result() for future in futures]
+
+        latencies: dict[str, list[float]] = {operation: [] for operation in OPERATIONS}
+        errors: Counter[str] = Counter()
+        for result in results:
+            for operation, operation_latencies in result.latencies.items():
+                latencies[operation].extend(operation_latencies)
+            errors.update(result.errors)
+        all_latencies = [latency for values in latencies.values() for latency in values]
+        expected_hits = sum(result.expected_hits for result in results)
+        unexpected_misses = sum(result.unexpected_misses for result in results)
+        miss_rate = unexpected_misses / expected_hits if expected_hits else 0.0
+
+        self.stdout.write(self.style.MIGRATE_HEADING(config.label))
+        self.stdout.write(
+            f"  {len(all_latencies) / options['duration']:.0f} operations/s, "
+            f"{unexpected_misses} of {expected_hits} reads of present keys missed "
+            f"({miss_rate:.2%}), {errors.total()} errors"
+        )
+        self.stdout.write(f"  all: {summarize_latencies(all_latencies)}")
+        for operation, operation_latencies in latencies.items():
+            self.stdout.write(f"  {operation}: {summarize_latencies(operation_latencies)}")
+        for error, count in errors.most_common():
+            self.stdout.write(f"  {count} x {error}")
@@ -0,0 +1,58 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError, CommandParser
+
+from agora.core import selectors
+
+
+def _milliseconds(seconds: float | None) -> str:
+    return "-" if seconds is None else f"{seconds * 1000:g}"
+
+
+class Command(BaseCommand):
+    help = (
+        "Show cache hits, misses, timeouts, writes and latency per key prefix, added up over "
+        "all workers."
+    )
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument("--alias", default="default", help="Cache to show.")
+        parser.add_argument("--json", action="store_true", help="Output the raw numbers.")
+        parser.add_argument(
+            "--reset", action="store_true", help="Start counting from zero in every worker."
+        )
+
+    def handle(self, *args, **options) -> None:
+        metrics = selectors.cache_metrics(alias=options["alias"])
+        if metrics is None:
+            raise CommandError(f"The {options['alias']} cache doesn't record metrics")
+
+        if options["reset"]:
+            metrics.reset()
+            self.stdout.write("Reset the cache metrics")
+            return
+
+        summary = metrics.summary()
+        if options["json"]:
+            self.stdout.write(json.dumps(summary, indent=2))
+            return
+
+        self.stdout.write(f"Metrics from {summary['workers']} worker(s)")
+        self.stdout.write(
+            f"{'prefix':<32} {'hits':>8} {'local':>8} {'misses':>8} {'timeouts':>8} "
+            f"{'sets':>8} {'deletes':>8} {'hit rate':>8}  get p50/p95/p99 ms   set p50/p95/p99 ms"
+        )
+        for prefix, stats in summary["prefixes"].items():
+            hit_rate = "-" if stats["hit_rate"] is None else f"{stats['hit_rate']:.1%}"
+            latencies = [
+                "/".join(
+                    _milliseconds(stats["latency"][operation][percentile])
+                    for percentile in ("p50", "p95", "p99")
+                )
+                for operation in ("get", "set")
+            ]
+            self.stdout.write(
+                f"{prefix:<32} {stats['hits']:>8} {stats['local_hits']:>8} "
+                f"{stats['misses']:>8} {stats['timeouts']:>8} {stats['sets']:>8} "
+                f"{stats['deletes']:>8} {hit_rate:>8}  {latencies[0]:<20} {latencies[1]}"
+            )
@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand, CommandError, CommandParser
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from utils.db import SQLiteDatabaseInUse, configure_sqlite_database, rebuild_sqlite_database
+
+
+class Command(BaseCommand):
+    help = (
+        "Rebuild the SQLite database file to apply the page size and auto vacuum mode in "
+        "SQLITE_DATABASE_PRAGMAS. Stop the app (and the Stripe event worker) first: the "
+        "rebuild needs the only connection to the database and refuses to run otherwise. "
+        "It rewrites the whole file so takes a while and needs as much free disk space again."
+    )
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument("--database", default=DEFAULT_DB_ALIAS, help="Database to rebuild.")
+
+    def handle(self, *args, **options) -> None:
+        using = options["database"]
+        if connections[using].vendor != "sqlite":
+            raise CommandError(f"The {using} database isn't SQLite")
+
+        differing = configure_sqlite_database(using=using)
+        if not differing:
+            self.stdout.write("Nothing to do, the PRAGMAs already match")
+            return
+
+        self.stdout.write(f"Rebuilding to change {differing}")
+        try:
+            rebuild_sqlite_database(using=using)
+        except SQLiteDatabaseInUse as e:
+            raise CommandError(
+                f"The database is in use ({e}), stop the app before rebuilding it"
+            ) from e
+        finally:
+            connections[using].close()
+
+        self.stdout.write(self.style.SUCCESS("Rebuilt the database"))
@@ -0,0 +1,8 @@
+from django.core.cache import caches
+
+from utils.cache_backends import CacheMetrics
+
+
+def cache_metrics(*, alias: str = "default") -> CacheMetrics | None:
+    """Metrics of a cache, `None` if its backend doesn't record any."""
+    return getattr(caches[alias], "metrics", None)
@@ -0,0 +1,19 @@
+import logging
+
+from utils.db import READ_ONLY_DB_ALIAS, configure_sqlite_database
+
+logger = logging.getLogger(__name__)
+
+
+def configure_database_before_migrating(sender, using: str, **kwargs) -> None:
+    # Connected for this app only (see `CoreAppConfig.ready`) as it's sent for every app.
+    # Before any tables are created so a new database starts with the right page size.
+    if using == READ_ONLY_DB_ALIAS:
+        return
+
+    differing = configure_sqlite_database(using=using)
+    if differing:
+        logger.warning(
+            f"SQLite PRAGMAs differ from SQLITE_DATABASE_PRAGMAS: {differing}. Stop the app and "
+            f"run `manage.py rebuild_sqlite_database --database {using}` to apply them."
+        )
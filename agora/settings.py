@@ -18,7 +18,6 @@ import tempfile
 from pathlib import Path
 
 import environ
-import stripe
 
 PROJECT_DIR = Path(__file__).resolve().parent
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -92,6 +91,7 @@ if DEBUG and not TESTING:
     ]
 
 MIDDLEWARE = [
+    "utils.deadline.RequestDeadlineMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
@@ -253,27 +253,35 @@ DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 # For databases, if using SQLITE, add the following options
 # https://gcollazo.com/optimal-sqlite-settings-for-django/
 # https://briandouglas.ie/sqlite-defaults/
+# Run on every new connection, which are kept open between requests (`CONN_MAX_AGE`)
 SQLITE_OPTIONS = {
     "init_command": (
         "PRAGMA foreign_keys = ON;"
-        "PRAGMA journal_mode = WAL;"
         "PRAGMA synchronous = NORMAL;"
         "PRAGMA busy_timeout = 500;"  # 500ms
         "PRAGMA temp_store = MEMORY;"
-        "PRAGMA auto_vacuum = INCREMENTAL;"
-        f"PRAGMA page_size = {8 * 1024};"  # 8KB
         f"PRAGMA mmap_size = {128 * 1024 * 1024};"  # 128MB
         f"PRAGMA journal_size_limit = {64 * 1024 * 1024};"  # 64MB
         f"PRAGMA cache_size = -{20 * 1024 * 1024};"  # 20MB of 4096 bytes pages
     ),
     "transaction_mode": "IMMEDIATE",
 }
+# Stored in the database file so only set once, before migrating (see
+# `utils.db.configure_sqlite_database`)
+SQLITE_DATABASE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "auto_vacuum": "INCREMENTAL",
+    "page_size": 8 * 1024,  # 8KB
+}
+# Seconds a connection is reused for, checked before each request that reuses it
+DB_CONN_MAX_AGE = env.int("DB_CONN_MAX_AGE", default=600)  # type: ignore
 
 # Cache
 # https://docs.djangoproject.com/en/5.1/topics/cache/
 CACHES = {
     "default": {
-        "BACKEND": "diskcache.DjangoCache",
+        # diskcache with an in-process LRU in front of it for hot keys
+        "BACKEND": "utils.cache_backends.TieredCache",
         "LOCATION": env.str("CACHE_FILEPATH", tempfile.gettempdir()),  # type: ignore
         "TIMEOUT": 300,
         # ^-- Django setting for default timeout of each key.
@@ -283,6 +291,21 @@ CACHES = {
         "OPTIONS": {
             "size_limit": 2**30  # 1 gigabyte
         },
+        # Keys (read often, written rarely) that are also kept in each worker's memory
+        "LOCAL_KEY_PREFIXES": ["stripe:price:"],
+        "LOCAL_VERSIONED_KEY_PREFIXES": ["user:onboarding_state:"],
+        # ^-- Kept in memory too, but their keys include a generation of their own so writing
+        # one doesn't drop the other workers' copies.
+        "LOCAL_MAX_ENTRIES": 1024,
+        "LOCAL_TIMEOUT": 60,
+        # ^-- Seconds a worker keeps its copy of a key at most.
+        "GENERATION_CHECK_INTERVAL": 1.0,
+        # ^-- Seconds between checks for keys changed by other workers.
+        # Hits, misses, timeouts and latency are recorded per key prefix (e.g. `stripe:price`),
+        # see `manage.py cache_stats`
+        "METRICS_KEY_DEPTH": 2,
+        "METRICS_FLUSH_INTERVAL": 10,
+        # ^-- Seconds between each worker writing its metrics to the shared store.
     },
 }
 
@@ -484,17 +507,54 @@ STRIPE_SECRET_KEY = env.str("STRIPE_SECRET_KEY")
 STRIPE_PUBLISHABLE_KEY = env.str("STRIPE_PUBLISHABLE_KEY")
 STRIPE_WEBHOOK_SECRET = env.str("STRIPE_WEBHOOK_SECRET")
 STRIPE_VERIFICATION_FLOW_ID = env.str("STRIPE_VERIFICATION_FLOW_ID")
-
-stripe.api_key = STRIPE_SECRET_KEY
+# Timeout for a single request to Stripe
+STRIPE_TIMEOUT = env.float("STRIPE_TIMEOUT", default=2.0)  # type: ignore
+# Deadline for a Stripe operation including retries, keep below gunicorn's `timeout`
+STRIPE_OPERATION_TIMEOUT = env.float("STRIPE_OPERATION_TIMEOUT", default=4.0)  # type: ignore
+STRIPE_MAX_NETWORK_RETRIES = env.int("STRIPE_MAX_NETWORK_RETRIES", default=2)  # type: ignore
+STRIPE_CONNECTION_POOL_SIZE = env.int("STRIPE_CONNECTION_POOL_SIZE", default=10)  # type: ignore
+# Override to point at a local fake Stripe server (e.g. for load testing)
+STRIPE_API_BASE = env.str("STRIPE_API_BASE", default="https://api.stripe.com")  # type: ignore
+# Failures within the window that open the circuit breaker, after which Stripe isn't called
+# until the reset timeout passes and a probe call succeeds
+STRIPE_CIRCUIT_FAILURE_THRESHOLD = env.int("STRIPE_CIRCUIT_FAILURE_THRESHOLD", default=5)  # type: ignore
+STRIPE_CIRCUIT_FAILURE_WINDOW = env.float("STRIPE_CIRCUIT_FAILURE_WINDOW", default=30.0)  # type: ignore
+STRIPE_CIRCUIT_RESET_TIMEOUT = env.float("STRIPE_CIRCUIT_RESET_TIMEOUT", default=30.0)  # type: ignore
+# Threads per worker process that make Stripe calls on behalf of requests
+STRIPE_EXECUTOR_WORKERS = env.int("STRIPE_EXECUTOR_WORKERS", default=4)  # type: ignore
 
 # Agora settings
 # ------------------------------------
 
 DJANGO_ADMIN_URL = env.str("DJANGO_ADMIN_URL", default="django-admin/")  # pyright: ignore
 
+# Time a request has to respond, keep below gunicorn's `timeout` so slow calls can give up
+# and still render a response before the worker is killed
+REQUEST_TIME_BUDGET = env.float("REQUEST_TIME_BUDGET", default=4.0)  # type: ignore
+
 
 for db in DATABASES.values():
+    db.setdefault("CONN_MAX_AGE", DB_CONN_MAX_AGE)
+    db.setdefault("CONN_HEALTH_CHECKS", True)
     if "sqlite3" in db["ENGINE"]:
         options = SQLITE_OPTIONS.copy()
         options.update(db.get("OPTIONS", {}))
         db["OPTIONS"] = options
+
+# A second connection to the SQLite database that can only read. Its transactions are
+# deferred so they don't queue behind writers for the write lock like the default
+# connection's (`IMMEDIATE`) do, see `utils.db.ReadOnlyRouter` for what uses it
+if "sqlite3" in DATABASES["default"]["ENGINE"]:
+    DATABASES["read_only"] = {
+        **DATABASES["default"],
+        "OPTIONS": {
+            **DATABASES["default"]["OPTIONS"],
+            "init_command": DATABASES["default"]["OPTIONS"].get("init_command", "")
+            + "PRAGMA query_only = ON;",
+            "transaction_mode": "DEFERRED",
+        },
+        "ATOMIC_REQUESTS": False,
+        "TEST": {"MIRROR": "default"},
+    }
+
+DATABASE_ROUTERS = ["utils.db.ReadOnlyRouter"]
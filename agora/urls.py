@@ -1,15 +1,17 @@
 from debug_toolbar.toolbar import debug_toolbar_urls
 from django.conf import settings
 from django.contrib import admin
-from django.urls import include, path
+from django.urls import include, path, re_path
 from django.views.generic import TemplateView
 from wagtail import urls as wagtail_urls
+from wagtail import views as wagtail_views
 from wagtail.admin import urls as wagtailadmin_urls
 from wagtail.documents import urls as wagtaildocs_urls
 
 from agora.core import views as core_views
 from home import views as home_views
 from search import views as search_views
+from utils.db import read_only_view
 
 from .api_v1 import api as api_v1
 
@@ -51,11 +53,17 @@ if settings.DEBUG:
 if not settings.TESTING:
     urlpatterns += debug_toolbar_urls()
 
+# Wagtail's URLs with pages served from the read-only database connection
+wagtail_urlpatterns = [
+    *(pattern for pattern in wagtail_urls.urlpatterns if pattern.name != "wagtail_serve"),
+    re_path(wagtail_urls.serve_pattern, read_only_view(wagtail_views.serve), name="wagtail_serve"),
+]
+
 urlpatterns = urlpatterns + [
     # For anything not caught by a more specific rule above, hand over to
     # Wagtail's page serving mechanism. This should be the last pattern in
     # the list:
-    path("", include(wagtail_urls)),
+    path("", include(wagtail_urlpatterns)),
     # Alternatively, if you want Wagtail pages to be served from a subpath
     # of your site, rather than the site root:
     #    path("pages/", include(wagtail_urls)),
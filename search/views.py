@@ -3,6 +3,8 @@ from django.http import HttpRequest
 from django.template.response import TemplateResponse
 from wagtail.models import Page
 
+from utils.db import read_only_view
+
 # To enable logging of search queries for use with the "Promoted search results" module
 # <https://docs.wagtail.org/en/stable/reference/contrib/searchpromotions.html>
 # uncomment the following line and the lines indicated in the search function
@@ -11,6 +13,7 @@ from wagtail.models import Page
 # from wagtail.contrib.search_promotions.models import Query
 
 
+@read_only_view
 def search(request: HttpRequest) -> TemplateResponse:
     search_query = request.GET.get("query", None)
     page = request.GET.get("page", 1)
@@ -114,3 +114,26 @@ class CustomerAdmin(admin.ModelAdmin):
         SubscriptionInline,
         PaymentMethodInline,
     ]
+
+
+@admin.register(user_models.StripeEvent)
+class StripeEventAdmin(admin.ModelAdmin):
+    list_display = [
+        "stripe_event_id",
+        "type",
+        "stripe_customer_id",
+        "stripe_created",
+        "status",
+        "attempts",
+    ]
+    list_filter = ["status", "type"]
+    search_fields = ["stripe_event_id", "stripe_customer_id"]
+    readonly_fields = [
+        "stripe_event_id",
+        "type",
+        "payload",
+        "stripe_customer_id",
+        "stripe_created",
+        "processed_at",
+        "last_error",
+    ]
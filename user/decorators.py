@@ -2,14 +2,23 @@ from collections.abc import Callable
 from functools import wraps
 from typing import TypeVar
 
-from django.core.cache import cache
-from django.db import transaction
+import stripe
+from django.db import IntegrityError, transaction
+from django.dispatch import Signal
 from django.http import HttpRequest, HttpResponse
+from django.shortcuts import render
 
-from . import logger
+from . import logger, models
+from .stripe_client import circuit_breaker
 
 F = TypeVar("F", bound=Callable[[HttpRequest], HttpResponse])
 
+# Sent (with `prefix` and `object_id`) once a webhook handler's work has been committed
+webhook_processed = Signal()
+
+# Seconds the browser is asked to wait before retrying when Stripe is unavailable
+STRIPE_UNAVAILABLE_RETRY_AFTER = 30
+
 
 def onboarding_not_required(view_func: F) -> F:
     """
@@ -19,42 +28,75 @@ def onboarding_not_required(view_func: F) -> F:
     return view_func
 
 
-def idempotent_webhook(prefix: str, id_field: str, timeout: int = 300):
-    """Decorator to make webhook handlers idempotent using cache-based locking.
+def stripe_unavailable_retry_page[ViewT: Callable[..., HttpResponse]](view_func: ViewT) -> ViewT:
+    """
+    Decorator for views that call Stripe, rendering a retry page instead of an error when
+    Stripe is slow (the call ran out of time), unreachable or rate limiting us.
 
-    Calls the function in a transaction for all-or-nothing processing.
+    While the Stripe circuit breaker is open the view isn't run at all.
     """
 
+    def unavailable(request: HttpRequest, *, retry_after: float) -> HttpResponse:
+        response = render(request, "user/onboarding/unavailable.html", status=503)
+        response["Retry-After"] = str(max(1, round(retry_after)))
+        return response
+
+    @wraps(view_func)
+    def wrapper(request: HttpRequest, *args, **kwargs) -> HttpResponse:
+        open_for = circuit_breaker.open_for()
+        if open_for:
+            return unavailable(request, retry_after=open_for)
+
+        try:
+            return view_func(request, *args, **kwargs)
+        except (stripe.APIConnectionError, stripe.RateLimitError) as e:
+            logger.warning(f"Stripe unavailable for {request.path}: {e}")
+            return unavailable(request, retry_after=STRIPE_UNAVAILABLE_RETRY_AFTER)
+
+    return wrapper  # type: ignore[return-value]
+
+
+def idempotent_webhook(prefix: str, id_field: str):
+    """Decorator to make webhook handlers idempotent using a database ledger.
+
+    Calls the function in a transaction for all-or-nothing processing. The ledger row is
+    written in the same transaction so it only exists if the handler succeeded, and the
+    unique constraint stops concurrent workers (or hosts) from processing the same object.
+    """
+    stripped_prefix = prefix.strip(":")
+
     def decorator(func):
         @wraps(func)
         def wrapper(*args, **kwargs):
             obj_id = kwargs.get(id_field)
             if obj_id is None:
                 raise ValueError(f"{id_field} is required")
-            # Create unique lock and processed keys for this session
-            stripped_prefix = prefix.strip(":")
-            lock_key = f"{stripped_prefix}:{obj_id}"
-            processed_key = f"{stripped_prefix}:processed:{obj_id}"
-
-            # Check if already processed
-            if cache.get(processed_key):
-                logger.info(f"Session {obj_id} already processed, skipping")
-                return
 
-            # Try to acquire lock
-            if not cache.add(lock_key, "lock", timeout):
-                logger.warning(f"Session {obj_id} is being processed, skipping")
+            # Check if already processed (without taking the write lock)
+            processed_webhooks = models.ProcessedWebhook.objects.filter(
+                prefix=stripped_prefix, object_id=obj_id
+            )
+            if processed_webhooks.exists():
+                logger.info(f"{stripped_prefix} {obj_id} already processed, skipping")
                 return
 
-            try:
-                with transaction.atomic():
-                    result = func(*args, **kwargs)
-                    # Mark as processed if successful
-                    cache.set(processed_key, True, timeout=60 * 60 * 24 * 7)  # 1 week
-                    return result
-            finally:
-                # Always release lock
-                cache.delete(lock_key)
+            with transaction.atomic():
+                try:
+                    with transaction.atomic():
+                        models.ProcessedWebhook.objects.create(
+                            prefix=stripped_prefix, object_id=obj_id
+                        )
+                except IntegrityError:
+                    logger.warning(f"{stripped_prefix} {obj_id} was processed concurrently")
+                    return
+
+                result = func(*args, **kwargs)
+                transaction.on_commit(
+                    lambda: webhook_processed.send(
+                        sender=func, prefix=stripped_prefix, object_id=obj_id
+                    )
+                )
+                return result
 
         return wrapper
 
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand, CommandParser
+
+from user import services
+
+
+class Command(BaseCommand):
+    help = "Index all Stripe customers by email so checkout doesn't need the Search API."
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument(
+            "--batch-size", type=int, default=500, help="Rows written per statement."
+        )
+
+    def handle(self, *args, **options) -> None:
+        indexed_count = services.backfill_stripe_customer_index(batch_size=options["batch_size"])
+        self.stdout.write(f"Indexed {indexed_count} Stripe customers")
@@ -0,0 +1,29 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand, CommandParser
+
+from user import services
+
+
+class Command(BaseCommand):
+    help = (
+        "Cancel identity verification sessions that were never completed and delete their rows. "
+        "Safe to run periodically (e.g. cron)."
+    )
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument(
+            "--workers", type=int, default=4, help="Number of sessions cancelled in parallel."
+        )
+        parser.add_argument(
+            "--batch-size", type=int, default=100, help="Rows deleted per statement."
+        )
+
+    def handle(self, *args, **options) -> None:
+        with ThreadPoolExecutor(
+            max_workers=options["workers"], thread_name_prefix="identity-cleanup"
+        ) as executor:
+            deleted_count = services.cancel_stale_identity_verifications(
+                executor=executor, batch_size=options["batch_size"]
+            )
+        self.stdout.write(f"Deleted {deleted_count} stale identity verifications")
@@ -0,0 +1,514 @@
+import json
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter
+from collections.abc import Callable, Iterator
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+from dataclasses import dataclass
+from datetime import timedelta
+from typing import Any
+from urllib.parse import urlsplit, urlunsplit
+
+import django
+import mintotp
+from allauth.mfa.totp.internal.auth import SECRET_SESSION_KEY
+from django.core import mail
+from django.core.management.base import BaseCommand, CommandError, CommandParser
+from django.db import DEFAULT_DB_ALIAS, OperationalError, connections
+from django.http import HttpResponse
+from django.test import Client, override_settings
+from django.test.utils import setup_databases, teardown_databases
+from django.urls import reverse
+
+from user import models, selectors, services, stripe_client
+from utils.benchmark import summarize_latencies
+from utils.fake_stripe import FakeStripe, sign_webhook_payload
+
+STEPS = (
+    "signup",
+    "confirm_email",
+    "activate_totp",
+    "checkout",
+    "checkout_webhook",
+    "subscription_fulfilled",
+    "identity",
+    "identity_webhook",
+    "identity_fulfilled",
+)
+PASSWORD = "I'm4S3cur3P@ssw0rd!"
+WEBHOOK_SECRET = "whsec_load_test"
+
+
+class LoadTestError(Exception):
+    pass
+
+
+@dataclass(slots=True)
+class StepResult:
+    """What one virtual user's step cost."""
+
+    user: int
+    step: str
+    latency: float = 0.0
+    queries: int = 0
+    lock_waits: int = 0
+    lock_wait_time: float = 0.0
+    busy_errors: int = 0
+    error: str = ""
+
+
+class QueryRecorder:
+    """Database wrapper counting a step's statements and how long SQLite made it wait.
+
+    Transactions start with `BEGIN IMMEDIATE`, which is where a writer waits (up to the busy
+    timeout) for SQLite's write lock, so the time spent in `BEGIN` is counted as lock wait.
+    """
+
+    def __init__(self, *, lock_threshold: float):
+        self.lock_threshold = lock_threshold
+        self.result: StepResult | None = None
+
+    def __call__(self, execute, sql, params, many, context):
+        result = self.result
+        if result is None:
+            return execute(sql, params, many, context)
+
+        start = time.monotonic()
+        try:
+            return execute(sql, params, many, context)
+        except OperationalError as e:
+            if "database is locked" in str(e):
+                result.busy_errors += 1
+            raise
+        finally:
+            result.queries += 1
+            if sql.startswith("BEGIN"):
+                waited = time.monotonic() - start
+                result.lock_wait_time += waited
+                if waited >= self.lock_threshold:
+                    result.lock_waits += 1
+
+    @contextmanager
+    def paused(self) -> Iterator[None]:
+        """Leave the load test's own bookkeeping queries out of the step."""
+        result, self.result = self.result, None
+        try:
+            yield
+        finally:
+            self.result = result
+
+
+class VirtualUser:
+    """A user going through onboarding the way a browser would."""
+
+    def __init__(self, *, index: int, run_id: str, options: dict[str, Any]):
+        self.index = index
+        self.email = f"loadtest-{run_id}-{index}@example.com"
+        self.run_id = run_id
+        self.options = options
+        # A different address for every user so they aren't rate limited together
+        self.client = Client(REMOTE_ADDR=f"10.{index >> 16 & 255}.{index >> 8 & 255}.{index & 255}")
+        self.recorder = QueryRecorder(lock_threshold=options["lock_threshold"] / 1000)
+        self.results: list[StepResult] = []
+
+    @contextmanager
+    def step(self, name: str) -> Iterator[None]:
+        result = StepResult(user=self.index, step=name)
+        self.results.append(result)
+        self.recorder.result = result
+        start = time.monotonic()
+        try:
+            yield
+        except Exception as e:
+            result.error = f"{type(e).__name__}: {e}"[:200]
+            raise
+        finally:
+            result.latency = time.monotonic() - start
+            self.recorder.result = None
+
+    def run(self) -> None:
+        with ExitStack() as stack:
+            # Including the read-only connection
+            for db_connection in connections.all():
+                stack.enter_context(db_connection.execute_wrapper(self.recorder))
+            self.sign_up()
+            self.activate_totp()
+            self.subscribe()
+            self.verify_identity()
+
+    def sign_up(self) -> None:
+        signup_url = reverse("account_signup")
+        with self.step("signup"):
+            self.expect(self.client.get(signup_url), 200)
+            response = self.client.post(
+                signup_url, {"email": self.email, "password1": PASSWORD, "password2": PASSWORD}
+            )
+            self.expect(response, 302)
+
+        with self.step("confirm_email"):
+            response = self.client.post(
+                reverse("account_email_verification_sent"),
+                {"code": self.verification_code()},
+            )
+            self.expect(response, 302)
+
+    def activate_totp(self) -> None:
+        activate_url = reverse("mfa_activate_totp")
+        with self.step("activate_totp"):
+            response = self.client.get(activate_url)
+            if response.status_code == 302 and response["Location"].startswith(
+                reverse("account_reauthenticate")
+            ):
+                self.expect(self.client.post(response["Location"], {"password": PASSWORD}), 302)
+                response = self.client.get(activate_url)
+            self.expect(response, 200)
+
+            with self.recorder.paused():
+                secret = self.client.session[SECRET_SESSION_KEY]
+            self.expect(self.client.post(activate_url, {"code": mintotp.totp(secret)}), 302)
+
+    def subscribe(self) -> None:
+        with self.step("checkout"):
+            response = self.client.post(
+                reverse(selectors.OnboardingStep.BILLING.value), {"price": self.options["price"]}
+            )
+            self.expect(response, 302)
+        # Redirected to the session's URL, which ends with its ID
+        checkout_session_id = response["Location"].rsplit("/", 1)[-1]
+
+        with self.recorder.paused():
+            customer = models.Customer.objects.get(user__email=self.email)
+        with self.step("checkout_webhook"):
+            self.deliver(
+                "checkout.session.completed",
+                {
+                    "id": checkout_session_id,
+                    "object": "checkout.session",
+                    "status": "complete",
+                    "payment_status": "paid",
+                    "client_reference_id": str(customer.user_id),
+                    "customer": customer.stripe_customer_id,
+                    "subscription": None,
+                },
+            )
+
+        with self.step("subscription_fulfilled"), self.recorder.paused():
+            self.wait_for(lambda: models.Subscription.objects.filter(customer=customer).exists())
+
+    def verify_identity(self) -> None:
+        with self.step("identity"):
+            response = self.client.get(reverse(selectors.OnboardingStep.IDENTITY.value))
+            self.expect(response, 302)
+        verification_session_id = response["Location"].rsplit("/", 1)[-1]
+
+        with self.recorder.paused():
+            user_id = models.AgoraUser.objects.values_list("id", flat=True).get(email=self.email)
+        with self.step("identity_webhook"):
+            self.deliver(
+                "identity.verification_session.verified",
+                {
+                    "id": verification_session_id,
+                    "object": "identity.verification_session",
+                    "status": "verified",
+                    "client_reference_id": str(user_id),
+                    "last_error": None,
+                },
+            )
+
+        with self.step("identity_fulfilled"), self.recorder.paused():
+            self.wait_for(
+                lambda: models.IdentityVerification.objects.filter(
+                    stripe_identity_verification_session_id=verification_session_id,
+                    verified_at__isnull=False,
+                ).exists()
+            )
+
+    def verification_code(self) -> str:
+        for message in reversed(mail.outbox):
+            if self.email not in message.to:
+                continue
+            # The code is on the first non-empty line after the prompt
+            _, _, after_prompt = message.body.partition("verification code is listed below")
+            for line in after_prompt.splitlines()[1:]:
+                if line.strip():
+                    return line.strip()
+        raise LoadTestError(f"No verification code was sent to {self.email}")
+
+    def deliver(self, event_type: str, obj: dict[str, Any]) -> None:
+        now = int(time.time())
+        event = {
+            "id": f"evt_loadtest_{self.run_id}_{uuid.uuid4().hex}",
+            "object": "event",
+            "type": event_type,
+            "created": now,
+            "livemode": False,
+            "data": {"object": obj | {"created": now}},
+        }
+        payload = json.dumps(event).encode()
+        response = self.client.post(
+            "/api/v1/user/webhooks/stripe/",
+            data=payload,
+            content_type="application/json",
+            HTTP_STRIPE_SIGNATURE=sign_webhook_payload(
+                payload, secret=WEBHOOK_SECRET, timestamp=now
+            ),
+        )
+        self.expect(response, 200)
+
+    def wait_for(self, condition: Callable[[], bool]) -> None:
+        deadline = time.monotonic() + self.options["fulfilment_timeout"]
+        while not condition():
+            if time.monotonic() > deadline:
+                raise LoadTestError("Timed out waiting for the event worker")
+            time.sleep(0.05)
+
+    def expect(self, response: HttpResponse, status_code: int) -> None:
+        if response.status_code != status_code:
+            raise LoadTestError(
+                f"{response.request['REQUEST_METHOD']} {response.request['PATH_INFO']} "  # type: ignore
+                f"responded {response.status_code}, expected {status_code}"
+            )
+
+
+def _run_virtual_user(*, index: int, run_id: str, options: dict[str, Any]) -> list[StepResult]:
+    virtual_user = VirtualUser(index=index, run_id=run_id, options=options)
+    try:
+        virtual_user.run()
+    except Exception as e:
+        # Failures within a step are recorded against it
+        if not virtual_user.results or not virtual_user.results[-1].error:
+            virtual_user.results.append(
+                StepResult(user=index, step="harness", error=f"{type(e).__name__}: {e}"[:200])
+            )
+    finally:
+        connections.close_all()
+    return virtual_user.results
+
+
+def _run_virtual_users(
+    indices: list[int], run_id: str, options: dict[str, Any]
+) -> list[StepResult]:
+    with ThreadPoolExecutor(max_workers=options["concurrency"]) as executor:
+        return [
+            result
+            for results in executor.map(
+                lambda index: _run_virtual_user(index=index, run_id=run_id, options=options),
+                indices,
+            )
+            for result in results
+        ]
+
+
+def _run_virtual_users_in_process(
+    indices: list[int], run_id: str, options: dict[str, Any], overrides: dict[str, Any]
+) -> list[StepResult]:
+    # Processes are spawned (and set up by `django.setup`) so apply the overrides again
+    with override_settings(**overrides):
+        return _run_virtual_users(indices, run_id, options)
+
+
+class Command(BaseCommand):
+    help = (
+        "Drive virtual users through onboarding (signup, TOTP, checkout, webhooks and identity "
+        "verification) against a fake Stripe and report throughput, latency, queries and "
+        "SQLite lock waits per step. Users are created in a temporary test database, which is "
+        "deleted afterwards."
+    )
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument("--users", type=int, default=50, help="Virtual users to onboard.")
+        parser.add_argument(
+            "--processes",
+            type=int,
+            default=1,
+            help="Processes to share the users between, like the server's workers.",
+        )
+        parser.add_argument(
+            "--concurrency", type=int, default=8, help="Users onboarding at once per process."
+        )
+        parser.add_argument("--workers", type=int, default=4, help="Event worker threads.")
+        parser.add_argument(
+            "--price", default="price_fake", help="Stripe price the users subscribe to."
+        )
+        parser.add_argument(
+            "--stripe-latency",
+            type=float,
+            default=0.0,
+            help="Seconds the fake Stripe takes to answer every request.",
+        )
+        parser.add_argument(
+            "--lock-threshold",
+            type=float,
+            default=10.0,
+            help="Milliseconds waited for the write lock before it counts as a lock wait.",
+        )
+        parser.add_argument(
+            "--fulfilment-timeout",
+            type=float,
+            default=30.0,
+            help="Seconds to wait for the event worker to apply a webhook.",
+        )
+
+    def handle(self, *args, **options) -> None:
+        run_id = uuid.uuid4().hex[:8]
+        worker_errors: Counter[str] = Counter()
+
+        with (
+            self.temporary_database(),
+            FakeStripe(latency=options["stripe_latency"]) as fake_stripe,
+        ):
+            overrides = {
+                "STRIPE_API_BASE": fake_stripe.base_url,
+                "STRIPE_WEBHOOK_SECRET": WEBHOOK_SECRET,
+                "ROOT_URLCONF": "user.management.onboarding_urls",
+                "EMAIL_BACKEND": "django.core.mail.backends.locmem.EmailBackend",
+                "ALLOWED_HOSTS": ["testserver"],
+            }
+            with override_settings(**overrides):
+                # The Stripe client is created once per process, make sure it uses the fake
+                stripe_client._stripe_client_for_process.cache_clear()
+                stripe_client.circuit_breaker.reset()
+
+                stop = threading.Event()
+                worker = threading.Thread(
+                    target=self.process_events, args=(stop, worker_errors, options)
+                )
+                worker.start()
+                start = time.monotonic()
+                try:
+                    results = self.run_virtual_users(run_id, overrides, options)
+                finally:
+                    elapsed = time.monotonic() - start
+                    stop.set()
+                    worker.join()
+                    stripe_client._stripe_client_for_process.cache_clear()
+
+        self.report(results, elapsed, worker_errors, options)
+
+    @contextmanager
+    def temporary_database(self) -> Iterator[None]:
+        """Migrate a throwaway SQLite file the way the test runner does and run against it."""
+        default_connection = connections[DEFAULT_DB_ALIAS]
+        if default_connection.vendor != "sqlite":
+            raise CommandError(
+                "The load test measures SQLite's locking, it needs a SQLite database"
+            )
+
+        with tempfile.TemporaryDirectory() as directory:
+            database_path = os.path.join(directory, "onboarding_load_test.sqlite3")
+            # A file rather than the in-memory default, so that threads and processes share it
+            default_connection.settings_dict["TEST"]["NAME"] = database_path
+            mirror_settings = {
+                alias: dict(connections[alias].settings_dict)
+                for alias in connections
+                if alias != DEFAULT_DB_ALIAS
+            }
+            old_config = setup_databases(
+                verbosity=0, interactive=False, aliases={DEFAULT_DB_ALIAS}, serialized_aliases=set()
+            )
+            # Test mirrors take the default connection's settings, keep the read-only ones
+            for alias, settings_dict in mirror_settings.items():
+                connections[alias].close()
+                connections[alias].settings_dict = settings_dict | {"NAME": database_path}
+            # Spawned processes read their settings from the environment, keep its options
+            previous_url = os.environ.get("DB_DEFAULT_URL")
+            query = urlsplit(previous_url).query if previous_url else ""
+            os.environ["DB_DEFAULT_URL"] = urlunsplit(
+                ("sqlite", "", f"/{database_path}", query, "")
+            )
+            try:
+                yield
+            finally:
+                if previous_url is None:
+                    del os.environ["DB_DEFAULT_URL"]
+                else:
+                    os.environ["DB_DEFAULT_URL"] = previous_url
+                connections.close_all()
+                teardown_databases(old_config, verbosity=0)
+
+    def run_virtual_users(
+        self, run_id: str, overrides: dict[str, Any], options: dict[str, Any]
+    ) -> list[StepResult]:
+        indices = list(range(options["users"]))
+        if options["processes"] == 1:
+            return _run_virtual_users(indices, run_id, options)
+
+        with ProcessPoolExecutor(
+            max_workers=options["processes"],
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=django.setup,
+        ) as executor:
+            futures = [
+                executor.submit(
+                    _run_virtual_users_in_process,
+                    indices[offset :: options["processes"]],
+                    run_id,
+                    options,
+                    overrides,
+                )
+                for offset in range(options["processes"])
+            ]
+            return [result for future in futures for result in future.result()]
+
+    def process_events(
+        self, stop: threading.Event, worker_errors: Counter[str], options: dict[str, Any]
+    ) -> None:
+        with ThreadPoolExecutor(max_workers=options["workers"]) as executor:
+            while not stop.is_set():
+                try:
+                    stripe_events = services.process_pending_stripe_events(
+                        executor=executor,
+                        batch_size=50,
+                        max_attempts=3,
+                        backoff=timedelta(seconds=1),
+                        lease=timedelta(minutes=5),
+                    )
+                except OperationalError as e:
+                    worker_errors[str(e)] += 1
+                    stripe_events = []
+                if not stripe_events:
+                    stop.wait(0.05)
+        connections.close_all()
+
+    def report(
+        self,
+        results: list[StepResult],
+        elapsed: float,
+        worker_errors: Counter[str],
+        options: dict[str, Any],
+    ) -> None:
+        failed_users = {result.user for result in results if result.error}
+        onboarded = len(
+            {result.user for result in results if result.step == STEPS[-1]} - failed_users
+        )
+        self.stdout.write(
+            f"Onboarded {onboarded}/{options['users']} users in {elapsed:.2f}s "
+            f"({onboarded / elapsed:.2f} users/s) with {options['processes']} process(es) x "
+            f"{options['concurrency']} concurrent users"
+        )
+
+        for step in STEPS:
+            step_results = [result for result in results if result.step == step]
+            if not step_results:
+                continue
+            succeeded = [result for result in step_results if not result.error]
+            queries = sum(result.queries for result in succeeded) / max(len(succeeded), 1)
+            self.stdout.write(f"{step}: {summarize_latencies([r.latency for r in succeeded])}")
+            self.stdout.write(
+                f"    queries={queries:.1f}/user "
+                f"lock waits={sum(result.lock_waits for result in step_results)} "
+                f"({sum(result.lock_wait_time for result in step_results):.2f}s) "
+                f"busy errors={sum(result.busy_errors for result in step_results)} "
+                f"errors={len(step_results) - len(succeeded)}"
+            )
+
+        errors = Counter((result.step, result.error) for result in results if result.error)
+        for (step, error), count in errors.most_common(5):
+            self.stdout.write(f"{count} x {step}: {error}")
+        for error, count in worker_errors.most_common(5):
+            self.stdout.write(f"{count} x event worker: {error}")
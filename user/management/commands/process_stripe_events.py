@@ -0,0 +1,73 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandParser
+
+from user import services
+
+
+class Command(BaseCommand):
+    help = "Process Stripe webhook events stored in the inbox by the webhook endpoint."
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument(
+            "--workers", type=int, default=4, help="Number of events processed in parallel."
+        )
+        parser.add_argument(
+            "--batch-size", type=int, default=50, help="Maximum events claimed at a time."
+        )
+        parser.add_argument(
+            "--max-attempts",
+            type=int,
+            default=8,
+            help="Attempts before an event is marked as failed.",
+        )
+        parser.add_argument(
+            "--backoff",
+            type=float,
+            default=5.0,
+            help="Seconds to wait before the first retry, doubling with every attempt.",
+        )
+        parser.add_argument(
+            "--lease",
+            type=float,
+            default=300.0,
+            help="Seconds after which an event claimed by a dead worker is retried.",
+        )
+        parser.add_argument(
+            "--poll-interval",
+            type=float,
+            default=1.0,
+            help="Seconds to sleep when there are no due events.",
+        )
+        parser.add_argument(
+            "--once", action="store_true", help="Exit once there are no more due events."
+        )
+
+    def handle(self, *args, **options) -> None:
+        backoff = timedelta(seconds=options["backoff"])
+        lease = timedelta(seconds=options["lease"])
+
+        with ThreadPoolExecutor(
+            max_workers=options["workers"], thread_name_prefix="stripe-events"
+        ) as executor:
+            while True:
+                stripe_events = services.process_pending_stripe_events(
+                    executor=executor,
+                    batch_size=options["batch_size"],
+                    max_attempts=options["max_attempts"],
+                    backoff=backoff,
+                    lease=lease,
+                )
+                for stripe_event in stripe_events:
+                    self.stdout.write(
+                        f"{stripe_event.stripe_event_id} ({stripe_event.type}): "
+                        f"{stripe_event.status}"
+                    )
+
+                if stripe_events:
+                    continue
+                if options["once"]:
+                    break
+                time.sleep(options["poll_interval"])
@@ -0,0 +1,23 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandParser
+
+from user import services
+
+
+class Command(BaseCommand):
+    help = "Delete old entries from the webhook idempotency ledger."
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument(
+            "--older-than-days",
+            type=int,
+            default=30,
+            help="Keep entries newer than this. Stripe retries events for up to 3 days.",
+        )
+
+    def handle(self, *args, **options) -> None:
+        deleted_count = services.prune_processed_webhooks(
+            older_than=timedelta(days=options["older_than_days"])
+        )
+        self.stdout.write(f"Deleted {deleted_count} processed webhook entries")
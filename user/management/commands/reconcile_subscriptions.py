@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand, CommandParser
+
+from user import services
+
+
+class Command(BaseCommand):
+    help = "Bring local subscriptions in line with Stripe. Safe to run periodically (e.g. cron)."
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument(
+            "--batch-size", type=int, default=500, help="Subscriptions compared per batch."
+        )
+
+    def handle(self, *args, **options) -> None:
+        reconciliation = services.reconcile_subscriptions(batch_size=options["batch_size"])
+        self.stdout.write(
+            f"Created {reconciliation.created}, updated {reconciliation.updated}, "
+            f"unchanged {reconciliation.unchanged}, skipped {reconciliation.skipped} subscriptions"
+        )
@@ -0,0 +1,308 @@
+import json
+import random
+import threading
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from pathlib import Path
+from typing import Any
+
+import requests
+import stripe
+from django.core.management.base import BaseCommand, CommandError, CommandParser
+from django.db.models import Count
+
+from user import models, services, stripe_client
+from user.decorators import webhook_processed
+from utils.benchmark import summarize_latencies
+from utils.fake_stripe import FakeStripe, sign_webhook_payload
+
+# Replacements for anything that could identify a person, applied at any depth of the event
+_SANITIZED_FIELDS: dict[str, Any] = {
+    "email": "redacted@example.com",
+    "name": "Redacted",
+    "first_name": "Redacted",
+    "last_name": "Redacted",
+    "phone": None,
+    "dob": None,
+    "address": None,
+    "customer_details": None,
+    "billing_details": None,
+    "shipping": None,
+    "shipping_details": None,
+    # Kept as an object (with nothing verified) so it's handled like the real thing
+    "verified_outputs": {
+        "first_name": "Redacted",
+        "last_name": "Redacted",
+        "dob": None,
+        "address": None,
+        "phone": None,
+        "id_number": None,
+    },
+    "client_secret": None,
+    "url": None,
+    "metadata": {},
+}
+
+
+def sanitize(value: Any) -> Any:
+    if isinstance(value, dict):
+        return {
+            key: _SANITIZED_FIELDS[key] if key in _SANITIZED_FIELDS else sanitize(item)
+            for key, item in value.items()
+        }
+    if isinstance(value, list):
+        return [sanitize(item) for item in value]
+    return value
+
+
+def with_fresh_ids(events: list[dict[str, Any]]) -> list[dict[str, Any]]:
+    """Give the events, and the objects they carry, new IDs.
+
+    An object keeps its (new) ID across events, including wherever another object refers to it.
+    """
+    fresh_ids: dict[str, str] = {}
+    for event in events:
+        object_id = event["data"]["object"].get("id")
+        if object_id and object_id not in fresh_ids:
+            prefix = object_id.rsplit("_", 1)[0]
+            fresh_ids[object_id] = f"{prefix}_{uuid.uuid4().hex}"
+
+    def replace_ids(value: Any) -> Any:
+        if isinstance(value, dict):
+            return {key: replace_ids(item) for key, item in value.items()}
+        if isinstance(value, list):
+            return [replace_ids(item) for item in value]
+        if isinstance(value, str):
+            return fresh_ids.get(value, value)
+        return value
+
+    return [replace_ids(event) | {"id": f"evt_{uuid.uuid4().hex}"} for event in events]
+
+
+class Command(BaseCommand):
+    help = (
+        "Record sanitized Stripe events and replay them against the webhook endpoint to measure "
+        "how it (and the event worker) copes with a burst. Run the server being measured with "
+        "STRIPE_WEBHOOK_SECRET set to the replay --secret."
+    )
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        subparsers = parser.add_subparsers(dest="action", required=True)
+
+        record = subparsers.add_parser("record", help="Write sanitized events to a JSONL file.")
+        record.add_argument("file", type=Path)
+        record.add_argument(
+            "--from-stripe",
+            action="store_true",
+            help="Record events from the Stripe API rather than the local event inbox.",
+        )
+        record.add_argument("--limit", type=int, default=1000)
+        record.add_argument("--type", action="append", default=[], help="Only these event types.")
+
+        replay = subparsers.add_parser("replay", help="Replay events from a JSONL file.")
+        replay.add_argument("file", type=Path)
+        replay.add_argument(
+            "--url",
+            default="http://localhost:8000/api/v1/user/webhooks/stripe/",
+            help="Webhook endpoint to deliver to.",
+        )
+        replay.add_argument("--secret", default="whsec_benchmark", help="Webhook signing secret.")
+        replay.add_argument(
+            "--rate", type=float, default=0.0, help="Deliveries per second (0 for no limit)."
+        )
+        replay.add_argument("--concurrency", type=int, default=8, help="Deliveries in flight.")
+        replay.add_argument(
+            "--redeliver",
+            type=int,
+            default=1,
+            help="Deliver every event this many times, like Stripe retrying a delivery.",
+        )
+        replay.add_argument(
+            "--fresh-ids",
+            action="store_true",
+            help="Give the events new IDs so a file can be replayed against the same database.",
+        )
+        replay.add_argument(
+            "--shuffle", action="store_true", help="Deliver the events in a random order."
+        )
+        replay.add_argument(
+            "--process",
+            action="store_true",
+            help="Then drain the event inbox here with a fake Stripe answering follow-up calls.",
+        )
+        replay.add_argument("--workers", type=int, default=4, help="Event worker threads.")
+
+    def handle(self, *args, **options) -> None:
+        if options["action"] == "record":
+            self.record(options)
+        else:
+            self.replay(options)
+
+    def record(self, options: dict[str, Any]) -> None:
+        if options["from_stripe"]:
+            params: stripe.EventService.ListParams = {"limit": 100}
+            if options["type"]:
+                params["types"] = options["type"]
+            events = (
+                event.to_dict()
+                for event in stripe_client.get_stripe_client()
+                .events.list(params=params)
+                .auto_paging_iter()
+            )
+        else:
+            stripe_events = models.StripeEvent.objects.order_by("stripe_created", "id")
+            if options["type"]:
+                stripe_events = stripe_events.filter(type__in=options["type"])
+            events = (payload for payload in stripe_events.values_list("payload", flat=True))
+
+        count = 0
+        with options["file"].open("w") as file:
+            for event in events:
+                if count >= options["limit"]:
+                    break
+                file.write(json.dumps(sanitize(event) | {"livemode": False}) + "\n")
+                count += 1
+
+        self.stdout.write(f"Recorded {count} events to {options['file']}")
+
+    def replay(self, options: dict[str, Any]) -> None:
+        with options["file"].open() as file:
+            events = [json.loads(line) for line in file if line.strip()]
+        if not events:
+            raise CommandError(f"No events in {options['file']}")
+
+        if options["fresh_ids"]:
+            events = with_fresh_ids(events)
+        deliveries = [event for event in events for _ in range(options["redeliver"])]
+        if options["shuffle"]:
+            random.shuffle(deliveries)
+
+        self.deliver(deliveries, options)
+        if options["process"]:
+            self.process(events, options)
+
+    def deliver(self, deliveries: list[dict[str, Any]], options: dict[str, Any]) -> None:
+        thread_local = threading.local()
+        latencies: list[float] = []
+        status_codes: Counter[str] = Counter()
+        lock = threading.Lock()
+
+        def deliver(event: dict[str, Any]) -> None:
+            session = getattr(thread_local, "session", None)
+            if session is None:
+                session = thread_local.session = requests.Session()
+
+            payload = json.dumps(event).encode()
+            headers = {
+                "Content-Type": "application/json",
+                "Stripe-Signature": sign_webhook_payload(
+                    payload, secret=options["secret"], timestamp=int(time.time())
+                ),
+            }
+            start = time.monotonic()
+            try:
+                response = session.post(options["url"], data=payload, headers=headers, timeout=30)
+                outcome = str(response.status_code)
+            except requests.RequestException as e:
+                outcome = type(e).__name__
+            latency = time.monotonic() - start
+
+            with lock:
+                latencies.append(latency)
+                status_codes[outcome] += 1
+
+        interval = 1 / options["rate"] if options["rate"] else 0.0
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=options["concurrency"]) as executor:
+            for index, event in enumerate(deliveries):
+                if interval:
+                    # Open loop so a slow endpoint doesn't slow the arrival rate down
+                    time.sleep(max(0.0, start + index * interval - time.monotonic()))
+                executor.submit(deliver, event)
+        elapsed = time.monotonic() - start
+
+        errors = sum(count for outcome, count in status_codes.items() if outcome != "200")
+        self.stdout.write(
+            f"Delivered {len(deliveries)} events in {elapsed:.2f}s "
+            f"({len(deliveries) / elapsed:.1f}/s)"
+        )
+        self.stdout.write(f"Latency: {summarize_latencies(latencies)}")
+        self.stdout.write(
+            f"Errors: {errors} ({errors / len(deliveries):.1%}) "
+            f"responses={dict(sorted(status_codes.items()))}"
+        )
+
+    def process(self, events: list[dict[str, Any]], options: dict[str, Any]) -> None:
+        fulfilled: set[tuple[str, str]] = set()
+        lock = threading.Lock()
+
+        def count_fulfilment(sender, prefix: str, object_id: str, **kwargs) -> None:
+            with lock:
+                fulfilled.add((prefix, object_id))
+
+        with FakeStripe() as fake_stripe, stripe_client.stripe_api_base(fake_stripe.base_url):
+            for event in events:
+                fake_stripe.seed(event["data"]["object"])
+            webhook_processed.connect(count_fulfilment)
+
+            processed: Counter[str] = Counter()
+            start = time.monotonic()
+            try:
+                with ThreadPoolExecutor(max_workers=options["workers"]) as executor:
+                    while stripe_events := services.process_pending_stripe_events(
+                        executor=executor,
+                        batch_size=50,
+                        max_attempts=3,
+                        backoff=timedelta(0),
+                        lease=timedelta(minutes=5),
+                    ):
+                        processed.update(str(stripe_event.status) for stripe_event in stripe_events)
+            finally:
+                webhook_processed.disconnect(count_fulfilment)
+            elapsed = time.monotonic() - start
+
+        total = sum(processed.values())
+        self.stdout.write(
+            f"Processed {total} events in {elapsed:.2f}s "
+            f"({total / elapsed if elapsed else 0:.1f}/s) outcomes={dict(processed)}"
+        )
+        self.stdout.write(
+            f"Fulfilments: {len(fulfilled)} objects, "
+            f"{self.duplicate_fulfilments(events)} duplicate rows"
+        )
+
+    def duplicate_fulfilments(self, events: list[dict[str, Any]]) -> int:
+        """Rows written more than once for the same Stripe object by the event handlers.
+
+        The ledger only records that an object was fulfilled once, so look at what the
+        fulfilment wrote instead.
+        """
+        stripe_subscription_ids: set[str] = set()
+        verification_session_ids: set[str] = set()
+        for event in events:
+            obj = event["data"]["object"]
+            if obj.get("object") == "checkout.session" and obj.get("subscription"):
+                stripe_subscription_ids.add(str(obj["subscription"]))
+            elif obj.get("object") == "identity.verification_session":
+                verification_session_ids.add(obj["id"])
+
+        rows_per_object = [
+            models.Subscription.objects.filter(
+                stripe_subscription_id__in=stripe_subscription_ids
+            ).values("stripe_subscription_id"),
+            models.IdentityVerification.objects.filter(
+                stripe_identity_verification_session_id__in=verification_session_ids
+            ).values("stripe_identity_verification_session_id"),
+            # A user only has the one phone number verified through Stripe Identity
+            models.UserPhoneNumber.objects.filter(
+                phone_number=services.STRIPE_IDENTITY_PHONE_NUMBER
+            ).values("contact_scope"),
+        ]
+        return sum(
+            row["count"] - 1
+            for rows in rows_per_object
+            for row in rows.annotate(count=Count("id")).filter(count__gt=1)
+        )
@@ -0,0 +1,52 @@
+"""
+Stand-in onboarding views so the onboarding services can be driven over HTTP.
+
+The billing and identity services link to the onboarding steps by URL name, this URLconf
+gives those names minimal views (on top of the project's URLs) that call the services the
+way the onboarding pages do. `manage.py onboarding_load_test` uses it as the `ROOT_URLCONF`.
+"""
+
+from django.http import HttpResponse
+from django.shortcuts import redirect
+from django.urls import path
+from django.views.decorators.http import require_GET, require_POST
+
+from agora import urls as agora_urls
+from user import selectors, services
+from user.decorators import stripe_unavailable_retry_page
+from utils.typing.request import HttpRequest
+
+
+@require_POST
+@stripe_unavailable_retry_page
+def billing(request: HttpRequest) -> HttpResponse:
+    checkout_session_obj = services.create_stripe_checkout_session_for_subscription(
+        request=request, stripe_price_id=request.POST["price"]
+    )
+    return redirect(str(checkout_session_obj.url))
+
+
+@require_GET
+@stripe_unavailable_retry_page
+def identity(request: HttpRequest) -> HttpResponse:
+    verification_session_obj = services.create_stripe_identity_verification_session(request=request)
+    if verification_session_obj.status in services.IDENTITY_VERIFICATION_SUBMITTED_STATUSES:
+        return redirect(selectors.OnboardingStep.IDENTITY_PENDING.value)
+    return redirect(str(verification_session_obj.url))
+
+
+@require_GET
+def identity_pending(request: HttpRequest) -> HttpResponse:
+    return HttpResponse(selectors.user_identity_verification_status(user=request.user))  # type: ignore
+
+
+urlpatterns = [
+    path("onboarding/billing/", billing, name=selectors.OnboardingStep.BILLING.value),
+    path("onboarding/identity/", identity, name=selectors.OnboardingStep.IDENTITY.value),
+    path(
+        "onboarding/identity/pending/",
+        identity_pending,
+        name=selectors.OnboardingStep.IDENTITY_PENDING.value,
+    ),
+    *agora_urls.urlpatterns,
+]
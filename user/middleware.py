@@ -1,10 +1,14 @@
-from allauth.mfa.utils import is_mfa_enabled
 from django.conf import settings
 from django.contrib import messages
 from django.http import HttpRequest, HttpResponse
 from django.shortcuts import redirect
 from django.utils.deprecation import MiddlewareMixin
 
+from . import selectors
+
+# Session flag remembering that the user has MFA enabled, so we don't need to look it up again
+MFA_ENABLED_SESSION_KEY = "user_mfa_enabled"
+
 
 class AllUserRequire2FAMiddleware(MiddlewareMixin):
     """
@@ -17,21 +21,23 @@ class AllUserRequire2FAMiddleware(MiddlewareMixin):
     https://github.com/pennersr/django-allauth/issues/3649#issuecomment-2023044039
     """
 
-    # List of URL names that the user should still be allowed to access.
-    allowed_pages = [
-        # They should still be able to log out or change password.
-        "account_login",
-        "account_logout",
-        "account_reauthenticate",
-        "account_reset_password_done",
-        "account_reset_password_from_key",
-        "account_reset_password_from_key_done",
-        "account_reset_password",
-        "account_email",
-        "account_email_verification_sent",
-        "account_confirm_email",
-        "mfa_activate_totp",
-    ]
+    # URL names that the user should still be allowed to access.
+    allowed_pages = frozenset(
+        {
+            # They should still be able to log out or change password.
+            "account_login",
+            "account_logout",
+            "account_reauthenticate",
+            "account_reset_password_done",
+            "account_reset_password_from_key",
+            "account_reset_password_from_key_done",
+            "account_reset_password",
+            "account_email",
+            "account_email_verification_sent",
+            "account_confirm_email",
+            "mfa_activate_totp",
+        }
+    )
     # The message to the user if they don't have 2FA enabled and must enable it.
     require_2fa_message = "You must enable two-factor authentication before doing anything else."
 
@@ -63,6 +69,20 @@ class AllUserRequire2FAMiddleware(MiddlewareMixin):
     def is_allowed_page(self, request: HttpRequest) -> bool:
         return request.resolver_match.url_name in self.allowed_pages  # type: ignore
 
+    def has_mfa_enabled(self, request: HttpRequest) -> bool:
+        """
+        Check the session flag first so that MFA-enabled users cost no queries. Only a
+        positive result is remembered as users without MFA are expected to enable it.
+        """
+        if request.session.get(MFA_ENABLED_SESSION_KEY, False):
+            return True
+
+        mfa_enabled = selectors.user_has_mfa_enabled(user=request.user)  # type: ignore
+        if mfa_enabled:
+            request.session[MFA_ENABLED_SESSION_KEY] = True
+
+        return mfa_enabled
+
     def process_view(
         self,
         request: HttpRequest,
@@ -79,7 +99,7 @@ class AllUserRequire2FAMiddleware(MiddlewareMixin):
             return None
 
         # User already has two-factor configured, do nothing.
-        if is_mfa_enabled(request.user):
+        if self.has_mfa_enabled(request):
             return None
 
         # The request required 2FA but it isn't configured!
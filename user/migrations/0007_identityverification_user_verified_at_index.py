@@ -0,0 +1,17 @@
+# Generated by Django 5.2.3 on 2026-10-18 10:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user', '0006_agorauser_visibility'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='identityverification',
+            index=models.Index(fields=['user', 'verified_at'], name='user_identver_user_verif_idx'),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 5.2.3 on 2026-10-18 10:19
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user', '0008_stripeevent'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProcessedWebhook',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('prefix', models.CharField(max_length=255)),
+                ('object_id', models.CharField(max_length=255)),
+                ('processed_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('prefix', 'object_id'), name='user_processedwebhook_unique')],
+            },
+        ),
+    ]
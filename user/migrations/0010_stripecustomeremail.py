@@ -0,0 +1,45 @@
+# Generated by Django 5.2.3 on 2026-10-18 10:23
+
+import django.utils.timezone
+import model_utils.fields
+from django.db import migrations, models
+
+
+def index_existing_customers(apps, schema_editor):
+    Customer = apps.get_model('user', 'Customer')
+    StripeCustomerEmail = apps.get_model('user', 'StripeCustomerEmail')
+
+    StripeCustomerEmail.objects.bulk_create(
+        [
+            StripeCustomerEmail(
+                email=customer.user.email.strip().lower(),
+                stripe_customer_id=customer.stripe_customer_id,
+            )
+            for customer in Customer.objects.select_related('user')
+        ],
+        ignore_conflicts=True,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user', '0009_processedwebhook'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StripeCustomerEmail',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', model_utils.fields.AutoCreatedField(default=django.utils.timezone.now, editable=False, verbose_name='created')),
+                ('modified', model_utils.fields.AutoLastModifiedField(default=django.utils.timezone.now, editable=False, verbose_name='modified')),
+                ('email', models.EmailField(max_length=254, unique=True)),
+                ('stripe_customer_id', models.CharField(db_index=True, max_length=255)),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.RunPython(index_existing_customers, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 5.2.3 on 2026-10-18 10:29
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def remove_duplicate_subscriptions(apps, schema_editor):
+    Subscription = apps.get_model('user', 'Subscription')
+
+    duplicate_ids = (
+        Subscription.objects.values('stripe_subscription_id')
+        .annotate(count=Count('id'))
+        .filter(count__gt=1)
+        .values_list('stripe_subscription_id', flat=True)
+    )
+    for stripe_subscription_id in duplicate_ids:
+        # Keep the row with the latest expiration date
+        subscriptions = Subscription.objects.filter(
+            stripe_subscription_id=stripe_subscription_id
+        ).order_by('-expiration_date', '-id')
+        Subscription.objects.filter(
+            id__in=list(subscriptions.values_list('id', flat=True)[1:])
+        ).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user', '0010_stripecustomeremail'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_subscriptions, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='customer',
+            name='stripe_customer_id',
+            field=models.CharField(db_index=True, max_length=255),
+        ),
+        migrations.AlterField(
+            model_name='subscription',
+            name='stripe_subscription_id',
+            field=models.CharField(max_length=255, unique=True),
+        ),
+    ]
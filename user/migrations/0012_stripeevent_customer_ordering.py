@@ -0,0 +1,56 @@
+# Generated by Django 5.2.3 on 2026-10-18 10:39
+
+import datetime
+
+from django.db import migrations, models
+
+
+def backfill_unprocessed_events(apps, schema_editor):
+    StripeEvent = apps.get_model('user', 'StripeEvent')
+
+    stripe_events = list(StripeEvent.objects.exclude(status='processed'))
+    for stripe_event in stripe_events:
+        obj = stripe_event.payload.get('data', {}).get('object', {})
+        if obj.get('object') == 'customer':
+            customer = obj.get('id')
+        else:
+            customer = obj.get('customer') or obj.get('related_customer')
+        if isinstance(customer, dict):
+            customer = customer.get('id')
+        stripe_event.stripe_customer_id = customer or ''
+        stripe_event.stripe_created = datetime.datetime.fromtimestamp(
+            stripe_event.payload['created'], tz=datetime.UTC
+        )
+    StripeEvent.objects.bulk_update(
+        stripe_events, ['stripe_customer_id', 'stripe_created'], batch_size=500
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user', '0011_subscription_stripe_subscription_id_unique'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customer',
+            name='last_stripe_event_at',
+            field=models.DateTimeField(blank=True, default=None, null=True),
+        ),
+        migrations.AddField(
+            model_name='stripeevent',
+            name='stripe_created',
+            field=models.DateTimeField(blank=True, default=None, null=True),
+        ),
+        migrations.AddField(
+            model_name='stripeevent',
+            name='stripe_customer_id',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AddIndex(
+            model_name='stripeevent',
+            index=models.Index(fields=['stripe_customer_id', 'stripe_created'], name='user_stripeevent_customer_idx'),
+        ),
+        migrations.RunPython(backfill_unprocessed_events, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.3 on 2026-10-18 11:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user', '0012_stripeevent_customer_ordering'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='subscription',
+            name='last_stripe_event_at',
+            field=models.DateTimeField(blank=True, default=None, null=True),
+        ),
+    ]
@@ -4,6 +4,7 @@ from django.conf import settings
 from django.contrib.auth.models import AbstractUser, BaseUserManager
 from django.db import models
 from django.urls import reverse
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 from django_countries.fields import CountryField
 from model_utils.models import TimeStampedModel
@@ -164,16 +165,32 @@ class UserDomain(UserContactScope.AbstractContactClaim, VerifiableMixin):  # typ
 # Subscription information
 class Customer(TimeStampedModel):
     user = models.OneToOneField(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
-    stripe_customer_id = models.CharField(max_length=255)
+    stripe_customer_id = models.CharField(max_length=255, db_index=True)
+    # When the latest `customer.*` Stripe event applied to this customer was created, to spot
+    # stale events
+    last_stripe_event_at = models.DateTimeField(null=True, default=None, blank=True)
 
     def __str__(self) -> str:
         return self.stripe_customer_id
 
 
+class StripeCustomerEmail(TimeStampedModel):
+    """Local index of Stripe customers by (normalized) email to avoid the Stripe Search API."""
+
+    email = models.EmailField(unique=True)
+    stripe_customer_id = models.CharField(max_length=255, db_index=True)
+
+    def __str__(self) -> str:
+        return f"{self.email} ({self.stripe_customer_id})"
+
+
 class Subscription(models.Model):
     customer = models.ForeignKey(Customer, on_delete=models.CASCADE)
-    stripe_subscription_id = models.CharField(max_length=255)
+    stripe_subscription_id = models.CharField(max_length=255, unique=True)
     expiration_date = models.DateField()
+    # When the latest `customer.subscription.*` Stripe event applied to this subscription was
+    # created, to spot stale events
+    last_stripe_event_at = models.DateTimeField(null=True, default=None, blank=True)
 
     def __str__(self) -> str:
         return self.stripe_subscription_id
@@ -201,5 +218,65 @@ class IdentityVerification(TimeStampedModel):
     last_error_code = models.TextField(blank=True, null=True, default=None)
     last_error_message = models.TextField(blank=True, null=True, default=None)
 
+    class Meta(TimeStampedModel.Meta):
+        indexes = [
+            models.Index(fields=["user", "verified_at"], name="user_identver_user_verif_idx"),
+        ]
+
     def __str__(self) -> str:
         return self.stripe_identity_verification_session_id
+
+
+# Stripe webhooks
+class StripeEvent(TimeStampedModel):
+    """Inbox of verified Stripe webhook events, drained by the `process_stripe_events` command."""
+
+    class Status(models.TextChoices):
+        PENDING = "pending", _("Pending")
+        PROCESSING = "processing", _("Processing")
+        PROCESSED = "processed", _("Processed")
+        FAILED = "failed", _("Failed")
+
+    stripe_event_id = models.CharField(max_length=255, unique=True)
+    type = models.CharField(max_length=255)
+    payload = models.JSONField()
+    # Events are applied in order per customer, blank for events that aren't about a customer
+    stripe_customer_id = models.CharField(max_length=255, blank=True)
+    # When Stripe created the event, which isn't necessarily the order they're delivered in
+    stripe_created = models.DateTimeField(null=True, default=None, blank=True)
+    status = models.CharField(max_length=16, choices=Status.choices, default=Status.PENDING)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    # When the event can next be claimed, also used as the lease for events being processed
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    processed_at = models.DateTimeField(null=True, default=None, blank=True)
+    last_error = models.TextField(blank=True)
+
+    class Meta(TimeStampedModel.Meta):
+        indexes = [
+            models.Index(fields=["status", "next_attempt_at"], name="user_stripeevent_status_idx"),
+            models.Index(
+                fields=["stripe_customer_id", "stripe_created"],
+                name="user_stripeevent_customer_idx",
+            ),
+        ]
+
+    def __str__(self) -> str:
+        return self.stripe_event_id
+
+
+class ProcessedWebhook(models.Model):
+    """Ledger of webhook objects that have been processed, see `decorators.idempotent_webhook`."""
+
+    prefix = models.CharField(max_length=255)
+    object_id = models.CharField(max_length=255)
+    processed_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["prefix", "object_id"], name="user_processedwebhook_unique"
+            ),
+        ]
+
+    def __str__(self) -> str:
+        return f"{self.prefix}:{self.object_id}"
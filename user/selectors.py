@@ -1,13 +1,21 @@
+import time
+from dataclasses import dataclass
+from datetime import date, timedelta
 from enum import Enum
 
 import stripe
-from allauth.mfa.utils import is_mfa_enabled
+from allauth.mfa.models import Authenticator
 from django.contrib.auth.models import AnonymousUser
 from django.core.cache import cache
+from django.db.models import Count, Exists, OuterRef, Q, Subquery
 from django.db.models.query import QuerySet
 from django.utils import timezone
 
+from utils.cache import get_or_compute, refresh
+from utils.db import read_only
+
 from . import models
+from .stripe_client import call_stripe, get_stripe_client
 
 
 class OnboardingStep(str, Enum):
@@ -26,6 +34,52 @@ class UserVerificationStatus(str, Enum):
     REJECTED = "rejected"
 
 
+@dataclass(frozen=True, slots=True)
+class OnboardingState:
+    """Everything needed to work out which onboarding step a user is on."""
+
+    mfa_enabled: bool
+    subscription_expiration_date: date | None
+    identity_verification_status: UserVerificationStatus
+
+    @property
+    def has_valid_subscription(self) -> bool:
+        # Compared on read so that a snapshot never outlives the subscription it describes
+        return (
+            self.subscription_expiration_date is not None
+            and self.subscription_expiration_date >= timezone.now().date()
+        )
+
+
+# Attribute used to memoize the onboarding state on a user instance for the rest of the request
+_ONBOARDING_STATE_ATTR = "_onboarding_state"
+ONBOARDING_STATE_CACHE_TIMEOUT = 60 * 60 * 24  # 1 day
+
+
+def onboarding_state_generation_key(*, user_id: int) -> str:
+    # Outside of the `user:onboarding_state:` prefix so workers never keep it in memory
+    return f"user:onboarding_generation:{user_id}"
+
+
+def onboarding_state_cache_key(*, user_id: int, generation: int) -> str:
+    return f"user:onboarding_state:{user_id}:{generation}"
+
+
+def onboarding_state_generation(*, user_id: int) -> int | None:
+    """The generation a user's onboarding state is cached under, `None` if it can't be read.
+
+    Invalidating the state increments the generation (see
+    `services.invalidate_user_onboarding_state`). A missing counter (new or evicted) starts
+    from the current time rather than zero so it never returns to an older generation.
+    """
+    generation_key = onboarding_state_generation_key(user_id=user_id)
+    generation: int | None = cache.get(generation_key)
+    if generation is None:
+        cache.add(generation_key, time.time_ns(), timeout=ONBOARDING_STATE_CACHE_TIMEOUT)
+        generation = cache.get(generation_key)
+    return generation
+
+
 def next_onboarding_step_route(user: models.AgoraUser | AnonymousUser) -> str | None:
     """
     Given a user, determine which onboarding step they should be redirected to and
@@ -39,13 +93,15 @@ def next_onboarding_step_route(user: models.AgoraUser | AnonymousUser) -> str |
     # Type narrowing - user is now known to be AgoraUser
     assert isinstance(user, models.AgoraUser)
 
-    if not user_has_mfa_enabled(user=user):
+    onboarding_state = user_onboarding_state(user=user)
+
+    if not onboarding_state.mfa_enabled:
         return OnboardingStep.MFA
 
-    if not user_has_valid_subscription(user=user):
+    if not onboarding_state.has_valid_subscription:
         return OnboardingStep.BILLING
 
-    identity_verification_status = user_identity_verification_status(user=user)
+    identity_verification_status = onboarding_state.identity_verification_status
 
     if identity_verification_status == UserVerificationStatus.MISSING:
         return OnboardingStep.IDENTITY
@@ -62,8 +118,83 @@ def next_onboarding_step_route(user: models.AgoraUser | AnonymousUser) -> str |
     return None
 
 
+def user_onboarding_state(*, user: models.AgoraUser) -> OnboardingState:
+    """
+    Load the MFA, subscription and identity verification state of a user in a single query.
+
+    The result is memoized on the user instance so that repeated calls within the same
+    request (e.g. middleware followed by a view) don't hit the database again. It is also
+    stored in the cache under the user's current generation until one of the services that
+    changes it invalidates it (see `services.invalidate_user_onboarding_state`).
+    """
+    memoized_state: OnboardingState | None = getattr(user, _ONBOARDING_STATE_ATTR, None)
+    if memoized_state is not None:
+        return memoized_state
+
+    # Read before the state itself so that a state loaded before an invalidation can only
+    # be cached under the generation it replaced
+    generation = onboarding_state_generation(user_id=user.pk)
+    if generation is None:
+        # Without the generation there's no telling if a cached state is current
+        onboarding_state = _load_onboarding_state(user=user)
+    else:
+        onboarding_state = get_or_compute(
+            onboarding_state_cache_key(user_id=user.pk, generation=generation),
+            lambda: _load_onboarding_state(user=user),
+            timeout=ONBOARDING_STATE_CACHE_TIMEOUT,
+        )
+    setattr(user, _ONBOARDING_STATE_ATTR, onboarding_state)
+
+    return onboarding_state
+
+
+@read_only()
+def _load_onboarding_state(*, user: models.AgoraUser) -> OnboardingState:
+    identity_verifications = models.IdentityVerification.objects.filter(user=OuterRef("pk"))
+    latest_subscription_expiration_date = (
+        models.Subscription.objects.filter(customer__user=OuterRef("pk"))
+        .order_by("-expiration_date")
+        .values("expiration_date")[:1]
+    )
+
+    row = (
+        models.AgoraUser.objects.filter(pk=user.pk)
+        .annotate(
+            has_mfa_enabled=Exists(Authenticator.objects.filter(user=OuterRef("pk"))),
+            latest_subscription_expiration_date=Subquery(latest_subscription_expiration_date),
+            has_identity_verification=Exists(identity_verifications),
+            has_pending_identity_verification=Exists(
+                identity_verifications.filter(verified_at__isnull=True)
+            ),
+            has_rejected_identity_verification=Exists(
+                identity_verifications.filter(last_error_code__isnull=False).exclude(
+                    last_error_code=""
+                )
+            ),
+        )
+        .values(
+            "has_mfa_enabled",
+            "latest_subscription_expiration_date",
+            "has_identity_verification",
+            "has_pending_identity_verification",
+            "has_rejected_identity_verification",
+        )
+        .get()
+    )
+
+    return OnboardingState(
+        mfa_enabled=row["has_mfa_enabled"],
+        subscription_expiration_date=row["latest_subscription_expiration_date"],
+        identity_verification_status=_identity_verification_status(
+            has_identity_verification=row["has_identity_verification"],
+            has_pending_identity_verification=row["has_pending_identity_verification"],
+            has_rejected_identity_verification=row["has_rejected_identity_verification"],
+        ),
+    )
+
+
 def user_has_mfa_enabled(*, user: models.AgoraUser) -> bool:
-    return is_mfa_enabled(user)
+    return user_onboarding_state(user=user).mfa_enabled
 
 
 def user_subscriptions(*, user: models.AgoraUser) -> "QuerySet[models.Subscription]":
@@ -71,61 +202,153 @@ def user_subscriptions(*, user: models.AgoraUser) -> "QuerySet[models.Subscripti
 
 
 def user_has_valid_subscription(*, user: models.AgoraUser) -> bool:
-    return user_subscriptions(user=user).filter(expiration_date__gte=timezone.now().date()).exists()
+    return user_onboarding_state(user=user).has_valid_subscription
 
 
+@read_only()
 def user_has_verified_identity(*, user: models.AgoraUser) -> bool:
     now = timezone.now()
     return models.IdentityVerification.objects.filter(user=user, verified_at__lte=now).exists()
 
 
+@read_only()
 def user_identity_verification_status(*, user: models.AgoraUser) -> UserVerificationStatus:
-    user_identity_verification_queryset = models.IdentityVerification.objects.filter(user=user)
-
-    if not user_identity_verification_queryset.exists():
+    # A single conditional aggregate (backed by the `(user, verified_at)` index) as the
+    # frontend polls this while a verification is pending
+    counts = models.IdentityVerification.objects.filter(user=user).aggregate(
+        total=Count("id"),
+        unverified=Count("id", filter=Q(verified_at__isnull=True)),
+        with_error=Count("id", filter=Q(last_error_code__isnull=False) & ~Q(last_error_code="")),
+    )
+
+    return _identity_verification_status(
+        has_identity_verification=counts["total"] > 0,
+        has_pending_identity_verification=counts["unverified"] > 0,
+        has_rejected_identity_verification=counts["with_error"] > 0,
+    )
+
+
+def _identity_verification_status(
+    *,
+    has_identity_verification: bool,
+    has_pending_identity_verification: bool,
+    has_rejected_identity_verification: bool,
+) -> UserVerificationStatus:
+    if not has_identity_verification:
         return UserVerificationStatus.MISSING
 
-    if user_identity_verification_queryset.filter(verified_at__isnull=True).exists():
+    if has_pending_identity_verification:
         return UserVerificationStatus.PENDING
 
-    if (
-        user_identity_verification_queryset.filter(last_error_code__isnull=False)
-        .exclude(last_error_code="")
-        .exists()
-    ):
+    if has_rejected_identity_verification:
         return UserVerificationStatus.REJECTED
 
     return UserVerificationStatus.VERIFIED
 
 
+# Stripe's hosted verification URLs expire after 48 hours so older sessions are abandoned
+IDENTITY_VERIFICATION_SESSION_MAX_AGE = timedelta(hours=48)
+
+
+@read_only()
+def user_open_identity_verification(
+    *, user: models.AgoraUser
+) -> models.IdentityVerification | None:
+    """The user's most recent unverified identity verification that can still be completed."""
+    return (
+        models.IdentityVerification.objects.filter(
+            user=user,
+            verified_at__isnull=True,
+            created__gte=timezone.now() - IDENTITY_VERIFICATION_SESSION_MAX_AGE,
+        )
+        .order_by("-created")
+        .first()
+    )
+
+
+@read_only()
 def user_from_email(*, email: str) -> models.AgoraUser:
     return models.AgoraUser.objects.get(email=email)
 
 
-def stripe_price_details() -> stripe.Price:
-    """Stripe is our source of truth so use the Stripe API to get the price details."""
-    stripe_lookup_key = "standard_annual"
-    cache_lookup_key = f"stripe:price:{stripe_lookup_key}"
+@dataclass(frozen=True, slots=True)
+class StripePriceCatalog:
+    """All active Stripe prices (with their products expanded) by lookup key."""
+
+    prices: dict[str, stripe.Price]
+    fetched_at: float
+
+
+PRICE_CATALOG_CACHE_KEY = "stripe:price:catalog"
+# After this the catalog is refreshed in the background while the stale copy is served
+PRICE_CATALOG_FRESH_FOR = 60 * 60  # 1 hour
+# Keep a stale copy around for a long time so we never have to block on Stripe
+PRICE_CATALOG_STALE_FOR = 60 * 60 * 24 * 30  # 30 days
+# With nothing cached, wait this long for another request's Stripe call before making our own
+PRICE_CATALOG_COMPUTE_WAIT = 2.0
 
-    cached_price = cache.get(cache_lookup_key)
-    if cached_price is not None:
-        return cached_price
 
-    matching_price_list = stripe.Price.search(query=f'lookup_key:"{stripe_lookup_key}"')
-    if matching_price_list.is_empty:
-        raise ValueError(f"No price found for lookup key {stripe_lookup_key}")
+def _fetch_stripe_price_catalog() -> StripePriceCatalog:
+    stripe_price_objs = get_stripe_client().prices.list(
+        params={"active": True, "expand": ["data.product"], "limit": 100}
+    )
+    return StripePriceCatalog(
+        prices={
+            stripe_price.lookup_key: stripe_price
+            for stripe_price in stripe_price_objs.auto_paging_iter()
+            if stripe_price.lookup_key
+        },
+        fetched_at=time.time(),
+    )
 
-    if len(matching_price_list.data) != 1:
-        raise ValueError(f"Multiple prices found for lookup key {stripe_lookup_key}")
 
-    # Pyright doesn't like this but we narrow the type using Price.search so we know this is a Price
-    stripe_price: stripe.Price = matching_price_list.data[0]  # type: ignore
+def refresh_stripe_price_catalog() -> StripePriceCatalog:
+    """Load all active prices from Stripe and store them in the cache."""
+    return refresh(
+        PRICE_CATALOG_CACHE_KEY,
+        _fetch_stripe_price_catalog,
+        timeout=PRICE_CATALOG_FRESH_FOR,
+        stale_for=PRICE_CATALOG_STALE_FOR,
+    )
 
-    cache.set(cache_lookup_key, stripe_price, timeout=60 * 60 * 24)
+
+def stripe_price_catalog() -> StripePriceCatalog:
+    """Stripe is our source of truth but serve the cached catalog, even if it's stale.
+
+    Only when nothing is cached at all (e.g. the very first request) do we wait for Stripe.
+    """
+    return get_or_compute(
+        PRICE_CATALOG_CACHE_KEY,
+        lambda: call_stripe(_fetch_stripe_price_catalog),
+        timeout=PRICE_CATALOG_FRESH_FOR,
+        stale_for=PRICE_CATALOG_STALE_FOR,
+        compute_wait=PRICE_CATALOG_COMPUTE_WAIT,
+        refresh_in_background=True,
+    )
+
+
+def stripe_price_details(*, lookup_key: str = "standard_annual") -> stripe.Price:
+    stripe_price = stripe_price_catalog().prices.get(lookup_key)
+    if stripe_price is None:
+        raise ValueError(f"No price found for lookup key {lookup_key}")
 
     return stripe_price
 
 
+def normalize_email(email: str) -> str:
+    return email.strip().lower()
+
+
+@read_only()
+def stripe_customer_id_from_email(*, email: str) -> str | None:
+    return (
+        models.StripeCustomerEmail.objects.filter(email=normalize_email(email))
+        .values_list("stripe_customer_id", flat=True)
+        .first()
+    )
+
+
+@read_only()
 def customer_obj(*, for_user: models.AgoraUser) -> models.Customer | None:
     try:
         return for_user.customer
@@ -1,33 +1,161 @@
-from datetime import datetime, timedelta
+import hashlib
+import time
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import UTC, date, datetime, timedelta
+from typing import Any
 
 import phonenumbers
 import stripe
 from django.conf import settings
+from django.core.cache import cache
+from django.db import close_old_connections, transaction
+from django.db.models import Exists, F, OuterRef, Q
+from django.db.models.query import QuerySet
 from django.urls import reverse
+from django.utils import timezone
 
 from user.decorators import idempotent_webhook
+from user.stripe_client import call_stripe, get_stripe_client
+from utils.deadline import remaining_request_budget
+from utils.lru import LRUCache
 from utils.typing.request import HttpRequest
 
 from . import logger, models, selectors
 
+# Stripe objects fetched while handling webhooks so retried events don't fetch them again
+_recently_fetched_stripe_objects: LRUCache[tuple[str, tuple[str, ...]], stripe.StripeObject] = (
+    LRUCache(maxsize=256, ttl=60 * 10)
+)
+
+
+def invalidate_user_onboarding_state(*, user_id: int) -> None:
+    """Invalidate the cached onboarding state of a user once the current transaction commits.
+
+    The state is cached per generation (see `selectors.onboarding_state_generation`) and this
+    moves the user on to the next one, so a concurrent request that loaded the pre-commit
+    state can only cache it under a generation that's no longer read.
+    """
+    invalidate_users_onboarding_states(user_ids=[user_id])
+
+
+def invalidate_users_onboarding_states(*, user_ids: list[int]) -> None:
+    """`invalidate_user_onboarding_state` for several users."""
+    transaction.on_commit(lambda: _next_onboarding_state_generations(user_ids=user_ids))
+
+
+def _next_onboarding_state_generations(*, user_ids: list[int]) -> None:
+    for user_id in user_ids:
+        generation_key = selectors.onboarding_state_generation_key(user_id=user_id)
+        try:
+            cache.incr(generation_key)
+        except ValueError:
+            # No counter, start a new one unless a request just did (after the change)
+            cache.add(
+                generation_key, time.time_ns(), timeout=selectors.ONBOARDING_STATE_CACHE_TIMEOUT
+            )
+
+
+def index_stripe_customer(*, email: str, stripe_customer_id: str) -> None:
+    """Record (or update) which Stripe customer an email address belongs to."""
+    stripe_customer_email = models.StripeCustomerEmail(
+        email=selectors.normalize_email(email), stripe_customer_id=stripe_customer_id
+    )
+    stripe_customer_email.full_clean(validate_unique=False)
+    models.StripeCustomerEmail.objects.bulk_create(
+        [stripe_customer_email],
+        update_conflicts=True,
+        unique_fields=["email"],
+        update_fields=["stripe_customer_id", "modified"],
+    )
+
+
+def unindex_stripe_customer(*, stripe_customer_id: str) -> None:
+    models.StripeCustomerEmail.objects.filter(stripe_customer_id=stripe_customer_id).delete()
+
+
+def handle_customer_changed_webhook_event(*, customer: stripe.Customer) -> None:
+    with transaction.atomic():
+        # The email may have changed so drop any previous entries for this customer
+        unindex_stripe_customer(stripe_customer_id=customer.id)
+        if customer.get("email"):
+            index_stripe_customer(email=str(customer.email), stripe_customer_id=customer.id)
+
+
+def backfill_stripe_customer_index(*, batch_size: int = 500) -> int:
+    """Index every Stripe customer with an email address, returns the number indexed."""
+    indexed_count = 0
+    # Keyed by email as an upsert can't touch the same row twice in one statement
+    stripe_customer_emails: dict[str, models.StripeCustomerEmail] = {}
+
+    def flush() -> None:
+        models.StripeCustomerEmail.objects.bulk_create(
+            list(stripe_customer_emails.values()),
+            update_conflicts=True,
+            unique_fields=["email"],
+            update_fields=["stripe_customer_id", "modified"],
+        )
+        stripe_customer_emails.clear()
+
+    # Customers are listed newest first so the oldest customer wins for duplicate emails
+    stripe_customer_objs = get_stripe_client().customers.list(params={"limit": 100})
+    for stripe_customer_obj in stripe_customer_objs.auto_paging_iter():
+        if not stripe_customer_obj.email:
+            continue
+
+        email = selectors.normalize_email(stripe_customer_obj.email)
+        stripe_customer_emails[email] = models.StripeCustomerEmail(
+            email=email, stripe_customer_id=stripe_customer_obj.id
+        )
+        indexed_count += 1
+        if len(stripe_customer_emails) >= batch_size:
+            flush()
+
+    if stripe_customer_emails:
+        flush()
+
+    return indexed_count
+
 
 def create_stripe_customer(*, user: models.AgoraUser) -> models.Customer:
-    existing_customer_objs = stripe.Customer.search(query=f'email:"{user.email}"', limit=20)
-    if existing_customer_objs.is_empty:
-        stripe_customer_obj = stripe.Customer.create(email=user.email)
-    else:
-        # Don't know why there are multiple but just pick the first one for now
-        stripe_customer_obj = existing_customer_objs.data[0]
+    # Check the local index first, the Search API is slow and rate limited
+    stripe_customer_id = selectors.stripe_customer_id_from_email(email=user.email)
+    if stripe_customer_id is None:
+        stripe_client = get_stripe_client()
+        existing_customer_objs = call_stripe(
+            lambda: stripe_client.customers.search(
+                params={"query": f'email:"{user.email}"', "limit": 20}
+            )
+        )
+        if existing_customer_objs.is_empty:
+            # Retried or concurrent requests for the same user won't create duplicates, the
+            # email is part of the key as Stripe rejects a reused key with different params
+            email_hash = hashlib.sha256(user.email.encode()).hexdigest()[:16]
+            stripe_customer_obj = call_stripe(
+                lambda: stripe_client.customers.create(
+                    params={"email": user.email},
+                    options={"idempotency_key": f"customer-create:{user.id}:{email_hash}"},
+                )
+            )
+        else:
+            # Don't know why there are multiple but just pick the first one for now
+            stripe_customer_obj = existing_customer_objs.data[0]
+
+        stripe_customer_id = stripe_customer_obj.id
+        index_stripe_customer(email=user.email, stripe_customer_id=stripe_customer_id)
 
-    customer_obj = models.Customer(user=user, stripe_customer_id=stripe_customer_obj.id)
-    customer_obj.full_clean()
-    customer_obj.save()
+    customer_obj = models.Customer(user=user, stripe_customer_id=stripe_customer_id)
+    customer_obj.full_clean(validate_unique=False)
+    # A concurrent request may have got here first (with the same Stripe customer thanks to the
+    # idempotency key) so keep whichever row won
+    models.Customer.objects.bulk_create([customer_obj], ignore_conflicts=True)
 
-    return customer_obj
+    return models.Customer.objects.get(user=user)
 
 
 def create_subscription(
-    *, customer: models.Customer, stripe_subscription_id: str, expiration_date: datetime
+    *, customer: models.Customer, stripe_subscription_id: str, expiration_date: date
 ) -> models.Subscription:
     logger.debug(f"Creating subscription for customer {customer.id}")
     subscription = models.Subscription(
@@ -35,16 +163,28 @@ def create_subscription(
         stripe_subscription_id=stripe_subscription_id,
         expiration_date=expiration_date,
     )
-    subscription.full_clean()
-    subscription.save()
+    subscription.full_clean(validate_unique=False)
+    # The subscription may already have been recorded from an invoice or by reconciliation
+    models.Subscription.objects.bulk_create(
+        [subscription],
+        update_conflicts=True,
+        unique_fields=["stripe_subscription_id"],
+        update_fields=["customer", "expiration_date"],
+    )
+
+    invalidate_user_onboarding_state(user_id=customer.user_id)
 
     logger.debug(f"Created subscription {subscription.id} for customer {customer.id}")
 
     return subscription
 
 
-def create_verified_phone_number(
-    *, user_id: int, phone_number: str, verified_at: datetime | None = None
+# Stripe Identity doesn't share the number itself, only that the user has verified one
+STRIPE_IDENTITY_PHONE_NUMBER = "REDACTED:STRIPE_IDENTITY"
+
+
+def update_or_create_verified_phone_number(
+    *, user: models.AgoraUser, phone_number: str, verified_at: datetime | None = None
 ) -> models.UserPhoneNumber | None:
     try:
         parsed_phone_number_obj = phonenumbers.parse(phone_number)
@@ -52,68 +192,172 @@ def create_verified_phone_number(
         logger.error(f"Invalid phone number: {phone_number}")
         return None
 
-    country_code = phonenumbers.region_code_for_number(parsed_phone_number_obj)
+    # Upsert the contact scope, Django sets the primary key from the returned row
+    contact_scope = models.UserContactScope(user=user)
+    models.UserContactScope.objects.bulk_create(
+        [contact_scope], update_conflicts=True, unique_fields=["user"], update_fields=["user"]
+    )
 
     user_phone_number = models.UserPhoneNumber(
-        user=user_id,
-        phone_number="REDACTED:STRIPE_IDENTITY",
-        country=country_code,
-        verified=verified_at,
+        contact_scope=contact_scope,
+        phone_number=STRIPE_IDENTITY_PHONE_NUMBER,
+        country=phonenumbers.region_code_for_number(parsed_phone_number_obj),
+        verified=verified_at.date() if verified_at is not None else None,
     )
-    user_phone_number.full_clean()
-    user_phone_number.save()
+    # The contact scope was just written, validating it would query for it again
+    user_phone_number.full_clean(exclude=["contact_scope"], validate_unique=False)
+
+    # A user only has one phone number verified through Stripe Identity
+    updated = models.UserPhoneNumber.objects.filter(
+        contact_scope=contact_scope, phone_number=STRIPE_IDENTITY_PHONE_NUMBER
+    ).update(country=user_phone_number.country, verified=user_phone_number.verified)
+    if not updated:
+        user_phone_number.save(force_insert=True)
 
     return user_phone_number
 
 
 def update_user_first_last_names(
-    *, user_id: int, first_name: str | None, last_name: str | None
+    *, user: models.AgoraUser, first_name: str | None, last_name: str | None
 ) -> models.AgoraUser:
-    user = models.AgoraUser.objects.get(id=user_id)
+    update_fields = []
     if first_name:
         user.first_name = first_name
+        update_fields.append("first_name")
     if last_name:
         user.last_name = last_name
-    user.full_clean()
-    user.save()
+        update_fields.append("last_name")
+    if not update_fields:
+        return user
+
+    # Only the changed fields, full_clean() would query to check the email and handle are unique
+    user.clean_fields(exclude={field.name for field in user._meta.fields} - set(update_fields))
+    user.save(update_fields=update_fields)
 
     return user
 
 
+# Checkout sessions are shared between requests for the same user and price within a window
+CHECKOUT_SESSION_WINDOW = 60 * 30  # 30 minutes
+# Sessions expire between 1 and 1.5 hours after being created (depending on the window)
+CHECKOUT_SESSION_LIFETIME = 60 * 90  # 1.5 hours
+# Don't hand out sessions that are about to expire
+CHECKOUT_SESSION_MIN_REMAINING = 60 * 5  # 5 minutes
+# How long concurrent requests wait for the request creating the session
+CHECKOUT_SESSION_WAIT = 3.0
+
+
+def checkout_session_cache_key(*, user_id: int, stripe_price_id: str) -> str:
+    return f"stripe:checkout_session:{user_id}:{stripe_price_id}"
+
+
+def _cached_checkout_session(*, cache_key: str) -> stripe.checkout.Session | None:
+    checkout_session_obj: stripe.checkout.Session | None = cache.get(cache_key)
+    if checkout_session_obj is None:
+        return None
+    if checkout_session_obj.expires_at - time.time() < CHECKOUT_SESSION_MIN_REMAINING:
+        return None
+    return checkout_session_obj
+
+
 def create_stripe_checkout_session_for_subscription(
     *, request: HttpRequest, stripe_price_id: str
 ) -> stripe.checkout.Session:
+    """Return an open Checkout Session for the user and price, creating one if needed.
+
+    Double clicks, retries and concurrent requests get the same session: the first request
+    creates it while the others wait for it to appear in the cache.
+    """
     if request.user.is_anonymous:
         raise ValueError("User must be authenticated to create a subscription")
 
     user: models.AgoraUser = request.user  # type: ignore
 
+    cache_key = checkout_session_cache_key(user_id=user.id, stripe_price_id=stripe_price_id)
+    checkout_session_obj = _cached_checkout_session(cache_key=cache_key)
+    if checkout_session_obj is not None:
+        return checkout_session_obj
+
+    lock_key = f"{cache_key}:lock"
+    # Only held while calling Stripe, which is bounded by the operation timeout, so a lock left
+    # behind by a killed worker doesn't hold up the user for long
+    if not cache.add(lock_key, True, timeout=settings.STRIPE_OPERATION_TIMEOUT):
+        remaining = remaining_request_budget()
+        if remaining is not None:
+            # Leave time to create the session ourselves, the Stripe call gets what's left
+            wait = min(CHECKOUT_SESSION_WAIT, remaining / 2)
+        else:
+            # The Stripe call gets the whole operation timeout, keep both within the budget
+            # a request would have (and so within gunicorn's timeout)
+            wait = min(
+                CHECKOUT_SESSION_WAIT,
+                max(0.0, settings.REQUEST_TIME_BUDGET - settings.STRIPE_OPERATION_TIMEOUT),
+            )
+        wait_until = time.monotonic() + wait
+        while time.monotonic() < wait_until:
+            time.sleep(0.1)
+            checkout_session_obj = _cached_checkout_session(cache_key=cache_key)
+            if checkout_session_obj is not None:
+                return checkout_session_obj
+        # Carry on and create it ourselves, the idempotency key stops Stripe creating a
+        # second session if the other request is still going
+
+    try:
+        checkout_session_obj = _create_stripe_checkout_session(
+            request=request, user=user, stripe_price_id=stripe_price_id
+        )
+        cache.set(
+            cache_key,
+            checkout_session_obj,
+            timeout=int(checkout_session_obj.expires_at - time.time()),
+        )
+    finally:
+        cache.delete(lock_key)
+
+    return checkout_session_obj
+
+
+def _create_stripe_checkout_session(
+    *, request: HttpRequest, user: models.AgoraUser, stripe_price_id: str
+) -> stripe.checkout.Session:
     # Do we have a customer record for this user?
     customer = selectors.customer_obj(for_user=user)
     if customer is None:
         customer = create_stripe_customer(user=user)
 
+    # Idempotency keys must always be sent with the same parameters so the expiry is derived
+    # from the window rather than the current time
+    window = int(time.time() // CHECKOUT_SESSION_WINDOW)
+    expires_at = window * CHECKOUT_SESSION_WINDOW + CHECKOUT_SESSION_LIFETIME
+
     # https://docs.stripe.com/api/checkout/sessions/create
-    checkout_session_obj = stripe.checkout.Session.create(
-        client_reference_id=str(user.id),
-        customer=customer.stripe_customer_id,
-        success_url=f"{request.build_absolute_uri(reverse(selectors.OnboardingStep.IDENTITY))}?session_id={{CHECKOUT_SESSION_ID}}",
-        cancel_url=request.build_absolute_uri(reverse(selectors.OnboardingStep.BILLING)),
-        mode="subscription",
-        line_items=[
-            {
-                "price": stripe_price_id,
-                "quantity": 1,
-            }
-        ],
-        allow_promotion_codes=True,
-        consent_collection={
-            "terms_of_service": "required",
-            "payment_method_reuse_agreement": {"position": "auto"},
-        },
-        customer_update={"address": "auto", "name": "auto"},
-        expires_at=int((datetime.now() + timedelta(hours=1)).timestamp()),
-        payment_method_collection="always",
+    success_url = request.build_absolute_uri(reverse(selectors.OnboardingStep.IDENTITY))
+    stripe_client = get_stripe_client()
+    checkout_session_obj = call_stripe(
+        lambda: stripe_client.checkout.sessions.create(
+            params={
+                "client_reference_id": str(user.id),
+                "customer": customer.stripe_customer_id,
+                "success_url": f"{success_url}?session_id={{CHECKOUT_SESSION_ID}}",
+                "cancel_url": request.build_absolute_uri(reverse(selectors.OnboardingStep.BILLING)),
+                "mode": "subscription",
+                "line_items": [
+                    {
+                        "price": stripe_price_id,
+                        "quantity": 1,
+                    }
+                ],
+                "allow_promotion_codes": True,
+                "consent_collection": {
+                    "terms_of_service": "required",
+                    "payment_method_reuse_agreement": {"position": "auto"},
+                },
+                "customer_update": {"address": "auto", "name": "auto"},
+                "expires_at": expires_at,
+                "payment_method_collection": "always",
+            },
+            options={"idempotency_key": f"checkout-session:{user.id}:{stripe_price_id}:{window}"},
+        )
     )
 
     return checkout_session_obj
@@ -133,160 +377,837 @@ def create_identity_verification(
     identity_verification.full_clean()
     identity_verification.save()
 
+    # A new (pending) verification moves the user onto the next onboarding step
+    invalidate_user_onboarding_state(user_id=user.id)
+
     return identity_verification
 
 
+# Sessions the user has submitted, they have no URL and the user should wait on the outcome
+IDENTITY_VERIFICATION_SUBMITTED_STATUSES = frozenset({"processing", "verified"})
+
+
 def create_stripe_identity_verification_session(
     *, request: HttpRequest
 ) -> stripe.identity.VerificationSession:
+    """Return the user's open Verification Session, only creating one if there isn't one.
+
+    Reloading the identity page therefore doesn't create more sessions (and pending rows).
+    A session that's already been submitted (see `IDENTITY_VERIFICATION_SUBMITTED_STATUSES`)
+    is returned as is, without a URL, so the caller should send the user to the pending step.
+    """
     if request.user.is_anonymous:
         raise ValueError("User must be authenticated to create a verification session")
 
     user: models.AgoraUser = request.user  # type: ignore
 
-    verification_session_obj = stripe.identity.VerificationSession.create(
-        client_reference_id=str(user.id),
-        provided_details={
-            "email": user.email,
-        },
-        related_customer=user.customer.stripe_customer_id,
-        verification_flow=settings.STRIPE_VERIFICATION_FLOW_ID,
-        # The flow configures everything including the return URL
-    )
+    stripe_client = get_stripe_client()
+    replaced_session_id = ""
+    open_identity_verification = selectors.user_open_identity_verification(user=user)
+    if open_identity_verification is not None:
+        open_session_id = open_identity_verification.stripe_identity_verification_session_id
+        # Retrieving a session that requires input gives it a fresh (single use) URL
+        verification_session_obj = call_stripe(
+            lambda: stripe_client.identity.verification_sessions.retrieve(open_session_id)
+        )
+        if (
+            verification_session_obj.status == "requires_input"
+            or verification_session_obj.status in IDENTITY_VERIFICATION_SUBMITTED_STATUSES
+        ):
+            return verification_session_obj
 
-    create_identity_verification(
-        user=user,
-        stripe_identity_verification_session_id=verification_session_obj.id,
-        identity_issuing_country="",
+        # Cancelled (or in a state it can't be completed from) so start again
+        replaced_session_id = open_session_id
+        open_identity_verification.delete()
+
+    window = int(time.time() // (60 * 60))
+    # Loaded here as the Stripe call runs on another thread, which mustn't touch the database
+    stripe_customer_id = user.customer.stripe_customer_id
+    verification_session_obj = call_stripe(
+        lambda: stripe_client.identity.verification_sessions.create(
+            params={
+                "client_reference_id": str(user.id),
+                "provided_details": {
+                    "email": user.email,
+                },
+                "related_customer": stripe_customer_id,
+                "verification_flow": settings.STRIPE_VERIFICATION_FLOW_ID,
+                # The flow configures everything including the return URL
+            },
+            # Concurrent requests for the same user get the same session
+            options={
+                "idempotency_key": f"identity-session:{user.id}:{replaced_session_id}:{window}"
+            },
+        )
     )
 
+    if not models.IdentityVerification.objects.filter(
+        stripe_identity_verification_session_id=verification_session_obj.id
+    ).exists():
+        create_identity_verification(
+            user=user,
+            stripe_identity_verification_session_id=verification_session_obj.id,
+            identity_issuing_country="",
+        )
+
     return verification_session_obj
 
 
-def create_user_date_of_birth(
-    *, user_id: int, day: int | None, month: int | None, year: int | None
+def cancel_stale_identity_verifications(
+    *, executor: ThreadPoolExecutor, batch_size: int = 100
+) -> int:
+    """Cancel verification sessions the user abandoned and delete their rows.
+
+    Sessions are cancelled in parallel on the executor and the rows deleted a batch at a time.
+    Returns the number of rows deleted.
+    """
+    stale_identity_verifications = models.IdentityVerification.objects.filter(
+        verified_at__isnull=True,
+        created__lt=timezone.now() - selectors.IDENTITY_VERIFICATION_SESSION_MAX_AGE,
+    ).values_list("id", "user_id", "stripe_identity_verification_session_id")
+
+    deleted_count = 0
+    last_id = 0
+    while True:
+        batch = list(
+            stale_identity_verifications.filter(id__gt=last_id).order_by("id")[:batch_size]
+        )
+        if not batch:
+            break
+        last_id = batch[-1][0]
+
+        cancelled = executor.map(
+            lambda row: _cancel_stripe_identity_verification_session(
+                verification_session_id=row[2]
+            ),
+            batch,
+        )
+        cancelled_rows = [
+            row for row, is_cancelled in zip(batch, cancelled, strict=True) if is_cancelled
+        ]
+        if not cancelled_rows:
+            continue
+
+        deleted, _ = models.IdentityVerification.objects.filter(
+            id__in=[row[0] for row in cancelled_rows]
+        ).delete()
+        deleted_count += deleted
+        invalidate_users_onboarding_states(user_ids=[row[1] for row in cancelled_rows])
+
+    return deleted_count
+
+
+def _cancel_stripe_identity_verification_session(*, verification_session_id: str) -> bool:
+    """Cancel a session in Stripe, returns whether it's now cancelled (or doesn't exist)."""
+    stripe_client = get_stripe_client()
+    try:
+        stripe_client.identity.verification_sessions.cancel(verification_session_id)
+        return True
+    except stripe.InvalidRequestError as e:
+        if e.code == "resource_missing":
+            return True
+        # Only sessions that require input can be cancelled, it may already be cancelled or
+        # be processing a late submission
+        try:
+            verification_session_obj = stripe_client.identity.verification_sessions.retrieve(
+                verification_session_id
+            )
+        except stripe.StripeError as retrieve_error:
+            logger.warning(
+                f"Failed to retrieve verification session {verification_session_id} after it "
+                f"couldn't be cancelled: {retrieve_error}"
+            )
+            return False
+        if verification_session_obj.status != "canceled":
+            logger.info(
+                f"Not cleaning up verification session {verification_session_id} "
+                f"({verification_session_obj.status})"
+            )
+        return verification_session_obj.status == "canceled"
+    except stripe.StripeError as e:
+        logger.warning(f"Failed to cancel verification session {verification_session_id}: {e}")
+        return False
+
+
+def update_or_create_user_date_of_birth(
+    *, user: models.AgoraUser, day: int | None, month: int | None, year: int | None
 ) -> models.UserDateOfBirth:
-    user_date_of_birth = models.UserDateOfBirth(user=user_id, day=day, month=month, year=year)
-    user_date_of_birth.full_clean()
-    user_date_of_birth.save()
+    user_date_of_birth = models.UserDateOfBirth(user=user, day=day, month=month, year=year)
+    # Validating the user would query for it again
+    user_date_of_birth.full_clean(exclude=["user"], validate_unique=False)
+    models.UserDateOfBirth.objects.bulk_create(
+        [user_date_of_birth],
+        update_conflicts=True,
+        unique_fields=["user"],
+        update_fields=["day", "month", "year"],
+    )
 
     return user_date_of_birth
 
 
-@idempotent_webhook(prefix="stripe:checkout_session_completed", id_field="checkout_session_id")
-def handle_checkout_session_completed(*, checkout_session_id: str) -> None:
+def expand_missing_stripe_fields[StripeObjectT: stripe.StripeObject](
+    stripe_obj: StripeObjectT,
+    *,
+    fields: list[str],
+    retrieve: Callable[[str, list[str]], StripeObjectT],
+) -> StripeObjectT:
+    """Return `stripe_obj` with `fields` expanded, only fetching from Stripe if they aren't.
+
+    Webhook payloads carry most of the object but related objects are either missing or
+    just an ID, so we only go back to Stripe for those.
+    """
+    missing_fields = tuple(
+        field for field in fields if not isinstance(stripe_obj.get(field), stripe.StripeObject)
+    )
+    if not missing_fields:
+        return stripe_obj
+
+    cache_key = (str(stripe_obj.id), missing_fields)
+    cached_stripe_obj = _recently_fetched_stripe_objects.get(cache_key)
+    if cached_stripe_obj is not None:
+        return cached_stripe_obj  # type: ignore[return-value]
+
+    fetched_stripe_obj = retrieve(str(stripe_obj.id), list(missing_fields))
+    _recently_fetched_stripe_objects.set(cache_key, fetched_stripe_obj)
+
+    return fetched_stripe_obj
+
+
+def handle_checkout_session_completed(
+    *,
+    checkout_session_id: str,
+    checkout_session: stripe.checkout.Session | None = None,
+) -> None:
     logger.info(f"Handling checkout session completed event for {checkout_session_id}")
     # https://docs.stripe.com/checkout/fulfillment?payment-ui=stripe-hosted#create-fulfillment-function
-    # Retrieve the Checkout Session from the API with line_items expanded
-    checkout_session_obj = stripe.checkout.Session.retrieve(
-        id=checkout_session_id,
-        expand=["line_items", "subscription"],
-    )
+    # Everything is fetched from Stripe before writing so the write lock isn't held while
+    # waiting on the network. Use the Checkout Session from the event payload where we have it
+    stripe_client = get_stripe_client()
+    checkout_session_obj = checkout_session
+    if checkout_session_obj is None:
+        checkout_session_obj = stripe_client.checkout.sessions.retrieve(checkout_session_id)
 
-    if checkout_session_obj.status == "expired":
+    if checkout_session_obj.status == "expired" or checkout_session_obj.payment_status == "unpaid":
         return
 
-    if checkout_session_obj.payment_status != "unpaid":
-        user_id_str = str(checkout_session_obj.client_reference_id)
-        try:
-            user_id = int(user_id_str)
-        except ValueError as e:
-            raise ValueError(f"Invalid user ID: {user_id_str}") from e
+    # Line items and the subscription are never expanded in the event payload
+    checkout_session_obj = expand_missing_stripe_fields(
+        checkout_session_obj,
+        fields=["line_items", "subscription"],
+        retrieve=lambda stripe_id, expand: stripe_client.checkout.sessions.retrieve(
+            stripe_id, params={"expand": expand}
+        ),
+    )
 
-        stripe_customer_id = str(checkout_session_obj.customer)
-        customer_obj, _ = models.Customer.objects.get_or_create(
-            user=user_id, stripe_customer_id=stripe_customer_id
-        )
+    user_id_str = str(checkout_session_obj.client_reference_id)
+    try:
+        user_id = int(user_id_str)
+    except ValueError as e:
+        raise ValueError(f"Invalid user ID: {user_id_str}") from e
 
-        line_items = checkout_session_obj.line_items
-        if line_items is None or line_items.is_empty:
-            raise ValueError("No line items in checkout session")
+    line_items = checkout_session_obj.line_items
+    if line_items is None or line_items.is_empty:
+        raise ValueError("No line items in checkout session")
 
-        # Todo(kisamoto): Handle individual line items, for now just assume our single product
+    # Todo(kisamoto): Handle individual line items, for now just assume our single product
 
-        subscription_obj = checkout_session_obj.subscription
-        if subscription_obj is None:
-            raise ValueError("No subscription object in checkout session")
-        # One year from the checkout session completion date
-        subscription_end_date = datetime.fromtimestamp(
-            subscription_obj.current_period_end
-        ) + timedelta(days=365)
+    subscription_obj = checkout_session_obj.subscription
+    if subscription_obj is None:
+        raise ValueError("No subscription object in checkout session")
+    if isinstance(subscription_obj, str):
+        raise ValueError(f"Subscription {subscription_obj} wasn't expanded")
 
-        create_subscription(
-            customer=customer_obj,
-            stripe_subscription_id=subscription_obj.id,
-            expiration_date=subscription_end_date,
+    fulfill_checkout_session(
+        checkout_session_id=checkout_session_id,
+        user_id=user_id,
+        stripe_customer_id=str(checkout_session_obj.customer),
+        stripe_price_ids=[
+            line_item.price.id for line_item in line_items.data if line_item.price is not None
+        ],
+        stripe_subscription_id=subscription_obj.id,
+        expiration_date=subscription_expiration_date(subscription=subscription_obj),
+    )
+
+
+@idempotent_webhook(prefix="stripe:checkout_session_completed", id_field="checkout_session_id")
+def fulfill_checkout_session(
+    *,
+    checkout_session_id: str,
+    user_id: int,
+    stripe_customer_id: str,
+    stripe_price_ids: list[str],
+    stripe_subscription_id: str,
+    expiration_date: date,
+) -> None:
+    """Record the subscription a completed Checkout Session paid for."""
+    customer_obj, _ = models.Customer.objects.get_or_create(
+        user_id=user_id, stripe_customer_id=stripe_customer_id
+    )
+
+    # The session is complete so it mustn't be handed out again, once that's committed
+    cache_keys = [
+        checkout_session_cache_key(user_id=user_id, stripe_price_id=stripe_price_id)
+        for stripe_price_id in stripe_price_ids
+    ]
+    transaction.on_commit(lambda: cache.delete_many(cache_keys))
+
+    create_subscription(
+        customer=customer_obj,
+        stripe_subscription_id=stripe_subscription_id,
+        expiration_date=expiration_date,
+    )
+
+
+def handle_identity_verification_completed(
+    *,
+    verification_session_id: str,
+    verification_session: stripe.identity.VerificationSession | None = None,
+) -> None:
+    # Everything is fetched from Stripe before writing so the write lock isn't held while
+    # waiting on the network. Use the Verification Session from the event payload where we have it
+    stripe_client = get_stripe_client()
+    verification_session_obj = verification_session
+    if verification_session_obj is None:
+        verification_session_obj = stripe_client.identity.verification_sessions.retrieve(
+            verification_session_id
         )
 
+    # Todo(kisamoto): Handle problems with verification
+
+    if verification_session_obj.status != "verified":
+        return
+
+    # Verified outputs are never expanded in the event payload
+    verification_session_obj = expand_missing_stripe_fields(
+        verification_session_obj,
+        fields=["verified_outputs"],
+        retrieve=lambda stripe_id, expand: (
+            stripe_client.identity.verification_sessions.retrieve(
+                stripe_id, params={"expand": expand}
+            )
+        ),
+    )
+
+    user_id_str = str(verification_session_obj.client_reference_id)
+    try:
+        user_id = int(user_id_str)
+    except ValueError as e:
+        raise ValueError(f"Invalid user ID: {user_id_str}") from e
+
+    apply_verified_identity_outputs(
+        verification_session_id=verification_session_id,
+        user_id=user_id,
+        verified_outputs=verification_session_obj.verified_outputs,  # type: ignore
+        # We don't have a "verified_at" field so we'll use the created field
+        verified_at=datetime.fromtimestamp(verification_session_obj.created, tz=UTC),
+    )
+
 
 @idempotent_webhook(
     prefix="stripe:identity_verification_session_completed",
     id_field="verification_session_id",
 )
-def handle_identity_verification_completed(*, verification_session_id: str) -> None:
-    verification_session_obj = stripe.identity.VerificationSession.retrieve(
-        id=verification_session_id, expand=["verified_outputs"]
+def apply_verified_identity_outputs(
+    *,
+    verification_session_id: str,
+    user_id: int,
+    verified_outputs: stripe.identity.VerificationSession.VerifiedOutputs,
+    verified_at: datetime,
+) -> None:
+    """Update the user with what Stripe verified about them as a single unit of work.
+
+    Every row is validated in memory and upserted so the whole update is a handful of
+    statements, keeping the webhook's transaction (and SQLite's write lock) short.
+    """
+    user = models.AgoraUser.objects.get(id=user_id)
+
+    # There's a chance we can get lots of verified outputs so wherever
+    # possible we'll update the user's information
+
+    dob: stripe.identity.VerificationSession.VerifiedOutputs.Dob | None = verified_outputs.get(
+        "dob"
     )
+    if dob is not None:
+        update_or_create_user_date_of_birth(user=user, day=dob.day, month=dob.month, year=dob.year)
 
-    # Todo(kisamoto): Handle problems with verification
+    update_user_first_last_names(
+        user=user,
+        first_name=verified_outputs.get("first_name"),
+        last_name=verified_outputs.get("last_name"),
+    )
 
-    if verification_session_obj.status == "verified":
-        # We don't have a "verified_at" field so we'll use the created field
-        verification_datetime = datetime.fromtimestamp(verification_session_obj.created)
+    phone: str | None = verified_outputs.get("phone")
+    if phone:
+        update_or_create_verified_phone_number(
+            user=user, phone_number=phone, verified_at=verified_at
+        )
 
-        user_id_str = str(verification_session_obj.client_reference_id)
-        try:
-            user_id = int(user_id_str)
-        except ValueError as e:
-            raise ValueError(f"Invalid user ID: {user_id_str}") from e
-
-        verified_outputs: stripe.identity.VerificationSession.VerifiedOutputs = (
-            verification_session_obj.verified_outputs
-        )  # type: ignore
-        identity_issuing_country_code = (
-            verified_outputs.address.country if verified_outputs.address else None
+    address: stripe.identity.VerificationSession.VerifiedOutputs.Address | None = (
+        verified_outputs.get("address")
+    )
+    identity_verification = models.IdentityVerification(
+        user=user,
+        stripe_identity_verification_session_id=verification_session_id,
+        verified_at=verified_at,
+        identity_issuing_country=(address.country if address is not None else None) or "",
+    )
+    identity_verification.full_clean(exclude=["user"], validate_unique=False)
+    updated = models.IdentityVerification.objects.filter(
+        user=user, stripe_identity_verification_session_id=verification_session_id
+    ).update(
+        verified_at=identity_verification.verified_at,
+        identity_issuing_country=identity_verification.identity_issuing_country,
+    )
+    if not updated:
+        identity_verification.save(force_insert=True)
+
+    invalidate_user_onboarding_state(user_id=user.id)
+
+
+def subscription_expiration_date(*, subscription: stripe.Subscription) -> date:
+    """The date a subscription has been paid up to (or ended on if it was cancelled early)."""
+    # Billing periods are per item since API version 2025-03-31 (basil) whereas payloads from
+    # older versions only have it on the subscription. Note that `items` has to be accessed as
+    # a key as the attribute is the `dict.items` method
+    item_period_ends = [
+        item["current_period_end"]
+        for item in subscription["items"].data
+        if item.get("current_period_end") is not None
+    ]
+    if item_period_ends:
+        period_end = max(item_period_ends)
+    elif subscription.get("current_period_end") is not None:
+        period_end = subscription["current_period_end"]
+    else:
+        raise ValueError(f"No current period end for subscription {subscription.id}")
+    if subscription.ended_at is not None:
+        period_end = min(period_end, subscription.ended_at)
+    return datetime.fromtimestamp(period_end, tz=UTC).date()
+
+
+def invoice_stripe_subscription_id(*, invoice: stripe.Invoice) -> str | None:
+    """The subscription an invoice is for, `None` if it isn't for one.
+
+    It's under `parent.subscription_details` since API version 2025-03-31 (basil) whereas
+    payloads from older versions (e.g. events for an older webhook endpoint) have
+    `subscription`, so neither can be relied on being there.
+    """
+    parent = invoice.get("parent")
+    subscription_details = parent.get("subscription_details") if parent else None
+    if subscription_details:
+        subscription = subscription_details.get("subscription")
+    else:
+        subscription = invoice.get("subscription")
+
+    if isinstance(subscription, stripe.StripeObject):
+        # Expanded
+        return subscription.id
+    return subscription or None
+
+
+def handle_invoice_paid_webhook_event(*, invoice: stripe.Invoice) -> None:
+    """Extend a subscription to the end of the period a paid invoice covers (e.g. renewals)."""
+    stripe_subscription_id = invoice_stripe_subscription_id(invoice=invoice)
+    if stripe_subscription_id is None:
+        logger.debug(f"Invoice {invoice.id} isn't for a subscription, ignoring")
+        return
+
+    period_ends = [line.period.end for line in invoice.lines.data]
+    if not period_ends:
+        raise ValueError(f"No line items in invoice {invoice.id}")
+    expiration_date = datetime.fromtimestamp(max(period_ends), tz=UTC).date()
+
+    subscription_obj = (
+        models.Subscription.objects.select_related("customer")
+        .filter(stripe_subscription_id=stripe_subscription_id)
+        .first()
+    )
+    if subscription_obj is None:
+        # The first invoice of a subscription can be paid before the checkout session completes
+        customer_obj = models.Customer.objects.filter(
+            stripe_customer_id=str(invoice.customer)
+        ).first()
+        if customer_obj is None:
+            logger.warning(f"No customer for invoice {invoice.id}, leaving it to checkout")
+            return
+        create_subscription(
+            customer=customer_obj,
+            stripe_subscription_id=stripe_subscription_id,
+            expiration_date=expiration_date,
         )
+        return
+
+    # Invoices aren't delivered in order so only ever extend
+    extended = models.Subscription.objects.filter(
+        id=subscription_obj.id, expiration_date__lt=expiration_date
+    ).update(expiration_date=expiration_date)
+    if extended:
+        logger.info(f"Extended subscription {stripe_subscription_id} to {expiration_date}")
+        invalidate_user_onboarding_state(user_id=subscription_obj.customer.user_id)
+
+
+def handle_subscription_changed_webhook_event(*, subscription: stripe.Subscription) -> None:
+    """Apply a subscription's current state, e.g. after a cancellation or plan change."""
+    if subscription.status in _UNPAID_SUBSCRIPTION_STATUSES:
+        return
+
+    _reconcile_subscription_batch(batch=[subscription], reconciliation=SubscriptionReconciliation())
+
+
+@dataclass
+class SubscriptionReconciliation:
+    created: int = 0
+    updated: int = 0
+    unchanged: int = 0
+    skipped: int = 0
+
+
+# Subscriptions that were never paid for don't grant access
+_UNPAID_SUBSCRIPTION_STATUSES = frozenset({"incomplete", "incomplete_expired"})
+
+
+def reconcile_subscriptions(*, batch_size: int = 500) -> SubscriptionReconciliation:
+    """Bring local subscriptions in line with Stripe, e.g. after missed webhooks.
+
+    Every subscription in Stripe is paged through and compared in batches. Each batch costs two
+    reads and at most one upsert however large it is.
+    """
+    reconciliation = SubscriptionReconciliation()
+    stripe_subscription_objs = get_stripe_client().subscriptions.list(
+        params={"status": "all", "limit": 100}
+    )
+
+    batch: list[stripe.Subscription] = []
+    for stripe_subscription_obj in stripe_subscription_objs.auto_paging_iter():
+        if stripe_subscription_obj.status in _UNPAID_SUBSCRIPTION_STATUSES:
+            reconciliation.skipped += 1
+            continue
+
+        batch.append(stripe_subscription_obj)
+        if len(batch) >= batch_size:
+            _reconcile_subscription_batch(batch=batch, reconciliation=reconciliation)
+            batch = []
+
+    if batch:
+        _reconcile_subscription_batch(batch=batch, reconciliation=reconciliation)
+
+    return reconciliation
 
-        # There's a chance we can get lots of verified outputs so wherever
-        # possible we'll update the user's information
 
-        dob: stripe.identity.VerificationSession.VerifiedOutputs.Dob | None = verified_outputs.get(
-            "dob"
+def _reconcile_subscription_batch(
+    *, batch: list[stripe.Subscription], reconciliation: SubscriptionReconciliation
+) -> None:
+    customers = {
+        customer_obj.stripe_customer_id: customer_obj
+        for customer_obj in models.Customer.objects.filter(
+            stripe_customer_id__in={
+                str(stripe_subscription_obj.customer) for stripe_subscription_obj in batch
+            }
         )
-        if dob is not None:
-            create_user_date_of_birth(
-                user_id=user_id,
-                day=dob.day,
-                month=dob.month,
-                year=dob.year,
-            )
+    }
+    expiration_dates = dict(
+        models.Subscription.objects.filter(
+            stripe_subscription_id__in=[
+                stripe_subscription_obj.id for stripe_subscription_obj in batch
+            ]
+        ).values_list("stripe_subscription_id", "expiration_date")
+    )
+
+    changed_subscriptions = []
+    for stripe_subscription_obj in batch:
+        customer_obj = customers.get(str(stripe_subscription_obj.customer))
+        if customer_obj is None:
+            # Not one of our users (e.g. created directly in the dashboard)
+            reconciliation.skipped += 1
+            continue
 
-        first_name: str | None = verified_outputs.get("first_name")
-        last_name: str | None = verified_outputs.get("last_name")
-        if first_name or last_name:
-            update_user_first_last_names(
-                user_id=user_id,
-                first_name=first_name,
-                last_name=last_name,
+        expiration_date = subscription_expiration_date(subscription=stripe_subscription_obj)
+        current_expiration_date = expiration_dates.get(stripe_subscription_obj.id)
+        if current_expiration_date == expiration_date:
+            reconciliation.unchanged += 1
+            continue
+
+        if current_expiration_date is None:
+            reconciliation.created += 1
+        else:
+            reconciliation.updated += 1
+        changed_subscriptions.append(
+            models.Subscription(
+                customer=customer_obj,
+                stripe_subscription_id=stripe_subscription_obj.id,
+                expiration_date=expiration_date,
             )
+        )
+
+    if not changed_subscriptions:
+        return
+
+    models.Subscription.objects.bulk_create(
+        changed_subscriptions,
+        update_conflicts=True,
+        unique_fields=["stripe_subscription_id"],
+        update_fields=["customer", "expiration_date"],
+    )
+    invalidate_users_onboarding_states(
+        user_ids=[subscription.customer.user_id for subscription in changed_subscriptions]
+    )
+
+
+def record_stripe_event(*, payload: dict[str, Any]) -> models.StripeEvent:
+    """Store a verified Stripe event in the inbox so it can be processed asynchronously.
+
+    Stripe retries deliveries so the insert is de-duplicated on the event ID.
+    """
+    stripe_event = models.StripeEvent(
+        stripe_event_id=payload["id"],
+        type=payload["type"],
+        payload=payload,
+        stripe_customer_id=stripe_event_customer_id(payload=payload),
+        stripe_created=datetime.fromtimestamp(payload["created"], tz=UTC),
+    )
+    stripe_event.full_clean(validate_unique=False)
+    models.StripeEvent.objects.bulk_create([stripe_event], ignore_conflicts=True)
+
+    return stripe_event
+
+
+def stripe_event_customer_id(*, payload: dict[str, Any]) -> str:
+    """The Stripe customer an event is about, blank if it isn't about a customer."""
+    obj = payload["data"]["object"]
+    if obj.get("object") == "customer":
+        return obj["id"]
+
+    customer = obj.get("customer") or obj.get("related_customer")
+    if isinstance(customer, dict):
+        # Expanded
+        customer = customer.get("id")
+    return customer or ""
+
+
+def _snapshot_event_objects(*, event: stripe.Event) -> QuerySet[Any] | None:
+    """The rows for the object a snapshot event carries, `None` for other events.
+
+    Snapshot events carry the full state of an object, applying an older one after a newer one
+    would roll it back. Other events (e.g. `invoice.paid`) only add to the state. Each object
+    records when the latest event applied to it was created, so that a newer event about one
+    object (e.g. the customer) doesn't make an older one about another (e.g. one of their
+    subscriptions) look stale.
+    """
+    if event.type in ("customer.created", "customer.updated", "customer.deleted"):
+        return models.Customer.objects.filter(stripe_customer_id=event.data.object.id)
+    if event.type.startswith("customer.subscription."):
+        return models.Subscription.objects.filter(stripe_subscription_id=event.data.object.id)
+    return None
+
+
+def process_stripe_event(*, stripe_event: models.StripeEvent) -> None:
+    event = stripe.Event.construct_from(stripe_event.payload, settings.STRIPE_SECRET_KEY)
+
+    snapshot_objects = None
+    if stripe_event.stripe_created is not None:
+        snapshot_objects = _snapshot_event_objects(event=event)
+    if (
+        snapshot_objects is not None
+        and snapshot_objects.filter(last_stripe_event_at__gt=stripe_event.stripe_created).exists()
+    ):
+        logger.info(f"Skipping stale Stripe event {stripe_event.stripe_event_id} ({event.type})")
+        return
+
+    if (
+        event.type == "checkout.session.completed"
+        or event.type == "checkout.session.async_payment_succeeded"
+    ):
+        checkout_session_obj: stripe.checkout.Session = event.data.object  # pyright: ignore
+        handle_checkout_session_completed(
+            checkout_session_id=checkout_session_obj.id, checkout_session=checkout_session_obj
+        )
+    elif event.type == "identity.verification_session.verified":
+        verification_session_obj: stripe.identity.VerificationSession = event.data.object  # pyright: ignore
+        handle_identity_verification_completed(
+            verification_session_id=verification_session_obj.id,
+            verification_session=verification_session_obj,
+        )
+    elif event.type == "customer.created" or event.type == "customer.updated":
+        customer_obj: stripe.Customer = event.data.object  # pyright: ignore
+        handle_customer_changed_webhook_event(customer=customer_obj)
+    elif event.type == "customer.deleted":
+        unindex_stripe_customer(stripe_customer_id=event.data.object.id)
+    elif event.type.startswith("price.") or event.type.startswith("product."):
+        # We're off the request path here so refresh rather than just invalidate
+        selectors.refresh_stripe_price_catalog()
+    elif event.type == "invoice.paid":
+        invoice_obj: stripe.Invoice = event.data.object  # pyright: ignore
+        handle_invoice_paid_webhook_event(invoice=invoice_obj)
+    elif event.type.startswith("customer.subscription."):
+        subscription_obj: stripe.Subscription = event.data.object  # pyright: ignore
+        handle_subscription_changed_webhook_event(subscription=subscription_obj)
+    else:
+        logger.warning(f"Unhandled event type: {event.type}")
+
+    if snapshot_objects is not None:
+        snapshot_objects.filter(
+            Q(last_stripe_event_at__isnull=True)
+            | Q(last_stripe_event_at__lt=stripe_event.stripe_created)
+        ).update(last_stripe_event_at=stripe_event.stripe_created)
+
 
-        phone: str | None = verified_outputs.get("phone")
-        if phone:
-            create_verified_phone_number(
-                user_id=user_id,
-                phone_number=phone,
-                verified_at=verification_datetime,
+def claim_stripe_events(*, limit: int, lease: timedelta) -> list[models.StripeEvent]:
+    """Claim up to `limit` due events for processing, in the order Stripe created them.
+
+    An event for a customer can't be claimed while an earlier event for the same customer is
+    waiting to be retried or being processed, so each customer's events apply in order.
+
+    Claimed events are leased rather than locked so events belonging to a worker that died
+    mid-way become claimable again once the lease runs out.
+    """
+    now = timezone.now()
+    open_stripe_events = models.StripeEvent.objects.filter(
+        Q(status=models.StripeEvent.Status.PENDING) | Q(status=models.StripeEvent.Status.PROCESSING)
+    )
+    earlier_undue_stripe_events = open_stripe_events.filter(
+        Q(stripe_created__lt=OuterRef("stripe_created"))
+        | Q(stripe_created=OuterRef("stripe_created"), id__lt=OuterRef("id")),
+        stripe_customer_id=OuterRef("stripe_customer_id"),
+        next_attempt_at__gt=now,
+    )
+    due_stripe_events = (
+        open_stripe_events.filter(next_attempt_at__lte=now)
+        .filter(Q(stripe_customer_id="") | ~Exists(earlier_undue_stripe_events))
+        .order_by("stripe_created", "id")[:limit]
+    )
+
+    claimed_stripe_events = []
+    for stripe_event in due_stripe_events:
+        # Conditional update so that only one worker can claim each event
+        claimed = models.StripeEvent.objects.filter(
+            id=stripe_event.id, next_attempt_at=stripe_event.next_attempt_at
+        ).update(
+            status=models.StripeEvent.Status.PROCESSING,
+            attempts=F("attempts") + 1,
+            next_attempt_at=now + lease,
+        )
+        if claimed:
+            stripe_event.status = models.StripeEvent.Status.PROCESSING
+            stripe_event.attempts += 1
+            stripe_event.next_attempt_at = now + lease
+            claimed_stripe_events.append(stripe_event)
+
+    return claimed_stripe_events
+
+
+def complete_stripe_event(
+    *,
+    stripe_event: models.StripeEvent,
+    error: Exception | None,
+    max_attempts: int,
+    backoff: timedelta,
+) -> models.StripeEvent:
+    now = timezone.now()
+    if error is None:
+        stripe_event.status = models.StripeEvent.Status.PROCESSED
+        stripe_event.processed_at = now
+        stripe_event.last_error = ""
+    elif stripe_event.attempts >= max_attempts:
+        stripe_event.status = models.StripeEvent.Status.FAILED
+        stripe_event.last_error = repr(error)
+    else:
+        # Exponential backoff: backoff, 2 * backoff, 4 * backoff, ...
+        stripe_event.status = models.StripeEvent.Status.PENDING
+        stripe_event.next_attempt_at = now + backoff * 2 ** (stripe_event.attempts - 1)
+        stripe_event.last_error = repr(error)
+
+    stripe_event.full_clean()
+    stripe_event.save(
+        update_fields=["status", "processed_at", "next_attempt_at", "last_error", "modified"]
+    )
+
+    return stripe_event
+
+
+def release_stripe_events(*, stripe_events: list[models.StripeEvent]) -> None:
+    """Hand claimed events back without counting the claim as an attempt."""
+    models.StripeEvent.objects.filter(
+        id__in=[stripe_event.id for stripe_event in stripe_events],
+        status=models.StripeEvent.Status.PROCESSING,
+    ).update(
+        status=models.StripeEvent.Status.PENDING,
+        attempts=F("attempts") - 1,
+        next_attempt_at=timezone.now(),
+    )
+
+
+def _process_claimed_stripe_events(
+    *, stripe_events: list[models.StripeEvent], max_attempts: int, backoff: timedelta
+) -> list[models.StripeEvent]:
+    """Process one customer's claimed events in order, stopping at the first failure."""
+    # Each worker thread has its own database connection which needs tidying up
+    close_old_connections()
+    try:
+        processed_stripe_events = []
+        for index, stripe_event in enumerate(stripe_events):
+            error = None
+            try:
+                process_stripe_event(stripe_event=stripe_event)
+            except Exception as e:
+                logger.exception(f"Error processing Stripe event {stripe_event.stripe_event_id}")
+                error = e
+
+            processed_stripe_events.append(
+                complete_stripe_event(
+                    stripe_event=stripe_event,
+                    error=error,
+                    max_attempts=max_attempts,
+                    backoff=backoff,
+                )
             )
+            if stripe_event.status == models.StripeEvent.Status.PENDING:
+                # Being retried later, the customer's later events have to wait for it
+                release_stripe_events(stripe_events=stripe_events[index + 1 :])
+                break
 
-        models.IdentityVerification.objects.update_or_create(
-            user=user_id,
-            stripe_identity_verification_session_id=verification_session_id,
-            defaults={
-                "verified_at": verification_datetime,
-                "identity_issuing_country": identity_issuing_country_code,
-            },
+        return processed_stripe_events
+    finally:
+        close_old_connections()
+
+
+def process_pending_stripe_events(
+    *,
+    executor: ThreadPoolExecutor,
+    batch_size: int,
+    max_attempts: int,
+    backoff: timedelta,
+    lease: timedelta,
+) -> list[models.StripeEvent]:
+    """Claim a batch of due events and process them on the executor.
+
+    Each customer's events are processed in order on one thread while different customers (and
+    events that aren't about a customer) are processed in parallel.
+
+    Returns the processed events (successfully or not).
+    """
+    claimed_stripe_events = claim_stripe_events(limit=batch_size, lease=lease)
+
+    partitions: dict[str, list[models.StripeEvent]] = {}
+    for stripe_event in claimed_stripe_events:
+        partition_key = stripe_event.stripe_customer_id or stripe_event.stripe_event_id
+        partitions.setdefault(partition_key, []).append(stripe_event)
+
+    return [
+        stripe_event
+        for processed_stripe_events in executor.map(
+            lambda stripe_events: _process_claimed_stripe_events(
+                stripe_events=stripe_events, max_attempts=max_attempts, backoff=backoff
+            ),
+            partitions.values(),
         )
+        for stripe_event in processed_stripe_events
+    ]
 
 
-def handle_invoice_paid_webhook_event(*, invoice: stripe.Invoice) -> None:
-    pass
+def prune_processed_webhooks(*, older_than: timedelta) -> int:
+    """Delete ledger entries older than Stripe's retry window so the table stays small."""
+    deleted_count, _ = models.ProcessedWebhook.objects.filter(
+        processed_at__lt=timezone.now() - older_than
+    ).delete()
+
+    return deleted_count
@@ -0,0 +1,25 @@
+from allauth.mfa.signals import authenticator_added, authenticator_removed
+from django.dispatch import receiver
+from django.http import HttpRequest
+
+from . import models, services
+from .middleware import MFA_ENABLED_SESSION_KEY
+
+
+@receiver(authenticator_added)
+@receiver(authenticator_removed)
+def invalidate_onboarding_state_on_mfa_change(sender, user: models.AgoraUser, **kwargs) -> None:
+    services.invalidate_user_onboarding_state(user_id=user.id)
+
+
+@receiver(authenticator_added)
+def remember_mfa_enabled_in_session(sender, request: HttpRequest | None, **kwargs) -> None:
+    if request is not None:
+        request.session[MFA_ENABLED_SESSION_KEY] = True
+
+
+@receiver(authenticator_removed)
+def forget_mfa_enabled_in_session(sender, request: HttpRequest | None, **kwargs) -> None:
+    # The middleware will re-check the (invalidated) onboarding state on the next request
+    if request is not None:
+        request.session.pop(MFA_ENABLED_SESSION_KEY, None)
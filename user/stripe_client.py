@@ -0,0 +1,387 @@
+"""
+A shared, instrumented Stripe client.
+
+All calls to the Stripe API should go through `get_stripe_client()` rather than the global
+`stripe` module state so that every gunicorn worker reuses a pool of keep-alive connections,
+each operation is bounded by a deadline (below the gunicorn timeout), latency and errors
+are recorded per endpoint and calls fail fast while Stripe is having an outage.
+"""
+
+import functools
+import os
+import re
+import threading
+import time
+from collections.abc import Callable, Iterator, Mapping
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import Any
+
+import requests
+import stripe
+from django.conf import settings
+from django.core.cache import cache
+from requests.adapters import HTTPAdapter
+
+from utils.deadline import remaining_request_budget
+
+from . import logger
+
+# Monotonic time by which the current Stripe operation (including retries) must finish
+_deadline: ContextVar[float | None] = ContextVar("stripe_deadline", default=None)
+
+# Time left to render a response after giving up on a Stripe call made during a request
+STRIPE_RESPONSE_MARGIN = 0.5
+
+# Replace object IDs (e.g. `cus_123`) in paths so metrics are grouped per endpoint
+_STRIPE_ID_RE = re.compile(r"/[a-z]+_[A-Za-z0-9_]+")
+
+
+class StripeDeadlineExceeded(stripe.APIConnectionError):
+    """Raised when there is no time left to make a request to Stripe."""
+
+
+class StripeUnavailable(stripe.APIConnectionError):
+    """Raised without calling Stripe while the circuit breaker is open."""
+
+
+@contextmanager
+def stripe_deadline(seconds: float) -> Iterator[None]:
+    """Bound all Stripe calls made within the block to `seconds` from now.
+
+    Nested deadlines can only shorten the current deadline, never extend it.
+    """
+    deadline = time.monotonic() + seconds
+    current_deadline = _deadline.get()
+    if current_deadline is not None:
+        deadline = min(deadline, current_deadline)
+
+    token = _deadline.set(deadline)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining_stripe_deadline() -> float | None:
+    """Seconds left before the current deadline or `None` if there isn't one."""
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+@dataclass
+class EndpointMetrics:
+    calls: int = 0
+    errors: int = 0
+    total_seconds: float = 0.0
+    max_seconds: float = 0.0
+
+    @property
+    def mean_seconds(self) -> float:
+        return self.total_seconds / self.calls if self.calls else 0.0
+
+
+class StripeMetrics:
+    """Per-process latency and error counters for each Stripe endpoint."""
+
+    def __init__(self) -> None:
+        self._endpoints: dict[str, EndpointMetrics] = {}
+        self._lock = threading.Lock()
+
+    def record(self, *, endpoint: str, seconds: float, error: bool) -> None:
+        with self._lock:
+            endpoint_metrics = self._endpoints.setdefault(endpoint, EndpointMetrics())
+            endpoint_metrics.calls += 1
+            endpoint_metrics.errors += int(error)
+            endpoint_metrics.total_seconds += seconds
+            endpoint_metrics.max_seconds = max(endpoint_metrics.max_seconds, seconds)
+
+    def snapshot(self) -> dict[str, EndpointMetrics]:
+        with self._lock:
+            return {
+                endpoint: EndpointMetrics(**vars(endpoint_metrics))
+                for endpoint, endpoint_metrics in self._endpoints.items()
+            }
+
+    def reset(self) -> None:
+        with self._lock:
+            self._endpoints.clear()
+
+
+metrics = StripeMetrics()
+
+
+class StripeCircuitBreaker:
+    """Circuit breaker for Stripe calls with its state shared by all workers through the cache.
+
+    - Closed: calls go through. `STRIPE_CIRCUIT_FAILURE_THRESHOLD` failures within
+      `STRIPE_CIRCUIT_FAILURE_WINDOW` seconds open the circuit.
+    - Open: calls fail immediately with `StripeUnavailable` for
+      `STRIPE_CIRCUIT_RESET_TIMEOUT` seconds.
+    - Half-open: a single probe call (across all workers) is let through, success closes the
+      circuit and failure opens it again.
+    """
+
+    def __init__(self, *, name: str):
+        self.failures_key = f"circuit:{name}:failures"
+        self.opened_at_key = f"circuit:{name}:opened_at"
+        self.probe_key = f"circuit:{name}:probe"
+
+    def open_for(self) -> float:
+        """Seconds until the circuit goes half-open, 0 if calls can be attempted."""
+        opened_at = cache.get(self.opened_at_key)
+        if opened_at is None:
+            return 0.0
+        return max(0.0, opened_at + settings.STRIPE_CIRCUIT_RESET_TIMEOUT - time.time())
+
+    def before_call(self) -> None:
+        opened_at = cache.get(self.opened_at_key)
+        if opened_at is None:
+            return
+
+        if time.time() - opened_at < settings.STRIPE_CIRCUIT_RESET_TIMEOUT:
+            raise StripeUnavailable("Stripe circuit breaker is open")
+
+        # Half-open, only one worker gets to find out if Stripe has recovered
+        if not cache.add(self.probe_key, True, timeout=settings.STRIPE_OPERATION_TIMEOUT):
+            raise StripeUnavailable("Stripe circuit breaker is half-open, waiting on a probe")
+        logger.info("Stripe circuit breaker is half-open, probing")
+
+    def record_success(self) -> None:
+        state = cache.get_many([self.failures_key, self.opened_at_key])
+        if not state:
+            return
+
+        if self.opened_at_key in state:
+            logger.info("Stripe circuit breaker closed")
+        self.reset()
+
+    def record_failure(self) -> None:
+        if cache.get(self.opened_at_key) is not None:
+            # A failed probe, stay open for another reset timeout
+            self._open()
+            return
+
+        cache.add(self.failures_key, 0, timeout=settings.STRIPE_CIRCUIT_FAILURE_WINDOW)
+        try:
+            failures = cache.incr(self.failures_key)
+        except ValueError:
+            # Expired between the add and incr, this is the first failure of a new window
+            cache.add(self.failures_key, 1, timeout=settings.STRIPE_CIRCUIT_FAILURE_WINDOW)
+            failures = 1
+
+        if failures >= settings.STRIPE_CIRCUIT_FAILURE_THRESHOLD:
+            self._open()
+
+    def _open(self) -> None:
+        logger.warning("Stripe circuit breaker opened")
+        cache.set(self.opened_at_key, time.time(), timeout=None)
+        cache.delete_many([self.failures_key, self.probe_key])
+
+    def reset(self) -> None:
+        cache.delete_many([self.failures_key, self.opened_at_key, self.probe_key])
+
+
+circuit_breaker = StripeCircuitBreaker(name="stripe")
+
+
+def _is_stripe_failure(status_code: int) -> bool:
+    # Client errors (e.g. validation) are our problem and say nothing about Stripe's health
+    return status_code >= 500 or status_code == 429
+
+
+def endpoint_name(method: str, url: str) -> str:
+    path = requests.utils.urlparse(url).path
+    return f"{method.upper()} {_STRIPE_ID_RE.sub('/{id}', path)}"
+
+
+class _DeadlineSession(requests.Session):
+    """Session that caps the timeout of each request at the time left before the deadline."""
+
+    def request(self, method, url, *args, timeout=None, **kwargs):  # type: ignore[override]
+        remaining = remaining_stripe_deadline()
+        if remaining is not None:
+            timeout = remaining if timeout is None else min(timeout, remaining)
+
+        return super().request(method, url, *args, timeout=timeout, **kwargs)
+
+
+class InstrumentedRequestsClient(stripe.RequestsClient):
+    """Requests based HTTP client with pooled connections, deadlines and metrics."""
+
+    def __init__(self, *, timeout: float, operation_timeout: float, pool_maxsize: int):
+        super().__init__(timeout=timeout)  # type: ignore[arg-type]
+        self.operation_timeout = operation_timeout
+        self.pool_maxsize = pool_maxsize
+
+    def _session_for_thread(self) -> requests.Session:
+        # RequestsClient keeps a session per thread, make sure it's one of ours
+        session = getattr(self._thread_local, "session", None)
+        if session is None:
+            session = _DeadlineSession()
+            session.mount("https://", HTTPAdapter(pool_maxsize=self.pool_maxsize))
+            session.mount("http://", HTTPAdapter(pool_maxsize=self.pool_maxsize))
+            self._thread_local.session = session
+        return session
+
+    def request(
+        self,
+        method: str,
+        url: str,
+        headers: Mapping[str, str] | None,
+        post_data: Any = None,
+    ) -> tuple[bytes, int, Mapping[str, str]]:
+        remaining = remaining_stripe_deadline()
+        if remaining is not None and remaining <= 0:
+            # Not retryable, there's no time left to retry in
+            raise StripeDeadlineExceeded("Deadline exceeded before calling Stripe")
+
+        self._session_for_thread()
+        return super().request(method, url, headers, post_data)
+
+    def _sleep_time_seconds(
+        self, num_retries: int, response: tuple[Any, Any, Mapping[str, str]] | None = None
+    ) -> float:
+        # Don't back off past the deadline
+        sleep_seconds = super()._sleep_time_seconds(num_retries, response)
+        remaining = remaining_stripe_deadline()
+        if remaining is not None:
+            sleep_seconds = max(0.0, min(sleep_seconds, remaining))
+        return sleep_seconds
+
+    def request_with_retries(
+        self,
+        method: str,
+        url: str,
+        headers: Mapping[str, str],
+        post_data: Any = None,
+        max_network_retries: int | None = None,
+        *,
+        _usage: list[str] | None = None,
+    ) -> tuple[str, int, Mapping[str, str]]:
+        endpoint = endpoint_name(method, url)
+        circuit_breaker.before_call()
+
+        start = time.monotonic()
+        error = True
+        try:
+            with stripe_deadline(self.operation_timeout):
+                response = super().request_with_retries(
+                    method, url, headers, post_data, max_network_retries, _usage=_usage
+                )
+        except stripe.APIConnectionError:
+            circuit_breaker.record_failure()
+            raise
+        else:
+            error = response[1] >= 400
+            if _is_stripe_failure(response[1]):
+                circuit_breaker.record_failure()
+            else:
+                circuit_breaker.record_success()
+            return response
+        finally:
+            seconds = time.monotonic() - start
+            metrics.record(endpoint=endpoint, seconds=seconds, error=error)
+            logger.debug(f"Stripe {endpoint} took {seconds * 1000:.0f}ms (error={error})")
+
+
+# Replaces `STRIPE_API_BASE` within `stripe_api_base`
+_api_base: str | None = None
+
+
+@contextmanager
+def stripe_api_base(base_url: str) -> Iterator[None]:
+    """Send the Stripe calls made within to another server (e.g. `utils.fake_stripe`).
+
+    For benchmarks and load tests, it applies to every thread of the process.
+    """
+    global _api_base
+    _api_base = base_url
+    _stripe_client_for_process.cache_clear()
+    try:
+        yield
+    finally:
+        _api_base = None
+        _stripe_client_for_process.cache_clear()
+
+
+@functools.cache
+def _stripe_client_for_process(pid: int) -> stripe.StripeClient:
+    logger.debug(f"Creating Stripe client for process {pid}")
+    return stripe.StripeClient(
+        api_key=settings.STRIPE_SECRET_KEY,
+        base_addresses={"api": _api_base or settings.STRIPE_API_BASE},
+        max_network_retries=settings.STRIPE_MAX_NETWORK_RETRIES,
+        http_client=InstrumentedRequestsClient(
+            timeout=settings.STRIPE_TIMEOUT,
+            operation_timeout=settings.STRIPE_OPERATION_TIMEOUT,
+            pool_maxsize=settings.STRIPE_CONNECTION_POOL_SIZE,
+        ),
+    )
+
+
+def get_stripe_client() -> stripe.StripeClient:
+    """Return the Stripe client for the current process.
+
+    Keyed on the process ID so that gunicorn workers never share connections with the master.
+    """
+    return _stripe_client_for_process(os.getpid())
+
+
+class _BoundedExecutor:
+    """Thread pool that won't queue more work than it has threads for.
+
+    Abandoned calls keep their thread until they hit their own deadline, so an unbounded
+    queue would only make later requests wait on Stripe calls nobody is waiting for.
+    """
+
+    def __init__(self, *, max_workers: int):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="stripe")
+        self._slots = threading.BoundedSemaphore(max_workers)
+
+    def submit[T](self, fn: Callable[[], T], *, timeout: float) -> Future[T]:
+        if not self._slots.acquire(timeout=timeout):
+            raise StripeDeadlineExceeded("No Stripe thread became free before the deadline")
+
+        future = self._executor.submit(fn)
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+
+@functools.cache
+def _stripe_executor_for_process(pid: int) -> _BoundedExecutor:
+    logger.debug(f"Creating Stripe executor for process {pid}")
+    return _BoundedExecutor(max_workers=settings.STRIPE_EXECUTOR_WORKERS)
+
+
+def call_stripe[T](func: Callable[[], T]) -> T:
+    """Make a blocking Stripe call off the calling thread, bounded by the request budget.
+
+    The call gets whatever is left of the request budget (less time to respond) or
+    `STRIPE_OPERATION_TIMEOUT` outside of a request. Raises `StripeDeadlineExceeded` when it
+    doesn't finish in time; the call itself is left to stop at its own deadline.
+    """
+    budget = settings.STRIPE_OPERATION_TIMEOUT
+    remaining = remaining_request_budget()
+    if remaining is not None:
+        budget = min(budget, remaining - STRIPE_RESPONSE_MARGIN)
+    if budget <= 0:
+        raise StripeDeadlineExceeded("No time left in the request to call Stripe")
+
+    deadline = time.monotonic() + budget
+
+    def call_with_deadline() -> T:
+        with stripe_deadline(deadline - time.monotonic()):
+            return func()
+
+    future = _stripe_executor_for_process(os.getpid()).submit(call_with_deadline, timeout=budget)
+    try:
+        return future.result(timeout=max(0.0, deadline - time.monotonic()))
+    except FutureTimeoutError as e:
+        future.cancel()
+        raise StripeDeadlineExceeded(f"Stripe call didn't finish within {budget:.1f}s") from e
@@ -0,0 +1,228 @@
+import threading
+import time
+from datetime import date, timedelta
+from typing import Any
+from unittest import mock
+
+import stripe
+from django.core.cache import cache
+from django.test import RequestFactory, TestCase, override_settings
+from django.utils import timezone
+
+from user import models, services
+
+from .utils.faker import fake_email
+from .utils.stripe import LOCAL_MEMORY_CACHES, use_fake_stripe
+
+LEDGER_PREFIX = "stripe:checkout_session_completed"
+
+
+@override_settings(CACHES=LOCAL_MEMORY_CACHES)
+class FulfillCheckoutSessionTestCase(TestCase):
+    def setUp(self) -> None:
+        cache.clear()
+        self.user = models.AgoraUser.objects.create_user(email=fake_email())
+
+    def fulfill(self, *, stripe_subscription_id: str = "sub_1") -> None:
+        services.fulfill_checkout_session(
+            checkout_session_id="cs_1",
+            user_id=self.user.id,
+            stripe_customer_id="cus_1",
+            stripe_price_ids=["price_1"],
+            stripe_subscription_id=stripe_subscription_id,
+            expiration_date=date(2100, 1, 1),
+        )
+
+    def test_records_subscription(self) -> None:
+        cache_key = services.checkout_session_cache_key(
+            user_id=self.user.id, stripe_price_id="price_1"
+        )
+        cache.set(cache_key, "checkout session")
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.fulfill()
+
+        subscription = models.Subscription.objects.get(customer__user=self.user)
+        self.assertEqual(subscription.customer.stripe_customer_id, "cus_1")
+        self.assertEqual(subscription.stripe_subscription_id, "sub_1")
+        self.assertEqual(subscription.expiration_date, date(2100, 1, 1))
+        self.assertTrue(
+            models.ProcessedWebhook.objects.filter(prefix=LEDGER_PREFIX, object_id="cs_1").exists()
+        )
+        # The completed session isn't handed out again
+        self.assertIsNone(cache.get(cache_key))
+
+    def test_ignores_redelivery(self) -> None:
+        self.fulfill()
+        self.fulfill(stripe_subscription_id="sub_2")
+
+        self.assertQuerySetEqual(
+            models.Subscription.objects.values_list("stripe_subscription_id", flat=True),
+            ["sub_1"],
+        )
+
+    def test_failure_isnt_recorded(self) -> None:
+        with (
+            mock.patch.object(services, "create_subscription", side_effect=ValueError("boom")),
+            self.assertRaises(ValueError),
+        ):
+            self.fulfill()
+
+        self.assertFalse(models.ProcessedWebhook.objects.exists())
+        self.assertFalse(models.Customer.objects.exists())
+
+        # So that a retry processes it
+        self.fulfill()
+        self.assertTrue(models.Subscription.objects.filter(customer__user=self.user).exists())
+
+    def test_prune_processed_webhooks(self) -> None:
+        self.fulfill()
+        old = models.ProcessedWebhook.objects.create(
+            prefix=LEDGER_PREFIX,
+            object_id="cs_old",
+            processed_at=timezone.now() - timedelta(days=10),
+        )
+
+        deleted_count = services.prune_processed_webhooks(older_than=timedelta(days=7))
+
+        self.assertEqual(deleted_count, 1)
+        self.assertFalse(models.ProcessedWebhook.objects.filter(id=old.id).exists())
+        self.assertTrue(models.ProcessedWebhook.objects.filter(object_id="cs_1").exists())
+
+
+@override_settings(CACHES=LOCAL_MEMORY_CACHES, STRIPE_MAX_NETWORK_RETRIES=0)
+class HandleCheckoutSessionCompletedTestCase(TestCase):
+    def setUp(self) -> None:
+        cache.clear()
+        self.fake_stripe = use_fake_stripe(self)
+        self.user = models.AgoraUser.objects.create_user(email=fake_email())
+
+    def checkout_session(self, **fields: Any) -> dict[str, Any]:
+        checkout_session = {
+            "id": "cs_1",
+            "object": "checkout.session",
+            "created": int(time.time()),
+            "status": "complete",
+            "payment_status": "paid",
+            "client_reference_id": str(self.user.id),
+            "customer": "cus_1",
+            "subscription": "sub_1",
+            **fields,
+        }
+        self.fake_stripe.seed(checkout_session)
+        return checkout_session
+
+    def test_fetches_line_items_and_subscription(self) -> None:
+        checkout_session = self.checkout_session()
+
+        services.handle_checkout_session_completed(
+            checkout_session_id="cs_1",
+            checkout_session=stripe.checkout.Session.construct_from(checkout_session, "sk_test"),
+        )
+
+        subscription = models.Subscription.objects.get(customer__user=self.user)
+        self.assertEqual(subscription.stripe_subscription_id, "sub_1")
+        # The fake's subscriptions are paid up for a year
+        self.assertGreater(subscription.expiration_date, timezone.now().date())
+        # One call to expand the session, nothing else was missing from the payload
+        self.assertEqual(self.fake_stripe.request_count, 1)
+
+    def test_retrieves_session_without_payload(self) -> None:
+        self.checkout_session()
+
+        services.handle_checkout_session_completed(checkout_session_id="cs_1")
+
+        self.assertTrue(models.Subscription.objects.filter(customer__user=self.user).exists())
+
+    def test_ignores_unpaid_session(self) -> None:
+        checkout_session = self.checkout_session(payment_status="unpaid")
+
+        services.handle_checkout_session_completed(
+            checkout_session_id="cs_1",
+            checkout_session=stripe.checkout.Session.construct_from(checkout_session, "sk_test"),
+        )
+
+        self.assertFalse(models.Subscription.objects.exists())
+        self.assertEqual(self.fake_stripe.request_count, 0)
+
+
+@override_settings(
+    CACHES=LOCAL_MEMORY_CACHES,
+    STRIPE_MAX_NETWORK_RETRIES=0,
+    # The success and cancel URLs link to the onboarding steps
+    ROOT_URLCONF="user.management.onboarding_urls",
+)
+class CreateCheckoutSessionTestCase(TestCase):
+    def setUp(self) -> None:
+        cache.clear()
+        self.fake_stripe = use_fake_stripe(self)
+        self.user = models.AgoraUser.objects.create_user(email=fake_email())
+        self.cache_key = services.checkout_session_cache_key(
+            user_id=self.user.id, stripe_price_id="price_1"
+        )
+
+    def create(self) -> stripe.checkout.Session:
+        request = RequestFactory().post("/onboarding/billing")
+        request.user = self.user
+        return services.create_stripe_checkout_session_for_subscription(
+            request=request,  # type: ignore[arg-type]
+            stripe_price_id="price_1",
+        )
+
+    def test_reuses_session(self) -> None:
+        checkout_session = self.create()
+        request_count = self.fake_stripe.request_count
+
+        self.assertEqual(self.create().id, checkout_session.id)
+        self.assertEqual(self.fake_stripe.request_count, request_count)
+        self.assertIsNone(cache.get(f"{self.cache_key}:lock"))
+
+    # Otherwise there's no time to wait outside of a request
+    @override_settings(REQUEST_TIME_BUDGET=10.0)
+    def test_waits_for_concurrent_request(self) -> None:
+        checkout_session = stripe.checkout.Session.construct_from(
+            {"id": "cs_elsewhere", "expires_at": int(time.time()) + 60 * 60}, "sk_test"
+        )
+        cache.add(f"{self.cache_key}:lock", True)
+
+        def create_elsewhere() -> None:
+            time.sleep(0.2)
+            cache.set(self.cache_key, checkout_session)
+
+        thread = threading.Thread(target=create_elsewhere)
+        thread.start()
+        self.addCleanup(thread.join)
+
+        self.assertEqual(self.create().id, "cs_elsewhere")
+        self.assertEqual(self.fake_stripe.request_count, 0)
+
+    def test_creates_same_session_after_waiting(self) -> None:
+        checkout_session = self.create()
+        # The other request is still going, it just hasn't cached the session yet
+        cache.delete(self.cache_key)
+        cache.add(f"{self.cache_key}:lock", True)
+
+        with (
+            override_settings(REQUEST_TIME_BUDGET=10.0),
+            mock.patch.object(services, "CHECKOUT_SESSION_WAIT", 0.1),
+        ):
+            self.assertEqual(self.create().id, checkout_session.id)
+        self.assertEqual(
+            [
+                obj
+                for obj in self.fake_stripe.objects.values()
+                if obj["object"] == "checkout.session"
+            ],
+            [self.fake_stripe.objects[checkout_session.id]],
+        )
+
+    def test_doesnt_reuse_expiring_session(self) -> None:
+        expiring_session = stripe.checkout.Session.construct_from(
+            {"id": "cs_expiring", "expires_at": int(time.time()) + 60}, "sk_test"
+        )
+        cache.set(self.cache_key, expiring_session)
+
+        checkout_session = self.create()
+
+        self.assertNotEqual(checkout_session.id, "cs_expiring")
+        self.assertEqual(cache.get(self.cache_key).id, checkout_session.id)
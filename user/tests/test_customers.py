@@ -0,0 +1,112 @@
+import stripe
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+
+from user import models, selectors, services
+
+from .utils.faker import fake_email
+from .utils.stripe import LOCAL_MEMORY_CACHES, use_fake_stripe
+
+
+@override_settings(CACHES=LOCAL_MEMORY_CACHES, STRIPE_MAX_NETWORK_RETRIES=0)
+class CreateStripeCustomerTestCase(TestCase):
+    def setUp(self) -> None:
+        cache.clear()
+        self.fake_stripe = use_fake_stripe(self)
+        self.user = models.AgoraUser.objects.create_user(email=fake_email())
+
+    def forget_customer(self) -> None:
+        # As if the first request's response was lost before anything was recorded
+        models.Customer.objects.all().delete()
+        models.StripeCustomerEmail.objects.all().delete()
+
+    def test_creates_customer(self) -> None:
+        customer = services.create_stripe_customer(user=self.user)
+
+        self.assertEqual(customer.user, self.user)
+        stripe_customer = self.fake_stripe.objects[customer.stripe_customer_id]
+        self.assertEqual(stripe_customer["email"], self.user.email)
+
+    def test_uses_indexed_customer(self) -> None:
+        services.index_stripe_customer(email=self.user.email, stripe_customer_id="cus_1")
+
+        customer = services.create_stripe_customer(user=self.user)
+
+        self.assertEqual(customer.stripe_customer_id, "cus_1")
+        self.assertEqual(self.fake_stripe.request_count, 0)
+
+    def test_indexes_created_customer(self) -> None:
+        customer = services.create_stripe_customer(user=self.user)
+
+        self.assertEqual(
+            selectors.stripe_customer_id_from_email(email=self.user.email),
+            customer.stripe_customer_id,
+        )
+
+    def test_retry_reuses_customer(self) -> None:
+        customer = services.create_stripe_customer(user=self.user)
+        self.forget_customer()
+
+        retried_customer = services.create_stripe_customer(user=self.user)
+
+        self.assertEqual(retried_customer.stripe_customer_id, customer.stripe_customer_id)
+        self.assertEqual(len(self.fake_stripe.objects), 1)
+
+    def test_changed_email_creates_customer(self) -> None:
+        customer = services.create_stripe_customer(user=self.user)
+        self.forget_customer()
+        self.user.email = fake_email()
+        self.user.save()
+
+        # Stripe would reject the previous key with a different email
+        changed_customer = services.create_stripe_customer(user=self.user)
+
+        self.assertNotEqual(changed_customer.stripe_customer_id, customer.stripe_customer_id)
+        stripe_customer = self.fake_stripe.objects[changed_customer.stripe_customer_id]
+        self.assertEqual(stripe_customer["email"], self.user.email)
+
+
+class StripeCustomerIndexTestCase(TestCase):
+    def customer_changed(self, **fields: str | None) -> None:
+        services.handle_customer_changed_webhook_event(
+            customer=stripe.Customer.construct_from(
+                {"id": "cus_1", "object": "customer", **fields}, "sk_test"
+            )
+        )
+
+    def test_normalizes_email(self) -> None:
+        services.index_stripe_customer(email=" Someone@Example.com", stripe_customer_id="cus_1")
+
+        self.assertEqual(
+            selectors.stripe_customer_id_from_email(email="someone@example.COM "), "cus_1"
+        )
+
+    def test_updates_existing_entry(self) -> None:
+        services.index_stripe_customer(email="someone@example.com", stripe_customer_id="cus_1")
+        services.index_stripe_customer(email="someone@example.com", stripe_customer_id="cus_2")
+
+        self.assertEqual(
+            selectors.stripe_customer_id_from_email(email="someone@example.com"), "cus_2"
+        )
+
+    def test_customer_email_changed(self) -> None:
+        self.customer_changed(email="before@example.com")
+        self.customer_changed(email="after@example.com")
+
+        self.assertIsNone(selectors.stripe_customer_id_from_email(email="before@example.com"))
+        self.assertEqual(
+            selectors.stripe_customer_id_from_email(email="after@example.com"), "cus_1"
+        )
+
+    def test_customer_email_removed(self) -> None:
+        self.customer_changed(email="someone@example.com")
+        self.customer_changed(email=None)
+
+        self.assertFalse(models.StripeCustomerEmail.objects.exists())
+
+    def test_customer_deleted(self) -> None:
+        self.customer_changed(email="someone@example.com")
+
+        services.unindex_stripe_customer(stripe_customer_id="cus_1")
+
+        self.assertIsNone(selectors.stripe_customer_id_from_email(email="someone@example.com"))
@@ -0,0 +1,203 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import UTC, datetime, timedelta
+from typing import Any
+
+import stripe
+from django.core.cache import cache
+from django.test import RequestFactory, TestCase, override_settings
+from django.utils import timezone
+
+from user import models, services
+
+from .utils.faker import fake_email
+from .utils.services import CustomerFactory, IdentityVerificationFactory
+from .utils.stripe import LOCAL_MEMORY_CACHES, use_fake_stripe
+
+
+@override_settings(CACHES=LOCAL_MEMORY_CACHES, STRIPE_MAX_NETWORK_RETRIES=0)
+class CreateIdentityVerificationSessionTestCase(TestCase):
+    def setUp(self) -> None:
+        cache.clear()
+        self.fake_stripe = use_fake_stripe(self)
+        self.user = models.AgoraUser.objects.create_user(email=fake_email())
+        CustomerFactory.create(user=self.user)
+
+    def create(self) -> stripe.identity.VerificationSession:
+        request = RequestFactory().get("/onboarding/identity")
+        request.user = models.AgoraUser.objects.get(id=self.user.id)
+        return services.create_stripe_identity_verification_session(
+            request=request  # type: ignore[arg-type]
+        )
+
+    def session_ids(self) -> list[str]:
+        return list(
+            models.IdentityVerification.objects.filter(user=self.user).values_list(
+                "stripe_identity_verification_session_id", flat=True
+            )
+        )
+
+    def test_creates_session(self) -> None:
+        verification_session = self.create()
+
+        self.assertEqual(verification_session.status, "requires_input")
+        self.assertEqual(self.session_ids(), [verification_session.id])
+
+    def test_reuses_open_session(self) -> None:
+        verification_session = self.create()
+
+        self.assertEqual(self.create().id, verification_session.id)
+        self.assertEqual(self.session_ids(), [verification_session.id])
+
+    def test_returns_submitted_session(self) -> None:
+        verification_session = self.create()
+        self.fake_stripe.objects[verification_session.id]["status"] = "processing"
+
+        submitted_session = self.create()
+
+        self.assertEqual(submitted_session.id, verification_session.id)
+        self.assertEqual(submitted_session.status, "processing")
+
+    def test_replaces_cancelled_session(self) -> None:
+        verification_session = self.create()
+        self.fake_stripe.objects[verification_session.id]["status"] = "canceled"
+
+        replacement_session = self.create()
+
+        self.assertNotEqual(replacement_session.id, verification_session.id)
+        self.assertEqual(self.session_ids(), [replacement_session.id])
+
+
+@override_settings(CACHES=LOCAL_MEMORY_CACHES, STRIPE_MAX_NETWORK_RETRIES=0)
+class CancelStaleIdentityVerificationsTestCase(TestCase):
+    def setUp(self) -> None:
+        cache.clear()
+        self.fake_stripe = use_fake_stripe(self)
+        self.user = models.AgoraUser.objects.create_user(email=fake_email())
+        self.executor = ThreadPoolExecutor(max_workers=2)
+        self.addCleanup(self.executor.shutdown)
+
+    def identity_verification(
+        self, session_id: str, *, age: timedelta, verified: bool = False, status: str | None = None
+    ) -> models.IdentityVerification:
+        identity_verification = IdentityVerificationFactory.create(
+            user=self.user,
+            stripe_identity_verification_session_id=session_id,
+            verified_at=timezone.now() if verified else None,
+        )
+        models.IdentityVerification.objects.filter(id=identity_verification.id).update(
+            created=timezone.now() - age
+        )
+        if status is not None:
+            self.fake_stripe.seed(
+                {"id": session_id, "object": "identity.verification_session", "status": status}
+            )
+        return identity_verification
+
+    def test_cancels_stale_sessions(self) -> None:
+        stale = timedelta(days=3)
+        self.identity_verification("vs_abandoned", age=stale, status="requires_input")
+        self.identity_verification("vs_missing", age=stale)
+        self.identity_verification("vs_verified", age=stale, verified=True, status="verified")
+        self.identity_verification("vs_recent", age=timedelta(hours=1), status="requires_input")
+
+        deleted_count = services.cancel_stale_identity_verifications(
+            executor=self.executor, batch_size=1
+        )
+
+        self.assertEqual(deleted_count, 2)
+        self.assertEqual(self.fake_stripe.objects["vs_abandoned"]["status"], "canceled")
+        self.assertEqual(self.fake_stripe.objects["vs_recent"]["status"], "requires_input")
+        self.assertQuerySetEqual(
+            models.IdentityVerification.objects.order_by(
+                "stripe_identity_verification_session_id"
+            ).values_list("stripe_identity_verification_session_id", flat=True),
+            ["vs_recent", "vs_verified"],
+        )
+
+    def test_keeps_rows_stripe_didnt_cancel(self) -> None:
+        self.identity_verification("vs_abandoned", age=timedelta(days=3), status="requires_input")
+        self.fake_stripe.failure_status = 500
+
+        with self.assertLogs("user", level="WARNING"):
+            deleted_count = services.cancel_stale_identity_verifications(executor=self.executor)
+
+        self.assertEqual(deleted_count, 0)
+        self.assertTrue(models.IdentityVerification.objects.exists())
+
+
+@override_settings(CACHES=LOCAL_MEMORY_CACHES)
+class ApplyVerifiedIdentityOutputsTestCase(TestCase):
+    verified_at = datetime(2025, 6, 1, tzinfo=UTC)
+
+    def setUp(self) -> None:
+        cache.clear()
+        self.user = models.AgoraUser.objects.create_user(email=fake_email())
+
+    def apply(self, **verified_outputs: Any) -> None:
+        services.apply_verified_identity_outputs(
+            verification_session_id="vs_1",
+            user_id=self.user.id,
+            verified_outputs=stripe.identity.VerificationSession.VerifiedOutputs.construct_from(
+                verified_outputs, "sk_test"
+            ),
+            verified_at=self.verified_at,
+        )
+
+    def test_updates_user(self) -> None:
+        IdentityVerificationFactory.create(
+            user=self.user,
+            stripe_identity_verification_session_id="vs_1",
+            verified_at=None,
+            identity_issuing_country="",
+        )
+
+        # The ledger check, loading the user and a statement or two per row (with savepoints)
+        with self.assertNumQueries(13):
+            self.apply(
+                first_name="Ada",
+                last_name="Lovelace",
+                dob={"day": 10, "month": 12, "year": 1815},
+                address={"country": "GB"},
+                phone="+442071838750",
+            )
+
+        user = models.AgoraUser.objects.get(id=self.user.id)
+        self.assertEqual((user.first_name, user.last_name), ("Ada", "Lovelace"))
+        date_of_birth = models.UserDateOfBirth.objects.get(user=user)
+        self.assertEqual(
+            (date_of_birth.day, date_of_birth.month, date_of_birth.year), (10, 12, 1815)
+        )
+        phone_number = models.UserPhoneNumber.objects.get(contact_scope__user=user)
+        self.assertEqual(phone_number.phone_number, services.STRIPE_IDENTITY_PHONE_NUMBER)
+        self.assertEqual(phone_number.country, "GB")
+        # The pending verification is completed rather than another one added
+        identity_verification = models.IdentityVerification.objects.get(user=user)
+        self.assertEqual(identity_verification.verified_at, self.verified_at)
+        self.assertEqual(identity_verification.identity_issuing_country, "GB")
+
+    def test_only_verified_outputs(self) -> None:
+        self.apply(first_name="Ada", last_name=None, dob=None, address=None, phone=None)
+
+        self.assertEqual(models.AgoraUser.objects.get(id=self.user.id).first_name, "Ada")
+        self.assertFalse(models.UserDateOfBirth.objects.exists())
+        self.assertFalse(models.UserPhoneNumber.objects.exists())
+        identity_verification = models.IdentityVerification.objects.get(user=self.user)
+        self.assertEqual(identity_verification.stripe_identity_verification_session_id, "vs_1")
+        self.assertEqual(identity_verification.identity_issuing_country, "")
+
+    def test_updates_existing_details(self) -> None:
+        self.apply(dob={"day": 1, "month": 1, "year": 1990}, phone="+442071838750")
+        models.ProcessedWebhook.objects.all().delete()
+
+        self.apply(dob={"day": 2, "month": 2, "year": 1990}, phone="+33142685300")
+
+        self.assertEqual(models.UserDateOfBirth.objects.get(user=self.user).day, 2)
+        self.assertEqual(models.UserPhoneNumber.objects.get().country, "FR")
+        self.assertEqual(models.IdentityVerification.objects.count(), 1)
+
+    def test_ignores_redelivery(self) -> None:
+        self.apply(first_name="Ada")
+
+        self.apply(first_name="Grace")
+
+        self.assertEqual(models.AgoraUser.objects.get(id=self.user.id).first_name, "Ada")
@@ -0,0 +1,54 @@
+from allauth.mfa.models import Authenticator
+from django.contrib.messages.storage import default_storage
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.cache import cache
+from django.http import HttpRequest, HttpResponse
+from django.test import RequestFactory, TestCase
+from django.urls import resolve
+
+from user import models, selectors
+from user.middleware import MFA_ENABLED_SESSION_KEY, AllUserRequire2FAMiddleware
+
+from .utils.faker import fake_email
+
+
+class AllUserRequire2FAMiddlewareTestCase(TestCase):
+    def setUp(self) -> None:
+        self.user = models.AgoraUser.objects.create_user(email=fake_email())
+        self.middleware = AllUserRequire2FAMiddleware(lambda request: HttpResponse())
+        self.session = SessionStore()
+
+    def tearDown(self) -> None:
+        self.clear_onboarding_state_cache()
+
+    def clear_onboarding_state_cache(self) -> None:
+        cache.delete(selectors.onboarding_state_generation_key(user_id=self.user.id))
+
+    def build_request(self) -> HttpRequest:
+        request = RequestFactory().get("/dashboard")
+        # A fresh instance each time so nothing is memoized between requests
+        request.user = models.AgoraUser.objects.get(id=self.user.id)
+        request.session = self.session
+        request._messages = default_storage(request)
+        request.resolver_match = resolve("/dashboard")
+        return request
+
+    def test_redirects_user_without_mfa(self) -> None:
+        response = self.middleware.process_view(self.build_request(), None, (), {})
+
+        assert response is not None
+        self.assertEqual(response.status_code, 302)
+        self.assertNotIn(MFA_ENABLED_SESSION_KEY, self.session)
+
+    def test_mfa_enabled_user_costs_no_queries(self) -> None:
+        Authenticator.objects.create(user=self.user, type=Authenticator.Type.TOTP, data={})
+
+        # The first request looks up the MFA status and remembers it in the session
+        self.assertIsNone(self.middleware.process_view(self.build_request(), None, (), {}))
+        self.assertTrue(self.session[MFA_ENABLED_SESSION_KEY])
+
+        # Even with a cold onboarding state cache the session flag is enough
+        self.clear_onboarding_state_cache()
+        request = self.build_request()
+        with self.assertNumQueries(0):
+            self.assertIsNone(self.middleware.process_view(request, None, (), {}))
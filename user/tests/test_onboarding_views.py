@@ -0,0 +1,59 @@
+from unittest import mock
+
+from allauth.mfa.models import Authenticator
+from django.conf import settings
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django_vite.core.asset_loader import DjangoViteAssetLoader
+
+from user import decorators, models, stripe_client
+
+from .utils.faker import fake_email
+from .utils.stripe import LOCAL_MEMORY_CACHES, use_fake_stripe
+
+
+@override_settings(
+    CACHES=LOCAL_MEMORY_CACHES,
+    STRIPE_MAX_NETWORK_RETRIES=0,
+    STRIPE_CIRCUIT_FAILURE_THRESHOLD=1,
+    STRIPE_CIRCUIT_RESET_TIMEOUT=60.0,
+    ROOT_URLCONF="user.management.onboarding_urls",
+    # Render pages without the built frontend or collected static files
+    DJANGO_VITE={"default": {"dev_mode": True}},
+    STORAGES={
+        **settings.STORAGES,
+        "staticfiles": {"BACKEND": "django.contrib.staticfiles.storage.StaticFilesStorage"},
+    },
+)
+class StripeUnavailableTestCase(TestCase):
+    def setUp(self) -> None:
+        cache.clear()
+        # It only reads its settings once
+        self.enterContext(mock.patch.object(DjangoViteAssetLoader, "_instance", None))
+        self.fake_stripe = use_fake_stripe(self)
+        user = models.AgoraUser.objects.create_user(email=fake_email())
+        Authenticator.objects.create(user=user, type=Authenticator.Type.TOTP, data={})
+        self.client.force_login(user)
+
+    def assertUnavailable(self, response, *, retry_after: int) -> None:
+        self.assertEqual(response.status_code, 503)
+        self.assertTemplateUsed(response, "user/onboarding/unavailable.html")
+        self.assertEqual(response["Retry-After"], str(retry_after))
+
+    def test_circuit_open(self) -> None:
+        with self.assertLogs(level="WARNING"), self.assertLogs("django.request", level="ERROR"):
+            stripe_client.circuit_breaker.record_failure()
+            billing_response = self.client.post("/onboarding/billing/", {"price": "price_1"})
+            identity_response = self.client.get("/onboarding/identity/")
+
+        self.assertUnavailable(billing_response, retry_after=60)
+        self.assertUnavailable(identity_response, retry_after=60)
+        self.assertEqual(self.fake_stripe.request_count, 0)
+
+    def test_stripe_unreachable(self) -> None:
+        self.fake_stripe.stop()
+
+        with self.assertLogs(level="WARNING"), self.assertLogs("django.request", level="ERROR"):
+            response = self.client.post("/onboarding/billing/", {"price": "price_1"})
+
+        self.assertUnavailable(response, retry_after=decorators.STRIPE_UNAVAILABLE_RETRY_AFTER)
@@ -0,0 +1,165 @@
+import time
+from datetime import date, timedelta
+from typing import Any
+
+from allauth.mfa.models import Authenticator
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from user import models, selectors
+from utils.cache import CachedValue
+
+from .utils.faker import fake_email
+from .utils.services import (
+    IdentityVerificationFactory,
+    SubscriptionFactory,
+    create_valid_subscription,
+)
+from .utils.stripe import LOCAL_MEMORY_CACHES, use_fake_stripe
+
+
+@override_settings(
+    CACHES={
+        "default": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+            "LOCATION": "user.tests.test_selectors",
+        }
+    }
+)
+class UserOnboardingStateTestCase(TestCase):
+    def setUp(self) -> None:
+        cache.clear()
+        self.user = models.AgoraUser.objects.create_user(email=fake_email())
+
+    def fresh_user(self) -> models.AgoraUser:
+        # Nothing memoized from a previous call
+        return models.AgoraUser.objects.get(id=self.user.id)
+
+    def test_loads_state_in_one_query(self) -> None:
+        Authenticator.objects.create(user=self.user, type=Authenticator.Type.TOTP, data={})
+        subscription = create_valid_subscription(user=self.user)
+        IdentityVerificationFactory.create(user=self.user, verified_at=None)
+        user = self.fresh_user()
+
+        with self.assertNumQueries(1):
+            onboarding_state = selectors._load_onboarding_state(user=user)
+
+        self.assertEqual(
+            onboarding_state,
+            selectors.OnboardingState(
+                mfa_enabled=True,
+                subscription_expiration_date=subscription.expiration_date.date(),
+                identity_verification_status=selectors.UserVerificationStatus.PENDING,
+            ),
+        )
+
+    def test_uses_latest_subscription(self) -> None:
+        customer = create_valid_subscription(user=self.user).customer
+        SubscriptionFactory.create(customer=customer, expiration_date=date(2000, 1, 1))
+
+        onboarding_state = selectors.user_onboarding_state(user=self.fresh_user())
+
+        self.assertTrue(onboarding_state.has_valid_subscription)
+
+    def test_expired_subscription_isnt_valid(self) -> None:
+        yesterday = timezone.now().date() - timedelta(days=1)
+        SubscriptionFactory.create(customer__user=self.user, expiration_date=yesterday)
+
+        onboarding_state = selectors.user_onboarding_state(user=self.fresh_user())
+
+        self.assertEqual(onboarding_state.subscription_expiration_date, yesterday)
+        self.assertFalse(onboarding_state.has_valid_subscription)
+
+    def test_memoized_on_user(self) -> None:
+        user = self.fresh_user()
+        onboarding_state = selectors.user_onboarding_state(user=user)
+        cache.clear()
+
+        with self.assertNumQueries(0):
+            self.assertIs(selectors.user_onboarding_state(user=user), onboarding_state)
+
+    def test_cached_between_requests(self) -> None:
+        selectors.user_onboarding_state(user=self.fresh_user())
+        user = self.fresh_user()
+
+        with self.assertNumQueries(0):
+            selectors.user_onboarding_state(user=user)
+
+    def test_next_onboarding_step(self) -> None:
+        def next_step() -> str | None:
+            step = selectors.next_onboarding_step_route(self.fresh_user())
+            # Each change is made directly so forget what was cached
+            cache.clear()
+            return step
+
+        self.assertEqual(next_step(), selectors.OnboardingStep.MFA)
+
+        Authenticator.objects.create(user=self.user, type=Authenticator.Type.TOTP, data={})
+        self.assertEqual(next_step(), selectors.OnboardingStep.BILLING)
+
+        create_valid_subscription(user=self.user)
+        self.assertEqual(next_step(), selectors.OnboardingStep.IDENTITY)
+
+        identity_verification = IdentityVerificationFactory.create(user=self.user, verified_at=None)
+        self.assertEqual(next_step(), selectors.OnboardingStep.IDENTITY_PENDING)
+
+        identity_verification.verified_at = timezone.now()
+        identity_verification.save()
+        self.assertIsNone(next_step())
+
+
+def build_price(*, lookup_key: str | None, unit_amount: int = 1000) -> dict[str, Any]:
+    return {
+        "id": f"price_{lookup_key}",
+        "object": "price",
+        "lookup_key": lookup_key,
+        "unit_amount": unit_amount,
+        "product": {"id": "prod_1", "object": "product", "name": "Membership"},
+    }
+
+
+@override_settings(CACHES=LOCAL_MEMORY_CACHES, STRIPE_MAX_NETWORK_RETRIES=0)
+class StripePriceCatalogTestCase(TestCase):
+    def setUp(self) -> None:
+        cache.clear()
+        self.fake_stripe = use_fake_stripe(self)
+        self.fake_stripe.prices = [
+            build_price(lookup_key="standard_annual"),
+            build_price(lookup_key=None),
+        ]
+
+    def test_fetches_prices_by_lookup_key(self) -> None:
+        stripe_price = selectors.stripe_price_details(lookup_key="standard_annual")
+
+        self.assertEqual(stripe_price.unit_amount, 1000)
+        self.assertEqual(list(selectors.stripe_price_catalog().prices), ["standard_annual"])
+
+    def test_cached(self) -> None:
+        selectors.stripe_price_catalog()
+
+        selectors.stripe_price_catalog()
+
+        self.assertEqual(self.fake_stripe.request_count, 1)
+
+    def test_unknown_lookup_key(self) -> None:
+        with self.assertRaises(ValueError):
+            selectors.stripe_price_details(lookup_key="missing")
+
+    def test_serves_stale_catalog_while_refreshing(self) -> None:
+        stale_catalog = selectors.refresh_stripe_price_catalog()
+        cache.set(
+            selectors.PRICE_CATALOG_CACHE_KEY,
+            CachedValue(value=stale_catalog, fresh_until=time.time() - 1, compute_time=0.01),
+        )
+        self.fake_stripe.prices = [build_price(lookup_key="standard_annual", unit_amount=2000)]
+
+        self.assertEqual(selectors.stripe_price_catalog(), stale_catalog)
+
+        # Refreshed in the background
+        deadline = time.monotonic() + 5
+        while selectors.stripe_price_catalog() == stale_catalog and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(
+            selectors.stripe_price_details(lookup_key="standard_annual").unit_amount, 2000
+        )
@@ -0,0 +1,81 @@
+import time
+
+import stripe
+from django.core.cache import cache
+from django.test import SimpleTestCase, override_settings
+
+from user import stripe_client
+from utils.fake_stripe import FakeStripe
+
+
+@override_settings(
+    # The circuit breaker's state lives in the cache, keep it to each test
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}},
+    STRIPE_MAX_NETWORK_RETRIES=0,
+    STRIPE_CIRCUIT_FAILURE_THRESHOLD=3,
+    STRIPE_CIRCUIT_FAILURE_WINDOW=10.0,
+    STRIPE_CIRCUIT_RESET_TIMEOUT=0.2,
+)
+class StripeCircuitBreakerTestCase(SimpleTestCase):
+    def setUp(self) -> None:
+        cache.clear()
+        self.fake_stripe = FakeStripe().start()
+        self.addCleanup(self.fake_stripe.stop)
+
+        settings_override = override_settings(STRIPE_API_BASE=self.fake_stripe.base_url)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        # A client pointed at the fake server
+        stripe_client._stripe_client_for_process.cache_clear()
+        self.addCleanup(stripe_client._stripe_client_for_process.cache_clear)
+        stripe_client.circuit_breaker.reset()
+        self.addCleanup(stripe_client.circuit_breaker.reset)
+
+    def create_customer(self) -> stripe.Customer:
+        return stripe_client.get_stripe_client().customers.create(
+            params={"email": "someone@example.com"}
+        )
+
+    def trip(self) -> None:
+        self.fake_stripe.failure_status = 500
+        for _ in range(3):
+            with self.assertRaises(stripe.APIError):
+                self.create_customer()
+
+    def test_opens_after_failures(self) -> None:
+        self.trip()
+
+        request_count = self.fake_stripe.request_count
+        with self.assertRaises(stripe_client.StripeUnavailable):
+            self.create_customer()
+        self.assertEqual(self.fake_stripe.request_count, request_count)
+        self.assertGreater(stripe_client.circuit_breaker.open_for(), 0)
+
+    def test_client_errors_dont_count(self) -> None:
+        for _ in range(5):
+            with self.assertRaises(stripe.InvalidRequestError):
+                stripe_client.get_stripe_client().customers.retrieve("cus_missing")
+
+        self.assertEqual(stripe_client.circuit_breaker.open_for(), 0)
+
+    def test_closes_after_successful_probe(self) -> None:
+        self.trip()
+        self.fake_stripe.failure_status = None
+        time.sleep(0.2)
+
+        self.assertTrue(self.create_customer().id.startswith("cus_"))
+        self.assertTrue(self.create_customer().id.startswith("cus_"))
+        self.assertEqual(stripe_client.circuit_breaker.open_for(), 0)
+
+    def test_reopens_after_failed_probe(self) -> None:
+        self.trip()
+        time.sleep(0.2)
+
+        with self.assertRaises(stripe.APIError):
+            self.create_customer()
+
+        request_count = self.fake_stripe.request_count
+        with self.assertRaises(stripe_client.StripeUnavailable):
+            self.create_customer()
+        self.assertEqual(self.fake_stripe.request_count, request_count)
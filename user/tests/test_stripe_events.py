@@ -0,0 +1,282 @@
+from datetime import UTC, date, datetime, timedelta
+from typing import Any
+from unittest import mock
+
+import stripe
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from user import models, services
+
+from .utils.faker import fake_email
+from .utils.services import CustomerFactory, SubscriptionFactory
+from .utils.stripe import LOCAL_MEMORY_CACHES
+
+LEASE = timedelta(minutes=5)
+BACKOFF = timedelta(seconds=5)
+
+
+def build_payload(
+    *, event_id: str, created: int, customer: str = "cus_1", type: str = "invoice.paid"
+) -> dict[str, Any]:
+    return {
+        "id": event_id,
+        "object": "event",
+        "type": type,
+        "created": created,
+        "data": {"object": {"id": f"in_{event_id}", "object": "invoice", "customer": customer}},
+    }
+
+
+class RecordStripeEventTestCase(TestCase):
+    def test_records_event(self) -> None:
+        services.record_stripe_event(payload=build_payload(event_id="evt_1", created=1_700_000_000))
+
+        stripe_event = models.StripeEvent.objects.get(stripe_event_id="evt_1")
+        self.assertEqual(stripe_event.type, "invoice.paid")
+        self.assertEqual(stripe_event.stripe_customer_id, "cus_1")
+        self.assertEqual(
+            stripe_event.stripe_created,
+            datetime.fromtimestamp(1_700_000_000, tz=UTC),
+        )
+        self.assertEqual(stripe_event.status, models.StripeEvent.Status.PENDING)
+
+    def test_ignores_redelivery(self) -> None:
+        payload = build_payload(event_id="evt_1", created=1_700_000_000)
+        services.record_stripe_event(payload=payload)
+        services.record_stripe_event(payload=payload)
+
+        self.assertEqual(models.StripeEvent.objects.count(), 1)
+
+
+class ClaimStripeEventsTestCase(TestCase):
+    def record(self, *, event_id: str, created: int, customer: str = "cus_1") -> None:
+        services.record_stripe_event(
+            payload=build_payload(event_id=event_id, created=created, customer=customer)
+        )
+
+    def claim(self, *, limit: int = 10) -> list[str]:
+        return [
+            stripe_event.stripe_event_id
+            for stripe_event in services.claim_stripe_events(limit=limit, lease=LEASE)
+        ]
+
+    def test_claims_in_created_order(self) -> None:
+        self.record(event_id="evt_2", created=1_700_000_002, customer="cus_2")
+        self.record(event_id="evt_1", created=1_700_000_001, customer="cus_1")
+
+        self.assertEqual(self.claim(), ["evt_1", "evt_2"])
+
+    def test_leases_claimed_events(self) -> None:
+        self.record(event_id="evt_1", created=1_700_000_001)
+
+        before = timezone.now()
+        self.assertEqual(self.claim(), ["evt_1"])
+        stripe_event = models.StripeEvent.objects.get(stripe_event_id="evt_1")
+        self.assertEqual(stripe_event.status, models.StripeEvent.Status.PROCESSING)
+        self.assertEqual(stripe_event.attempts, 1)
+        self.assertGreaterEqual(stripe_event.next_attempt_at, before + LEASE)
+
+        # Still leased
+        self.assertEqual(self.claim(), [])
+
+    def test_reclaims_after_lease_expires(self) -> None:
+        self.record(event_id="evt_1", created=1_700_000_001)
+        self.claim()
+
+        # The worker that claimed it died
+        models.StripeEvent.objects.update(next_attempt_at=timezone.now() - timedelta(seconds=1))
+
+        self.assertEqual(self.claim(), ["evt_1"])
+        self.assertEqual(models.StripeEvent.objects.get(stripe_event_id="evt_1").attempts, 2)
+
+    def test_earlier_event_for_customer_blocks_later_ones(self) -> None:
+        self.record(event_id="evt_1", created=1_700_000_001, customer="cus_1")
+        self.record(event_id="evt_2", created=1_700_000_002, customer="cus_1")
+        self.record(event_id="evt_3", created=1_700_000_003, customer="cus_2")
+
+        self.assertEqual(self.claim(limit=1), ["evt_1"])
+        # evt_2 waits for evt_1 but other customers' events don't
+        self.assertEqual(self.claim(), ["evt_3"])
+
+
+class CompleteStripeEventTestCase(TestCase):
+    def setUp(self) -> None:
+        services.record_stripe_event(payload=build_payload(event_id="evt_1", created=1_700_000_000))
+
+    def complete(self, *, error: Exception | None, max_attempts: int = 3) -> models.StripeEvent:
+        (stripe_event,) = services.claim_stripe_events(limit=1, lease=LEASE)
+        return services.complete_stripe_event(
+            stripe_event=stripe_event, error=error, max_attempts=max_attempts, backoff=BACKOFF
+        )
+
+    def test_marks_processed(self) -> None:
+        stripe_event = self.complete(error=None)
+
+        stripe_event.refresh_from_db()
+        self.assertEqual(stripe_event.status, models.StripeEvent.Status.PROCESSED)
+        self.assertIsNotNone(stripe_event.processed_at)
+        self.assertEqual(stripe_event.last_error, "")
+
+    def test_backs_off_exponentially(self) -> None:
+        for attempt in range(1, 3):
+            before = timezone.now()
+            stripe_event = self.complete(error=ValueError("boom"))
+
+            stripe_event.refresh_from_db()
+            self.assertEqual(stripe_event.status, models.StripeEvent.Status.PENDING)
+            self.assertEqual(stripe_event.attempts, attempt)
+            self.assertIn("boom", stripe_event.last_error)
+            delay = BACKOFF * 2 ** (attempt - 1)
+            self.assertGreaterEqual(stripe_event.next_attempt_at, before + delay)
+            self.assertLessEqual(stripe_event.next_attempt_at, timezone.now() + delay)
+
+            # Not claimable until the backoff is over
+            self.assertEqual(services.claim_stripe_events(limit=1, lease=LEASE), [])
+            models.StripeEvent.objects.update(next_attempt_at=timezone.now())
+
+    def test_fails_after_max_attempts(self) -> None:
+        self.complete(error=ValueError("boom"), max_attempts=2)
+        models.StripeEvent.objects.update(next_attempt_at=timezone.now())
+        stripe_event = self.complete(error=ValueError("boom"), max_attempts=2)
+
+        stripe_event.refresh_from_db()
+        self.assertEqual(stripe_event.status, models.StripeEvent.Status.FAILED)
+        self.assertEqual(stripe_event.attempts, 2)
+        self.assertEqual(services.claim_stripe_events(limit=1, lease=LEASE), [])
+
+
+@override_settings(CACHES=LOCAL_MEMORY_CACHES)
+class ProcessStripeEventTestCase(TestCase):
+    def setUp(self) -> None:
+        cache.clear()
+        user = models.AgoraUser.objects.create_user(email=fake_email())
+        self.customer = CustomerFactory.create(user=user, stripe_customer_id="cus_1")
+        SubscriptionFactory.create(
+            customer=self.customer, stripe_subscription_id="sub_1", expiration_date=date(2100, 1, 1)
+        )
+
+    def process(self, *, event_id: str, created: int, type: str, obj: dict[str, Any]) -> None:
+        stripe_event = services.record_stripe_event(
+            payload={
+                "id": event_id,
+                "object": "event",
+                "type": type,
+                "created": created,
+                "data": {"object": obj},
+            }
+        )
+        services.process_stripe_event(stripe_event=stripe_event)
+
+    def subscription_updated(self, *, event_id: str, created: int, period_end: datetime) -> None:
+        self.process(
+            event_id=event_id,
+            created=created,
+            type="customer.subscription.updated",
+            obj={
+                "id": "sub_1",
+                "object": "subscription",
+                "customer": "cus_1",
+                "status": "active",
+                "ended_at": None,
+                "items": {
+                    "object": "list",
+                    "url": "/v1/subscription_items",
+                    "data": [
+                        {
+                            "id": "si_1",
+                            "object": "subscription_item",
+                            "current_period_end": int(period_end.timestamp()),
+                        }
+                    ],
+                },
+            },
+        )
+
+    def expiration_date(self) -> date:
+        return models.Subscription.objects.get(stripe_subscription_id="sub_1").expiration_date
+
+    def test_applies_newer_snapshot(self) -> None:
+        self.subscription_updated(
+            event_id="evt_1", created=1_700_000_001, period_end=datetime(2100, 2, 1, tzinfo=UTC)
+        )
+        self.subscription_updated(
+            event_id="evt_2", created=1_700_000_002, period_end=datetime(2100, 3, 1, tzinfo=UTC)
+        )
+
+        self.assertEqual(self.expiration_date(), date(2100, 3, 1))
+        self.assertEqual(
+            models.Subscription.objects.get().last_stripe_event_at,
+            datetime.fromtimestamp(1_700_000_002, tz=UTC),
+        )
+
+    def test_skips_stale_snapshot(self) -> None:
+        self.subscription_updated(
+            event_id="evt_2", created=1_700_000_002, period_end=datetime(2100, 3, 1, tzinfo=UTC)
+        )
+
+        # Delivered late, it would roll the subscription back
+        with self.assertLogs("user", level="INFO"):
+            self.subscription_updated(
+                event_id="evt_1", created=1_700_000_001, period_end=datetime(2100, 2, 1, tzinfo=UTC)
+            )
+
+        self.assertEqual(self.expiration_date(), date(2100, 3, 1))
+        self.assertEqual(
+            models.Subscription.objects.get().last_stripe_event_at,
+            datetime.fromtimestamp(1_700_000_002, tz=UTC),
+        )
+
+    def test_other_objects_events_dont_make_snapshot_stale(self) -> None:
+        self.process(
+            event_id="evt_2",
+            created=1_700_000_002,
+            type="customer.updated",
+            obj={"id": "cus_1", "object": "customer", "email": "someone@example.com"},
+        )
+
+        self.subscription_updated(
+            event_id="evt_1", created=1_700_000_001, period_end=datetime(2100, 2, 1, tzinfo=UTC)
+        )
+
+        self.assertEqual(self.expiration_date(), date(2100, 2, 1))
+
+
+class ExpandMissingStripeFieldsTestCase(TestCase):
+    def setUp(self) -> None:
+        services._recently_fetched_stripe_objects.clear()
+        self.retrieve = mock.Mock(
+            side_effect=lambda id, expand: stripe.StripeObject.construct_from(
+                {"id": id, **{field: {"object": field} for field in expand}}, "sk_test"
+            )
+        )
+
+    def expand(self, payload: dict[str, Any]) -> stripe.StripeObject:
+        return services.expand_missing_stripe_fields(
+            stripe.StripeObject.construct_from(payload, "sk_test"),
+            fields=["line_items", "subscription"],
+            retrieve=self.retrieve,
+        )
+
+    def test_uses_payload_when_expanded(self) -> None:
+        payload = {"id": "cs_1", "line_items": {"object": "list"}, "subscription": {"id": "sub_1"}}
+
+        stripe_obj = self.expand(payload)
+
+        self.assertEqual(stripe_obj.subscription.id, "sub_1")
+        self.retrieve.assert_not_called()
+
+    def test_fetches_only_missing_fields(self) -> None:
+        stripe_obj = self.expand(
+            {"id": "cs_1", "line_items": {"object": "list"}, "subscription": "sub_1"}
+        )
+
+        self.assertEqual(stripe_obj.subscription.object, "subscription")
+        self.retrieve.assert_called_once_with("cs_1", ["subscription"])
+
+    def test_reuses_recent_fetch(self) -> None:
+        payload = {"id": "cs_1", "subscription": "sub_1"}
+
+        self.assertIs(self.expand(payload), self.expand(payload))
+        self.retrieve.assert_called_once_with("cs_1", ["line_items", "subscription"])
@@ -0,0 +1,175 @@
+from datetime import UTC, date, datetime
+from typing import Any
+
+import stripe
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+
+from user import models, services
+
+from .utils.faker import fake_email
+from .utils.services import CustomerFactory, SubscriptionFactory
+from .utils.stripe import LOCAL_MEMORY_CACHES, use_fake_stripe
+
+JAN_1 = int(datetime(2100, 1, 1, tzinfo=UTC).timestamp())
+FEB_1 = int(datetime(2100, 2, 1, tzinfo=UTC).timestamp())
+
+
+def build_subscription(
+    *,
+    subscription_id: str = "sub_1",
+    customer: str = "cus_1",
+    status: str = "active",
+    item_period_ends: list[int | None] | None = None,
+    **fields: Any,
+) -> dict[str, Any]:
+    items = [
+        {"id": f"si_{index}", "object": "subscription_item", "current_period_end": period_end}
+        for index, period_end in enumerate(item_period_ends or [])
+    ]
+    return {
+        "id": subscription_id,
+        "object": "subscription",
+        "customer": customer,
+        "status": status,
+        "ended_at": None,
+        "items": {"object": "list", "url": "/v1/subscription_items", "data": items},
+        **fields,
+    }
+
+
+def expiration_date(**fields: Any) -> date:
+    return services.subscription_expiration_date(
+        subscription=stripe.Subscription.construct_from(build_subscription(**fields), "sk_test")
+    )
+
+
+class SubscriptionExpirationDateTestCase(TestCase):
+    def test_latest_item_period_end(self) -> None:
+        self.assertEqual(expiration_date(item_period_ends=[JAN_1, FEB_1]), date(2100, 2, 1))
+
+    def test_subscription_period_end(self) -> None:
+        # Payloads from API versions before 2025-03-31
+        self.assertEqual(
+            expiration_date(item_period_ends=[None], current_period_end=JAN_1), date(2100, 1, 1)
+        )
+
+    def test_ended_early(self) -> None:
+        self.assertEqual(
+            expiration_date(item_period_ends=[FEB_1], ended_at=JAN_1), date(2100, 1, 1)
+        )
+
+    def test_no_period_end(self) -> None:
+        with self.assertRaises(ValueError):
+            expiration_date(item_period_ends=[])
+
+
+@override_settings(CACHES=LOCAL_MEMORY_CACHES)
+class HandleInvoicePaidTestCase(TestCase):
+    def setUp(self) -> None:
+        cache.clear()
+        user = models.AgoraUser.objects.create_user(email=fake_email())
+        self.customer = CustomerFactory.create(user=user, stripe_customer_id="cus_1")
+
+    def invoice_paid(self, **fields: Any) -> None:
+        invoice = {
+            "id": "in_1",
+            "object": "invoice",
+            "customer": "cus_1",
+            "lines": {
+                "object": "list",
+                "url": "/v1/invoices/in_1/lines",
+                "data": [{"id": "il_1", "object": "line_item", "period": {"end": FEB_1}}],
+            },
+            **fields,
+        }
+        services.handle_invoice_paid_webhook_event(
+            invoice=stripe.Invoice.construct_from(invoice, "sk_test")
+        )
+
+    def test_creates_subscription(self) -> None:
+        self.invoice_paid(parent={"subscription_details": {"subscription": "sub_1"}})
+
+        subscription = models.Subscription.objects.get(stripe_subscription_id="sub_1")
+        self.assertEqual(subscription.customer, self.customer)
+        self.assertEqual(subscription.expiration_date, date(2100, 2, 1))
+
+    def test_extends_subscription(self) -> None:
+        # Payloads from API versions before 2025-03-31
+        SubscriptionFactory.create(
+            customer=self.customer, stripe_subscription_id="sub_1", expiration_date=date(2100, 1, 1)
+        )
+
+        self.invoice_paid(subscription="sub_1")
+
+        subscription = models.Subscription.objects.get(stripe_subscription_id="sub_1")
+        self.assertEqual(subscription.expiration_date, date(2100, 2, 1))
+
+    def test_doesnt_shorten_subscription(self) -> None:
+        SubscriptionFactory.create(
+            customer=self.customer, stripe_subscription_id="sub_1", expiration_date=date(2100, 3, 1)
+        )
+
+        self.invoice_paid(subscription="sub_1")
+
+        subscription = models.Subscription.objects.get(stripe_subscription_id="sub_1")
+        self.assertEqual(subscription.expiration_date, date(2100, 3, 1))
+
+    def test_ignores_invoice_without_subscription(self) -> None:
+        self.invoice_paid(parent=None)
+
+        self.assertFalse(models.Subscription.objects.exists())
+
+
+@override_settings(CACHES=LOCAL_MEMORY_CACHES, STRIPE_MAX_NETWORK_RETRIES=0)
+class ReconcileSubscriptionsTestCase(TestCase):
+    def setUp(self) -> None:
+        cache.clear()
+        self.fake_stripe = use_fake_stripe(self)
+        user = models.AgoraUser.objects.create_user(email=fake_email())
+        self.customer = CustomerFactory.create(user=user, stripe_customer_id="cus_1")
+
+    def test_reconciles(self) -> None:
+        SubscriptionFactory.create(
+            customer=self.customer, stripe_subscription_id="sub_1", expiration_date=date(2100, 1, 1)
+        )
+        SubscriptionFactory.create(
+            customer=self.customer, stripe_subscription_id="sub_2", expiration_date=date(2100, 1, 1)
+        )
+        self.fake_stripe.subscriptions = [
+            build_subscription(subscription_id="sub_1", item_period_ends=[FEB_1]),
+            build_subscription(subscription_id="sub_2", item_period_ends=[JAN_1]),
+            build_subscription(subscription_id="sub_3", item_period_ends=[FEB_1]),
+            build_subscription(subscription_id="sub_4", customer="cus_elsewhere"),
+            build_subscription(subscription_id="sub_5", status="incomplete"),
+        ]
+
+        # Two reads and an upsert for the batch
+        with self.assertNumQueries(3):
+            reconciliation = services.reconcile_subscriptions()
+
+        self.assertEqual(
+            reconciliation,
+            services.SubscriptionReconciliation(created=1, updated=1, unchanged=1, skipped=2),
+        )
+        self.assertEqual(
+            dict(
+                models.Subscription.objects.values_list("stripe_subscription_id", "expiration_date")
+            ),
+            {
+                "sub_1": date(2100, 2, 1),
+                "sub_2": date(2100, 1, 1),
+                "sub_3": date(2100, 2, 1),
+            },
+        )
+
+    def test_reconciles_in_batches(self) -> None:
+        self.fake_stripe.subscriptions = [
+            build_subscription(subscription_id=f"sub_{index}", item_period_ends=[JAN_1])
+            for index in range(3)
+        ]
+
+        reconciliation = services.reconcile_subscriptions(batch_size=2)
+
+        self.assertEqual(reconciliation.created, 3)
+        self.assertEqual(models.Subscription.objects.count(), 3)
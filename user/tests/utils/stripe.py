@@ -0,0 +1,21 @@
+from unittest import TestCase
+
+from user import services, stripe_client
+from utils.fake_stripe import FakeStripe
+
+# The Stripe circuit breaker's state lives in the cache, `override_settings(CACHES=...)` keeps
+# it (and anything else cached) to each test
+LOCAL_MEMORY_CACHES = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+
+
+def use_fake_stripe(test_case: TestCase) -> FakeStripe:
+    """Send the Stripe calls made for the rest of the test to a fake Stripe server."""
+    fake_stripe = FakeStripe().start()
+    test_case.addCleanup(fake_stripe.stop)
+    test_case.enterContext(stripe_client.stripe_api_base(fake_stripe.base_url))
+    stripe_client.circuit_breaker.reset()
+    test_case.addCleanup(stripe_client.circuit_breaker.reset)
+    # Objects fetched from another test's fake would stand in for this one's
+    services._recently_fetched_stripe_objects.clear()
+    test_case.addCleanup(services._recently_fetched_stripe_objects.clear)
+    return fake_stripe
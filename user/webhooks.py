@@ -1,3 +1,5 @@
+import json
+
 import stripe
 from django.conf import settings
 from django.http import HttpRequest
@@ -49,19 +51,8 @@ def stripe_webhook(request: HttpRequest):
         logger.error("Event is None (for unknown reasons)")
         return 400, {}
 
-    if (
-        event.type == "checkout.session.completed"
-        or event.type == "checkout.session.async_payment_succeeded"
-    ):
-        services.handle_checkout_session_completed(checkout_session_id=event.data.object.id)
-    elif event.type == "identity.verification_session.verified":
-        services.handle_identity_verification_completed(
-            verification_session_id=event.data.object.id
-        )
-    elif event.type == "invoice.paid":
-        invoice_obj: stripe.Invoice = event.data.object  # pyright: ignore
-        services.handle_invoice_paid_webhook_event(invoice=invoice_obj)
-    else:
-        logger.warning(f"Unhandled event type: {event.type}")
+    # Processing happens out of band (see the `process_stripe_events` command) so we can
+    # acknowledge the event straight away
+    services.record_stripe_event(payload=json.loads(payload))
 
     return 200, {}
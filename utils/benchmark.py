@@ -0,0 +1,40 @@
+import statistics
+from dataclasses import dataclass
+
+
+@dataclass(frozen=True, slots=True)
+class LatencySummary:
+    """Latency percentiles (in seconds) of a benchmark run."""
+
+    count: int
+    mean: float
+    p50: float
+    p95: float
+    p99: float
+    max: float
+
+    def __str__(self) -> str:
+        return (
+            f"n={self.count} mean={self.mean * 1000:.1f}ms p50={self.p50 * 1000:.1f}ms "
+            f"p95={self.p95 * 1000:.1f}ms p99={self.p99 * 1000:.1f}ms max={self.max * 1000:.1f}ms"
+        )
+
+
+def summarize_latencies(latencies: list[float]) -> LatencySummary:
+    if not latencies:
+        return LatencySummary(count=0, mean=0.0, p50=0.0, p95=0.0, p99=0.0, max=0.0)
+    if len(latencies) == 1:
+        (latency,) = latencies
+        return LatencySummary(
+            count=1, mean=latency, p50=latency, p95=latency, p99=latency, max=latency
+        )
+
+    percentiles = statistics.quantiles(latencies, n=100, method="inclusive")
+    return LatencySummary(
+        count=len(latencies),
+        mean=statistics.fmean(latencies),
+        p50=percentiles[49],
+        p95=percentiles[94],
+        p99=percentiles[98],
+        max=max(latencies),
+    )
@@ -0,0 +1,136 @@
+import logging
+import math
+import random
+import threading
+import time
+from collections.abc import Callable
+from dataclasses import dataclass
+
+from django.core.cache import cache
+
+from utils.deadline import remaining_request_budget
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True, slots=True)
+class CachedValue[T]:
+    """A value stored by `get_or_compute` along with when it should be recomputed."""
+
+    value: T
+    fresh_until: float
+    # Seconds it took to compute, the longer it takes the earlier it's refreshed
+    compute_time: float
+
+    def should_refresh(self, *, beta: float) -> bool:
+        # Probabilistic early expiration ("XFetch"): each read is a little more likely to
+        # refresh the closer the value is to going stale, so one request (rather than all of
+        # them at once) recomputes it
+        early_by = -self.compute_time * beta * math.log(1 - random.random())
+        return time.time() + early_by >= self.fresh_until
+
+
+def _lock_key(key: str) -> str:
+    # Not under the key's own prefix, so taking the lock doesn't count as changing it
+    return f"lock:{key}"
+
+
+def _cached_value(key: str, *, version: int | None) -> CachedValue | None:
+    cached_value = cache.get(key, version=version)
+    # Anything else was stored by something other than `get_or_compute`
+    return cached_value if isinstance(cached_value, CachedValue) else None
+
+
+def refresh[T](
+    key: str,
+    compute: Callable[[], T],
+    *,
+    timeout: float,
+    stale_for: float = 0,
+    version: int | None = None,
+) -> T:
+    """Compute the value and store it in the cache for `get_or_compute` to serve."""
+    start = time.monotonic()
+    value = compute()
+    compute_time = time.monotonic() - start
+
+    cache.set(
+        key,
+        CachedValue(value=value, fresh_until=time.time() + timeout, compute_time=compute_time),
+        timeout=math.ceil(timeout + stale_for),
+        version=version,
+    )
+    return value
+
+
+def get_or_compute[T](
+    key: str,
+    compute: Callable[[], T],
+    *,
+    timeout: float,
+    stale_for: float = 0,
+    version: int | None = None,
+    beta: float = 1.0,
+    lock_timeout: float = 60,
+    compute_wait: float = 0,
+    refresh_in_background: bool = False,
+) -> T:
+    """Return the cached value for `key`, computing it if needed without a stampede.
+
+    - Only the request holding the key's lock (taken with `cache.add`) computes the value,
+      others serve the stale copy kept for `stale_for` seconds after `timeout`. When there's
+      no copy at all they compute it too, after waiting up to `compute_wait` seconds for it
+      to appear (worth it when computing is slow or rate limited, e.g. calls Stripe).
+    - The value is recomputed a little before it goes stale (see `CachedValue.should_refresh`).
+    - If computing fails the stale copy is served instead.
+    - With `refresh_in_background` the stale copy is served straight away and the value is
+      recomputed on a separate thread.
+    """
+    cached_value: CachedValue[T] | None = _cached_value(key, version=version)
+    if cached_value is not None and not cached_value.should_refresh(beta=beta):
+        return cached_value.value
+
+    lock_key = _lock_key(key)
+    if not cache.add(lock_key, True, timeout=math.ceil(lock_timeout)):
+        # Someone else is computing it
+        if cached_value is not None:
+            return cached_value.value
+
+        wait = compute_wait
+        remaining = remaining_request_budget()
+        if remaining is not None:
+            # Leave time to compute it ourselves
+            wait = min(wait, remaining / 2)
+        wait_until = time.monotonic() + wait
+        while time.monotonic() < wait_until:
+            time.sleep(0.05)
+            cached_value = _cached_value(key, version=version)
+            if cached_value is not None:
+                return cached_value.value
+        return refresh(key, compute, timeout=timeout, stale_for=stale_for, version=version)
+
+    def locked_refresh() -> T:
+        try:
+            return refresh(key, compute, timeout=timeout, stale_for=stale_for, version=version)
+        finally:
+            cache.delete(lock_key)
+
+    if cached_value is None:
+        return locked_refresh()
+
+    if refresh_in_background:
+
+        def background_refresh() -> None:
+            try:
+                locked_refresh()
+            except Exception:
+                logger.exception(f"Error refreshing {key} in the background")
+
+        threading.Thread(target=background_refresh, name=f"refresh {key}", daemon=True).start()
+        return cached_value.value
+
+    try:
+        return locked_refresh()
+    except Exception:
+        logger.exception(f"Error refreshing {key}, serving the stale value")
+        return cached_value.value
@@ -0,0 +1,449 @@
+import copy
+import math
+import os
+import pickle
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Any, cast
+
+from diskcache import Cache, DjangoCache, FanoutCache, Timeout
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+
+from utils.lru import LRUCache
+
+_MISSING = object()
+
+# Upper bounds (in seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, math.inf)
+COUNTERS = ("hits", "local_hits", "misses", "timeouts", "sets", "deletes")
+OPERATIONS = ("get", "set", "delete")
+# Keys are grouped by their first parts, anything beyond this many prefixes is "other"
+MAX_PREFIXES = 100
+
+
+def key_prefix(key: Any, *, depth: int) -> str:
+    """The first `depth` colon separated parts of a key, e.g. `stripe:price`."""
+    if not isinstance(key, str) or ":" not in key:
+        return "other"
+    return ":".join(key.split(":", depth)[:depth])
+
+
+def _empty_prefix_metrics() -> dict[str, Any]:
+    return dict.fromkeys(COUNTERS, 0) | {
+        "latency": {operation: [0] * len(LATENCY_BUCKETS) for operation in OPERATIONS}
+    }
+
+
+def _merge_prefix_metrics(into: dict[str, Any], prefix_metrics: dict[str, Any]) -> None:
+    for counter in COUNTERS:
+        into[counter] += prefix_metrics.get(counter, 0)
+    for operation, counts in prefix_metrics.get("latency", {}).items():
+        if operation in into["latency"] and len(counts) == len(LATENCY_BUCKETS):
+            into["latency"][operation] = [
+                total + count
+                for total, count in zip(into["latency"][operation], counts, strict=True)
+            ]
+
+
+def _percentile(counts: list[int], q: float) -> float | None:
+    """Upper bound of the bucket the `q` quantile falls in (the last finite bound if it's over)."""
+    total = sum(counts)
+    if not total:
+        return None
+    running = 0
+    for bound, count in zip(LATENCY_BUCKETS, counts, strict=True):
+        running += count
+        if running >= q * total:
+            return min(bound, LATENCY_BUCKETS[-2])
+    return LATENCY_BUCKETS[-2]
+
+
+class CacheMetrics:
+    """Hit, miss, timeout, set and delete counts and latency histograms per key prefix.
+
+    Each process counts in memory and writes its totals to a diskcache store shared by all
+    processes at most every `flush_interval` seconds, `summary` adds them up. A process's
+    totals are kept for `retention` seconds after its last write.
+    """
+
+    def __init__(
+        self, *, store: Cache, key_depth: int, flush_interval: float, retention: float
+    ) -> None:
+        self.store = store
+        self.key_depth = key_depth
+        self.flush_interval = flush_interval
+        self.retention = retention
+        self._lock = threading.Lock()
+        self._start()
+
+    def _start(self) -> None:
+        self._pid = os.getpid()
+        self._worker_key = f"worker:{socket.gethostname()}:{self._pid}:{uuid.uuid4().hex[:8]}"
+        self._prefixes: dict[str, dict[str, Any]] = {}
+        self._reset_token: str | None = None
+        self._flushed_at = time.monotonic()
+
+    def record(
+        self,
+        key: Any,
+        *,
+        counter: str | None = None,
+        operation: str | None = None,
+        seconds: float = 0.0,
+    ) -> None:
+        prefix = key_prefix(key, depth=self.key_depth)
+        with self._lock:
+            if os.getpid() != self._pid:
+                # A forked worker mustn't report its parent's numbers as its own
+                self._start()
+
+            prefix_metrics = self._prefixes.get(prefix)
+            if prefix_metrics is None:
+                if len(self._prefixes) >= MAX_PREFIXES:
+                    prefix = "other"
+                prefix_metrics = self._prefixes.setdefault(prefix, _empty_prefix_metrics())
+            if counter is not None:
+                prefix_metrics[counter] += 1
+            if operation is not None:
+                bucket = next(
+                    index for index, bound in enumerate(LATENCY_BUCKETS) if seconds <= bound
+                )
+                prefix_metrics["latency"][operation][bucket] += 1
+
+            flush = time.monotonic() - self._flushed_at >= self.flush_interval
+            if flush:
+                self._flushed_at = time.monotonic()
+        if flush:
+            self.flush(retry=False)
+
+    def flush(self, *, retry: bool = True) -> None:
+        """Write this process's totals to the shared store."""
+        try:
+            reset_token = self.store.get("reset", retry=retry)
+            with self._lock:
+                if reset_token != self._reset_token:
+                    # Someone reset the metrics since we last wrote ours
+                    self._reset_token = reset_token
+                    self._prefixes.clear()
+                prefixes = copy.deepcopy(self._prefixes)
+            self.store.set(
+                self._worker_key,
+                {"flushed_at": time.time(), "prefixes": prefixes},
+                expire=self.retention,
+                retry=retry,
+            )
+        except (Timeout, sqlite3.OperationalError):
+            # Not worth slowing a request down for, the totals are written next time
+            pass
+
+    def summary(self) -> dict[str, Any]:
+        """Totals of all processes per prefix, with hit rates and latency percentiles."""
+        self.flush()
+
+        workers = 0
+        totals: dict[str, dict[str, Any]] = {}
+        for store_key in list(self.store.iterkeys()):
+            if not str(store_key).startswith("worker:"):
+                continue
+            worker_metrics = cast(dict[str, Any] | None, self.store.get(store_key, retry=True))
+            if worker_metrics is None:
+                continue
+            workers += 1
+            for prefix, prefix_metrics in worker_metrics["prefixes"].items():
+                _merge_prefix_metrics(
+                    totals.setdefault(prefix, _empty_prefix_metrics()), prefix_metrics
+                )
+
+        prefixes = {}
+        for prefix, prefix_metrics in sorted(totals.items()):
+            reads = sum(
+                prefix_metrics[counter] for counter in ("hits", "local_hits", "misses", "timeouts")
+            )
+            prefixes[prefix] = {counter: prefix_metrics[counter] for counter in COUNTERS} | {
+                "hit_rate": (
+                    (prefix_metrics["hits"] + prefix_metrics["local_hits"]) / reads
+                    if reads
+                    else None
+                ),
+                "latency": {
+                    operation: {
+                        "count": sum(counts),
+                        "p50": _percentile(counts, 0.5),
+                        "p95": _percentile(counts, 0.95),
+                        "p99": _percentile(counts, 0.99),
+                        "buckets": dict(
+                            zip([str(bound) for bound in LATENCY_BUCKETS], counts, strict=True)
+                        ),
+                    }
+                    for operation, counts in prefix_metrics["latency"].items()
+                },
+            }
+        return {"workers": workers, "prefixes": prefixes}
+
+    def reset(self) -> None:
+        """Start counting from zero in every process."""
+        self.store.clear(retry=True)
+        self.store.set("reset", uuid.uuid4().hex, retry=True)
+        with self._lock:
+            self._prefixes.clear()
+
+
+class _FanoutCache(FanoutCache):
+    """FanoutCache whose `get` raises `Timeout` rather than pretending the key is missing."""
+
+    def get(self, key, default=None, read=False, expire_time=False, tag=False, retry=False):
+        shard = self._shards[self._hash(key) % self._count]
+        try:
+            return shard.get(key, default, read, expire_time, tag, retry)
+        except sqlite3.OperationalError as e:
+            raise Timeout from e
+
+
+class TieredCache(DjangoCache):
+    """diskcache with a small per-process LRU in front of it for hot keys.
+
+    Only keys starting with one of the `LOCAL_KEY_PREFIXES` are kept in memory (at most
+    `LOCAL_MAX_ENTRIES` per prefix for up to `LOCAL_TIMEOUT` seconds). Every write to such a
+    key changes its prefix's generation in diskcache, each process compares the generations
+    at most every `GENERATION_CHECK_INTERVAL` seconds and drops its copies of a prefix whose
+    generation changed. A value written by one worker is therefore seen by the others within
+    that interval.
+
+    Keys starting with one of the `LOCAL_VERSIONED_KEY_PREFIXES` are kept in memory too but
+    have no generation. They're for keys that include their own version (e.g. a counter
+    that's incremented to invalidate them), whose value doesn't change once written, so a
+    write only drops the writing process's copy of that key.
+
+    Values are pickled in memory (like Django's local memory cache) so that callers can't
+    change each other's copies.
+
+    Every operation is recorded in `metrics` per key prefix (the first `METRICS_KEY_DEPTH`
+    parts of the key), including reads that timed out which diskcache reports as misses.
+    """
+
+    def __init__(self, directory: str, params: dict[str, Any]):
+        BaseCache.__init__(self, params)
+        database_timeout: float = params.get("DATABASE_TIMEOUT", 0.010)
+        self._cache = _FanoutCache(
+            directory,
+            params.get("SHARDS", 8),
+            database_timeout,
+            **params.get("OPTIONS", {}),
+        )
+        self.metrics = CacheMetrics(
+            # Flushed by whichever request is recording when it's due, so it mustn't be able to
+            # hold that request up for any longer than the cache itself can
+            store=Cache(os.path.join(directory, "metrics"), timeout=database_timeout),  # type: ignore[arg-type]
+            key_depth=params.get("METRICS_KEY_DEPTH", 2),
+            flush_interval=params.get("METRICS_FLUSH_INTERVAL", 10),
+            retention=params.get("METRICS_RETENTION", 60 * 60 * 24),
+        )
+
+        self.generation_key_prefixes: tuple[str, ...] = tuple(params.get("LOCAL_KEY_PREFIXES", ()))
+        self.local_key_prefixes = self.generation_key_prefixes + tuple(
+            params.get("LOCAL_VERSIONED_KEY_PREFIXES", ())
+        )
+        self.generation_check_interval: float = params.get("GENERATION_CHECK_INTERVAL", 1.0)
+        local_max_entries: int = params.get("LOCAL_MAX_ENTRIES", 1024)
+        self.local_timeout: float = params.get("LOCAL_TIMEOUT", 60)
+
+        self._local: dict[str, LRUCache[str, bytes]] = {
+            prefix: LRUCache(maxsize=local_max_entries, ttl=self.local_timeout)
+            for prefix in self.local_key_prefixes
+        }
+        # Bumped whenever a prefix's local copies may be out of date, so that a read which
+        # started before then doesn't keep what it read
+        self._local_epochs: dict[str, int] = dict.fromkeys(self.local_key_prefixes, 0)
+        self._generations: dict[str, str | None] = {}
+        self._generations_checked_at = float("-inf")
+        self._lock = threading.Lock()
+
+    def _local_prefix(self, key: Any) -> str | None:
+        if isinstance(key, str):
+            for prefix in self.local_key_prefixes:
+                if key.startswith(prefix):
+                    return prefix
+        return None
+
+    def _generation_key(self, prefix: str) -> str:
+        # Stored in diskcache as is, without a key prefix or version
+        return f"tiered:generation:{prefix}"
+
+    def _next_generation(self, prefix: str) -> None:
+        self._cache.set(self._generation_key(prefix), uuid.uuid4().hex, retry=True)
+
+    def _drop_local(self, prefix: str) -> None:
+        with self._lock:
+            self._local_epochs[prefix] += 1
+            self._local[prefix].clear()
+
+    def _check_generations(self) -> None:
+        now = time.monotonic()
+        with self._lock:
+            if now - self._generations_checked_at < self.generation_check_interval:
+                return
+            self._generations_checked_at = now
+
+        for prefix in self.generation_key_prefixes:
+            try:
+                generation = cast(str | None, self._cache.get(self._generation_key(prefix)))
+            except Timeout:
+                # Looks like a new generation, which errs on the safe side
+                generation = None
+            if generation != self._generations.get(prefix):
+                self._generations[prefix] = generation
+                self._drop_local(prefix)
+
+    def _invalidate(self, key: Any, version: int | None) -> None:
+        prefix = self._local_prefix(key)
+        if prefix is None:
+            return
+
+        with self._lock:
+            self._local_epochs[prefix] += 1
+            self._local[prefix].delete(self.make_key(key, version=version))
+        if prefix in self.generation_key_prefixes:
+            # Tell the other processes that their copies are out of date
+            self._next_generation(prefix)
+
+    def get(
+        self,
+        key,
+        default=None,
+        version=None,
+        read=False,
+        expire_time=False,
+        tag=False,
+        retry=False,
+    ):
+        if read or expire_time or tag:
+            start = time.monotonic()
+            try:
+                return super().get(key, default, version, read, expire_time, tag, retry)
+            except Timeout:
+                self.metrics.record(key, counter="timeouts")
+                return default
+            finally:
+                self.metrics.record(key, operation="get", seconds=time.monotonic() - start)
+
+        prefix = self._local_prefix(key)
+        made_key = self.make_key(key, version=version)
+        epoch = 0
+        if prefix is not None:
+            self._check_generations()
+            pickled = self._local[prefix].get(made_key)
+            if pickled is not None:
+                self.metrics.record(key, counter="local_hits")
+                return pickle.loads(pickled)
+            epoch = self._local_epochs[prefix]
+
+        start = time.monotonic()
+        try:
+            value, expires_at = cast(
+                tuple[Any, float | None],
+                super().get(key, _MISSING, version, expire_time=True, retry=retry),
+            )
+        except Timeout:
+            self.metrics.record(
+                key, counter="timeouts", operation="get", seconds=time.monotonic() - start
+            )
+            return default
+        self.metrics.record(
+            key,
+            counter="misses" if value is _MISSING else "hits",
+            operation="get",
+            seconds=time.monotonic() - start,
+        )
+        if value is _MISSING:
+            return default
+
+        if prefix is not None:
+            ttl = self.local_timeout
+            if expires_at is not None:
+                # Never keep a copy for longer than diskcache keeps the value
+                ttl = min(ttl, expires_at - time.time())
+            with self._lock:
+                if self._local_epochs[prefix] == epoch:
+                    self._local[prefix].set(
+                        made_key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL), ttl=ttl
+                    )
+        return value
+
+    def set(
+        self,
+        key,
+        value,
+        timeout=DEFAULT_TIMEOUT,
+        version=None,
+        read=False,
+        tag=None,
+        retry=True,
+    ):
+        start = time.monotonic()
+        result = super().set(key, value, timeout, version, read, tag, retry)
+        self.metrics.record(key, counter="sets", operation="set", seconds=time.monotonic() - start)
+        self._invalidate(key, version)
+        return result
+
+    def add(
+        self,
+        key,
+        value,
+        timeout=DEFAULT_TIMEOUT,
+        version=None,
+        read=False,
+        tag=None,
+        retry=True,
+    ):
+        start = time.monotonic()
+        added = super().add(key, value, timeout, version, read, tag, retry)
+        self.metrics.record(key, counter="sets", operation="set", seconds=time.monotonic() - start)
+        if added:
+            self._invalidate(key, version)
+        return added
+
+    def incr(self, key, delta=1, version=None, default=None, retry=True):
+        start = time.monotonic()
+        value = super().incr(key, delta, version, default, retry)
+        self.metrics.record(key, counter="sets", operation="set", seconds=time.monotonic() - start)
+        self._invalidate(key, version)
+        return value
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None, retry=True):
+        start = time.monotonic()
+        touched = super().touch(key, timeout, version, retry)
+        self.metrics.record(key, counter="sets", operation="set", seconds=time.monotonic() - start)
+        if touched:
+            self._invalidate(key, version)
+        return touched
+
+    def pop(self, key, default=None, version=None, expire_time=False, tag=False, retry=True):
+        start = time.monotonic()
+        value = super().pop(key, default, version, expire_time, tag, retry)
+        self.metrics.record(
+            key, counter="deletes", operation="delete", seconds=time.monotonic() - start
+        )
+        self._invalidate(key, version)
+        return value
+
+    def delete(self, key, version=None, retry=True):
+        start = time.monotonic()
+        deleted = super().delete(key, version, retry)
+        self.metrics.record(
+            key, counter="deletes", operation="delete", seconds=time.monotonic() - start
+        )
+        # Even when it wasn't there, another process may have deleted it while we kept a copy
+        self._invalidate(key, version)
+        return deleted
+
+    def clear(self):
+        result = super().clear()
+        for prefix in self.local_key_prefixes:
+            self._drop_local(prefix)
+        for prefix in self.generation_key_prefixes:
+            # The generations were cleared too, so make sure they still change
+            self._next_generation(prefix)
+        return result
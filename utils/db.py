@@ -0,0 +1,179 @@
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, OperationalError, connections, transaction
+from django.http import HttpRequest, HttpResponse
+from django.template.response import SimpleTemplateResponse
+
+# Connection to the same database that can only read (see `DATABASES` in the settings)
+READ_ONLY_DB_ALIAS = "read_only"
+
+# What `PRAGMA auto_vacuum` returns for each mode
+_AUTO_VACUUM_MODES = {0: "NONE", 1: "FULL", 2: "INCREMENTAL"}
+# The order `SQLITE_DATABASE_PRAGMAS` are applied in: the page size and auto vacuum mode of a
+# new database before anything is written to it, the journal mode last as the page size can't
+# be changed in WAL mode
+_SQLITE_DATABASE_PRAGMA_ORDER = ("page_size", "auto_vacuum", "journal_mode")
+
+_read_only: ContextVar[bool] = ContextVar("read_only", default=False)
+
+
+@contextmanager
+def read_only() -> Iterator[None]:
+    """Send the reads made within to the read-only connection, also usable as a decorator.
+
+    Only for code that doesn't need to see its own uncommitted writes, although reads made
+    while the default connection is in a transaction stay on it anyway.
+    """
+    token = _read_only.set(True)
+    try:
+        yield
+    finally:
+        _read_only.reset(token)
+
+
+def read_only_view[ViewT: Callable[..., HttpResponse]](view_func: ViewT) -> ViewT:
+    """
+    Decorator for views that serves GET and HEAD requests from the read-only connection,
+    without wrapping them in a transaction on the default connection (`ATOMIC_REQUESTS`).
+
+    Other requests are handled as usual.
+    """
+
+    @wraps(view_func)
+    def wrapper(request: HttpRequest, *args, **kwargs) -> HttpResponse:
+        if request.method not in ("GET", "HEAD"):
+            if connections[DEFAULT_DB_ALIAS].settings_dict["ATOMIC_REQUESTS"]:
+                with transaction.atomic():
+                    return view_func(request, *args, **kwargs)
+            return view_func(request, *args, **kwargs)
+
+        with read_only():
+            response = view_func(request, *args, **kwargs)
+            # Templates are rendered after the view returns, render them while their
+            # queries still go to the read-only connection
+            if isinstance(response, SimpleTemplateResponse):
+                response.render()
+        return response
+
+    return transaction.non_atomic_requests(wrapper)  # type: ignore[return-value]
+
+
+def _sqlite_value(cursor, sql: str):
+    cursor.execute(sql)
+    row = cursor.fetchone()
+    if row is None:
+        raise RuntimeError(f"{sql} returned nothing")
+    return row[0]
+
+
+def _sqlite_pragma(cursor, pragma: str) -> str:
+    value = _sqlite_value(cursor, f"PRAGMA {pragma}")
+    if pragma == "auto_vacuum":
+        value = _AUTO_VACUUM_MODES.get(value, value)
+    return str(value).upper()
+
+
+class SQLiteDatabaseInUse(Exception):
+    """The database is open elsewhere so can't be rebuilt."""
+
+
+def _sqlite_database_pragmas() -> dict[str, str]:
+    pragmas = {
+        pragma: str(value).upper() for pragma, value in settings.SQLITE_DATABASE_PRAGMAS.items()
+    }
+    # Any others before the ones whose order matters
+    order = [pragma for pragma in pragmas if pragma not in _SQLITE_DATABASE_PRAGMA_ORDER] + [
+        pragma for pragma in _SQLITE_DATABASE_PRAGMA_ORDER if pragma in pragmas
+    ]
+    return {pragma: pragmas[pragma] for pragma in order}
+
+
+def configure_sqlite_database(*, using: str = DEFAULT_DB_ALIAS) -> dict[str, str]:
+    """Apply `SQLITE_DATABASE_PRAGMAS`, which are stored in the database file.
+
+    Unlike the PRAGMAs run on every new connection these only need setting once. A new
+    database takes them all straight away, but an existing one keeps its page size and auto
+    vacuum mode until it's rebuilt (see `rebuild_sqlite_database`). Returns the PRAGMAs that
+    still differ, with their current values.
+    """
+    connection = connections[using]
+    if connection.vendor != "sqlite" or connection.is_in_memory_db():
+        return {}
+
+    pragmas = _sqlite_database_pragmas()
+    with connection.cursor() as cursor:
+        for pragma, value in pragmas.items():
+            if _sqlite_pragma(cursor, pragma) != value:
+                cursor.execute(f"PRAGMA {pragma} = {value}")
+        current = {pragma: _sqlite_pragma(cursor, pragma) for pragma in pragmas}
+
+    return {
+        pragma: current[pragma] for pragma, value in pragmas.items() if current[pragma] != value
+    }
+
+
+def rebuild_sqlite_database(*, using: str = DEFAULT_DB_ALIAS) -> None:
+    """Rebuild the database file (`VACUUM`) to apply all of `SQLITE_DATABASE_PRAGMAS`.
+
+    Leaving WAL mode needs the only connection to the database, so nothing else (e.g. the
+    app) can have it open. Raises `SQLiteDatabaseInUse` rather than waiting when something
+    does.
+    """
+    connection = connections[using]
+    if connection.vendor != "sqlite":
+        raise ValueError(f"The {using} database isn't SQLite")
+
+    pragmas = _sqlite_database_pragmas()
+    journal_mode = pragmas.pop("journal_mode", None)
+    with connection.cursor() as cursor:
+        cursor.execute("PRAGMA busy_timeout = 0")
+        try:
+            mode = str(_sqlite_value(cursor, "PRAGMA journal_mode = DELETE"))
+        except OperationalError as e:
+            raise SQLiteDatabaseInUse(str(e)) from e
+        if mode.upper() != "DELETE":
+            raise SQLiteDatabaseInUse(f"Journal mode is still {mode}")
+
+        for pragma, value in pragmas.items():
+            cursor.execute(f"PRAGMA {pragma} = {value}")
+        cursor.execute("VACUUM")
+        if journal_mode is not None:
+            cursor.execute(f"PRAGMA journal_mode = {journal_mode}")
+
+    differing = configure_sqlite_database(using=using)
+    if differing:
+        raise RuntimeError(f"Rebuilt the database but PRAGMAs still differ: {differing}")
+
+
+class ReadOnlyRouter:
+    """Send reads made within `read_only` to the read-only connection.
+
+    Everything else uses the default connection, including reads made while it's in a
+    transaction as they might need to see what it hasn't committed yet. Its SQLite
+    transactions take the write lock straight away (`IMMEDIATE`) whereas the read-only
+    connection's are deferred, so reads sent there don't wait on writers.
+    """
+
+    def db_for_read(self, model, **hints) -> str:
+        if (
+            _read_only.get()
+            and READ_ONLY_DB_ALIAS in settings.DATABASES
+            and not connections[DEFAULT_DB_ALIAS].in_atomic_block
+        ):
+            return READ_ONLY_DB_ALIAS
+        return DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints) -> str:
+        # Also for objects read from the read-only connection
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints) -> bool:
+        return {obj1._state.db, obj2._state.db} <= {DEFAULT_DB_ALIAS, READ_ONLY_DB_ALIAS}
+
+    def allow_migrate(self, db: str, app_label: str, model_name=None, **hints) -> bool:
+        # Same database as the default connection
+        return db != READ_ONLY_DB_ALIAS
@@ -0,0 +1,35 @@
+import time
+from collections.abc import Callable
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.http import HttpRequest, HttpResponse
+
+# Monotonic time by which the current request should have a response
+_request_deadline: ContextVar[float | None] = ContextVar("request_deadline", default=None)
+
+
+def remaining_request_budget() -> float | None:
+    """Seconds left to respond to the current request or `None` outside of a request."""
+    deadline = _request_deadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+class RequestDeadlineMiddleware:
+    """Give every request a time budget (`REQUEST_TIME_BUDGET`) that slow calls can check.
+
+    The budget should be below the gunicorn worker timeout so that a request can still
+    respond (e.g. with a retry page) rather than have its worker killed.
+    """
+
+    def __init__(self, get_response: Callable[[HttpRequest], HttpResponse]):
+        self.get_response = get_response
+
+    def __call__(self, request: HttpRequest) -> HttpResponse:
+        token = _request_deadline.set(time.monotonic() + settings.REQUEST_TIME_BUDGET)
+        try:
+            return self.get_response(request)
+        finally:
+            _request_deadline.reset(token)
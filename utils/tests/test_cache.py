@@ -0,0 +1,157 @@
+import threading
+import time
+from unittest import mock
+
+from django.core.cache import cache
+from django.test import SimpleTestCase, override_settings
+
+from utils.cache import CachedValue, get_or_compute
+
+KEY = "test:key"
+LOCK_KEY = f"lock:{KEY}"
+
+
+class Compute:
+    """Stand in for an expensive computation that counts its calls."""
+
+    def __init__(self, value: str = "new", *, error: Exception | None = None) -> None:
+        self.value = value
+        self.error = error
+        self.calls = 0
+
+    def __call__(self) -> str:
+        self.calls += 1
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+@override_settings(
+    CACHES={
+        "default": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+            "LOCATION": "utils.tests.test_cache",
+        }
+    }
+)
+class GetOrComputeTestCase(SimpleTestCase):
+    def setUp(self) -> None:
+        cache.clear()
+
+    def set_stale(self, value: str = "stale") -> None:
+        cache.set(KEY, CachedValue(value=value, fresh_until=time.time() - 1, compute_time=0.01), 60)
+
+    def test_computes_once(self) -> None:
+        compute = Compute()
+
+        self.assertEqual(get_or_compute(KEY, compute, timeout=60), "new")
+        self.assertEqual(get_or_compute(KEY, compute, timeout=60), "new")
+        self.assertEqual(compute.calls, 1)
+        self.assertIsNone(cache.get(LOCK_KEY))
+
+    def test_refreshes_stale_value(self) -> None:
+        self.set_stale()
+        compute = Compute()
+
+        self.assertEqual(get_or_compute(KEY, compute, timeout=60), "new")
+        self.assertEqual(compute.calls, 1)
+
+    def test_serves_stale_value_while_locked(self) -> None:
+        self.set_stale()
+        cache.add(LOCK_KEY, True)
+        compute = Compute()
+
+        self.assertEqual(get_or_compute(KEY, compute, timeout=60), "stale")
+        self.assertEqual(compute.calls, 0)
+
+    def test_serves_stale_value_when_computing_fails(self) -> None:
+        self.set_stale()
+        compute = Compute(error=ValueError("boom"))
+
+        with self.assertLogs("utils.cache", level="ERROR"):
+            self.assertEqual(get_or_compute(KEY, compute, timeout=60), "stale")
+        self.assertEqual(compute.calls, 1)
+        self.assertIsNone(cache.get(LOCK_KEY))
+
+    def test_raises_when_computing_fails_without_stale_value(self) -> None:
+        compute = Compute(error=ValueError("boom"))
+
+        with self.assertRaises(ValueError):
+            get_or_compute(KEY, compute, timeout=60)
+        self.assertIsNone(cache.get(LOCK_KEY))
+
+    def test_waits_for_value_computed_elsewhere(self) -> None:
+        cache.add(LOCK_KEY, True)
+        compute = Compute()
+
+        def compute_elsewhere() -> None:
+            time.sleep(0.2)
+            cache.set(
+                KEY, CachedValue(value="elsewhere", fresh_until=time.time() + 60, compute_time=0.2)
+            )
+
+        thread = threading.Thread(target=compute_elsewhere)
+        thread.start()
+        self.addCleanup(thread.join)
+
+        self.assertEqual(get_or_compute(KEY, compute, timeout=60, compute_wait=2), "elsewhere")
+        self.assertEqual(compute.calls, 0)
+
+    def test_computes_itself_after_waiting(self) -> None:
+        cache.add(LOCK_KEY, True)
+        compute = Compute()
+
+        self.assertEqual(get_or_compute(KEY, compute, timeout=60, compute_wait=0.1), "new")
+        self.assertEqual(compute.calls, 1)
+
+    def test_computes_itself_without_waiting(self) -> None:
+        cache.add(LOCK_KEY, True)
+        compute = Compute()
+
+        with mock.patch("utils.cache.time.sleep") as sleep:
+            self.assertEqual(get_or_compute(KEY, compute, timeout=60), "new")
+        sleep.assert_not_called()
+        self.assertEqual(compute.calls, 1)
+
+    def test_refreshes_early_when_near_stale(self) -> None:
+        # Fresh for another second but takes ten to compute
+        cache.set(KEY, CachedValue(value="old", fresh_until=time.time() + 1, compute_time=10), 60)
+        compute = Compute()
+
+        with mock.patch("utils.cache.random.random", return_value=0.5):
+            self.assertEqual(get_or_compute(KEY, compute, timeout=60), "new")
+        self.assertEqual(compute.calls, 1)
+
+    def test_doesnt_refresh_early_when_far_from_stale(self) -> None:
+        cache.set(
+            KEY, CachedValue(value="old", fresh_until=time.time() + 60, compute_time=0.01), 60
+        )
+        compute = Compute()
+
+        with mock.patch("utils.cache.random.random", return_value=0.5):
+            self.assertEqual(get_or_compute(KEY, compute, timeout=60), "old")
+        self.assertEqual(compute.calls, 0)
+
+    def test_refreshes_in_background(self) -> None:
+        self.set_stale()
+        computing = threading.Event()
+        finish = threading.Event()
+
+        def compute() -> str:
+            computing.set()
+            finish.wait(timeout=5)
+            return "new"
+
+        self.assertEqual(
+            get_or_compute(KEY, compute, timeout=60, refresh_in_background=True), "stale"
+        )
+        self.assertTrue(computing.wait(timeout=5))
+        # Others are served the stale value while it's computed
+        self.assertEqual(get_or_compute(KEY, Compute(), timeout=60), "stale")
+
+        finish.set()
+        deadline = time.monotonic() + 5
+        while cache.get(LOCK_KEY) is not None and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(cache.get(KEY).value, "new")
+        self.assertIsNone(cache.get(LOCK_KEY))
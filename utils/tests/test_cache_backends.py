@@ -0,0 +1,136 @@
+import tempfile
+from typing import Any
+from unittest import mock
+
+from diskcache import DjangoCache
+from django.test import SimpleTestCase
+
+from utils.cache_backends import TieredCache
+
+KEY = "local:key"
+VERSIONED_KEY = "versioned:key:1"
+
+
+class TieredCacheTestCase(SimpleTestCase):
+    """Two instances over the same directory stand in for two worker processes."""
+
+    def setUp(self) -> None:
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def tiered_cache(self, *, generation_check_interval: float) -> TieredCache:
+        tiered_cache = TieredCache(
+            self.directory,
+            {
+                "SHARDS": 2,
+                "DATABASE_TIMEOUT": 1,
+                "LOCAL_KEY_PREFIXES": ["local:"],
+                "LOCAL_VERSIONED_KEY_PREFIXES": ["versioned:"],
+                "GENERATION_CHECK_INTERVAL": generation_check_interval,
+            },
+        )
+        self.addCleanup(tiered_cache.metrics.store.close)
+        self.addCleanup(tiered_cache.close)
+        return tiered_cache
+
+    def local_hits(self, tiered_cache: TieredCache) -> int:
+        return tiered_cache.metrics._prefixes.get("local:key", {}).get("local_hits", 0)
+
+    def test_serves_local_copy(self) -> None:
+        worker = self.tiered_cache(generation_check_interval=60)
+        other_worker = self.tiered_cache(generation_check_interval=60)
+        worker.set(KEY, "old")
+        self.assertEqual(worker.get(KEY), "old")
+
+        # Written straight to diskcache so no generation changes
+        DjangoCache.set(other_worker, KEY, "new")
+
+        self.assertEqual(worker.get(KEY), "old")
+        self.assertEqual(self.local_hits(worker), 1)
+        self.assertEqual(other_worker.get(KEY), "new")
+
+    def test_local_copies_are_independent(self) -> None:
+        worker = self.tiered_cache(generation_check_interval=60)
+        worker.set(KEY, ["a"])
+        worker.get(KEY).append("b")  # type: ignore[union-attr]
+
+        self.assertEqual(worker.get(KEY), ["a"])
+
+    def test_ignores_other_prefixes(self) -> None:
+        worker = self.tiered_cache(generation_check_interval=60)
+        other_worker = self.tiered_cache(generation_check_interval=60)
+        worker.set("other:key", "old")
+        worker.get("other:key")
+        other_worker.set("other:key", "new")
+
+        self.assertEqual(worker.get("other:key"), "new")
+
+    def test_write_propagates_to_other_workers(self) -> None:
+        worker = self.tiered_cache(generation_check_interval=0)
+        other_worker = self.tiered_cache(generation_check_interval=0)
+        worker.set(KEY, "old")
+        self.assertEqual(worker.get(KEY), "old")
+
+        other_worker.set(KEY, "new")
+
+        self.assertEqual(worker.get(KEY), "new")
+
+    def test_delete_propagates_to_other_workers(self) -> None:
+        worker = self.tiered_cache(generation_check_interval=0)
+        other_worker = self.tiered_cache(generation_check_interval=0)
+        worker.set(KEY, "old")
+        self.assertEqual(worker.get(KEY), "old")
+
+        other_worker.delete(KEY)
+
+        self.assertIsNone(worker.get(KEY))
+
+    def test_delete_drops_local_copy_of_missing_key(self) -> None:
+        worker = self.tiered_cache(generation_check_interval=60)
+        other_worker = self.tiered_cache(generation_check_interval=60)
+        worker.set(KEY, "old")
+        self.assertEqual(worker.get(KEY), "old")
+        other_worker.delete(KEY)
+
+        # Already gone from diskcache but still in this worker's memory
+        self.assertFalse(worker.delete(KEY))
+        self.assertIsNone(worker.get(KEY))
+
+    def test_read_racing_a_write_isnt_kept(self) -> None:
+        worker = self.tiered_cache(generation_check_interval=60)
+        worker.set(KEY, "old")
+        disk_get = DjangoCache.get
+
+        def get_then_write(tiered_cache: TieredCache, key: Any, *args, **kwargs) -> Any:
+            value = disk_get(tiered_cache, key, *args, **kwargs)
+            if key == KEY:
+                # Another thread writes after the read but before the copy is kept
+                tiered_cache.set(KEY, "new")
+            return value
+
+        with mock.patch.object(DjangoCache, "get", get_then_write):
+            self.assertEqual(worker.get(KEY), "old")
+
+        self.assertEqual(worker.get(KEY), "new")
+
+    def test_versioned_write_keeps_other_workers_copies(self) -> None:
+        worker = self.tiered_cache(generation_check_interval=0)
+        other_worker = self.tiered_cache(generation_check_interval=0)
+        worker.set(VERSIONED_KEY, "old")
+        self.assertEqual(worker.get(VERSIONED_KEY), "old")
+
+        other_worker.set("versioned:key:2", "new")
+        # Written straight to diskcache, so only a kept copy still reads "old"
+        DjangoCache.set(other_worker, VERSIONED_KEY, "new")
+
+        self.assertEqual(worker.get(VERSIONED_KEY), "old")
+
+    def test_versioned_write_drops_own_copy(self) -> None:
+        worker = self.tiered_cache(generation_check_interval=60)
+        worker.set(VERSIONED_KEY, "old")
+        self.assertEqual(worker.get(VERSIONED_KEY), "old")
+
+        worker.set(VERSIONED_KEY, "new")
+
+        self.assertEqual(worker.get(VERSIONED_KEY), "new")
@@ -0,0 +1,118 @@
+import os
+import tempfile
+from unittest import mock
+
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.test import SimpleTestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from wagtail.models import Page, Site
+
+from user import models, selectors
+from utils.db import READ_ONLY_DB_ALIAS, configure_sqlite_database, read_only
+
+
+class ReadOnlyRouterTestCase(TransactionTestCase):
+    databases = {DEFAULT_DB_ALIAS, READ_ONLY_DB_ALIAS}
+    # Keeps the page tree and locale created by Wagtail's migrations
+    serialized_rollback = True
+
+    def setUp(self) -> None:
+        self.user = models.AgoraUser.objects.create_user(email="someone@example.com")
+
+    def capture_queries(self) -> tuple[CaptureQueriesContext, CaptureQueriesContext]:
+        default_queries = CaptureQueriesContext(connections[DEFAULT_DB_ALIAS])
+        read_only_queries = CaptureQueriesContext(connections[READ_ONLY_DB_ALIAS])
+        for queries in (default_queries, read_only_queries):
+            # `enterContext`, which its type hints don't allow
+            queries.__enter__()
+            self.addCleanup(queries.__exit__, None, None, None)
+        return default_queries, read_only_queries
+
+    def test_reads_within_read_only_use_alias(self) -> None:
+        default_queries, read_only_queries = self.capture_queries()
+
+        with read_only():
+            self.assertTrue(models.AgoraUser.objects.filter(id=self.user.id).exists())
+
+        self.assertEqual(len(default_queries), 0)
+        self.assertEqual(len(read_only_queries), 1)
+
+    def test_read_only_selector_uses_alias(self) -> None:
+        default_queries, read_only_queries = self.capture_queries()
+
+        self.assertFalse(selectors.user_has_verified_identity(user=self.user))
+
+        self.assertEqual(len(default_queries), 0)
+        self.assertEqual(len(read_only_queries), 1)
+
+    def test_reads_outside_read_only_use_default(self) -> None:
+        default_queries, read_only_queries = self.capture_queries()
+
+        self.assertTrue(models.AgoraUser.objects.filter(id=self.user.id).exists())
+
+        self.assertEqual(len(default_queries), 1)
+        self.assertEqual(len(read_only_queries), 0)
+
+    def test_writes_use_default(self) -> None:
+        default_queries, read_only_queries = self.capture_queries()
+
+        with read_only():
+            user = models.AgoraUser.objects.get(id=self.user.id)
+            user.nickname = "Someone"
+            user.save(update_fields=["nickname"])
+
+        self.assertEqual(len(default_queries), 1)
+        self.assertEqual(len(read_only_queries), 1)
+        self.assertEqual(models.AgoraUser.objects.get(id=self.user.id).nickname, "Someone")
+
+    def test_reads_within_transaction_use_default(self) -> None:
+        default_queries, read_only_queries = self.capture_queries()
+
+        with read_only(), transaction.atomic():
+            models.AgoraUser.objects.filter(id=self.user.id).update(nickname="Someone")
+            # Has to see the uncommitted update
+            self.assertTrue(
+                models.AgoraUser.objects.filter(id=self.user.id, nickname="Someone").exists()
+            )
+
+        self.assertEqual(len(read_only_queries), 0)
+
+    def test_wagtail_page_renders_on_alias(self) -> None:
+        # The root of the page tree
+        page = Page.objects.get(depth=1).add_child(title="Read only", slug="read-only")
+        Site.objects.all().delete()
+        Site.objects.create(hostname="testserver", root_page=page, is_default_site=True)
+        default_queries, read_only_queries = self.capture_queries()
+
+        response = self.client.get("/")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, "Read only")
+        self.assertEqual(len(default_queries), 0)
+        self.assertGreater(len(read_only_queries), 0)
+
+
+class ConfigureSQLiteDatabaseTestCase(SimpleTestCase):
+    # Only the database added below is used, the test runner doesn't know about it
+    databases = "__all__"
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        # A database file that doesn't exist yet, added before `databases` is resolved
+        directory = tempfile.TemporaryDirectory()
+        cls.addClassCleanup(directory.cleanup)
+        settings_dict = {
+            **connections[DEFAULT_DB_ALIAS].settings_dict,
+            "NAME": os.path.join(directory.name, "new.sqlite3"),
+        }
+        cls.enterClassContext(mock.patch.dict(connections.settings, {"new": settings_dict}))
+        cls.addClassCleanup(cls.close_connection)
+        super().setUpClass()
+
+    @classmethod
+    def close_connection(cls) -> None:
+        connections["new"].close()
+        del connections["new"]
+
+    def test_new_database_takes_all_pragmas(self) -> None:
+        self.assertEqual(configure_sqlite_database(using="new"), {})